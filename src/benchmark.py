@@ -0,0 +1,513 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import logging
+import statistics
+import time
+import timeit
+from copy import deepcopy
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Union
+from lxml import etree
+from definitions import XML_FILES
+from parser import load_tei
+from cache import NerCache
+
+BENCHMARK_TEI: str = XML_FILES + "acssuschemeng.7b03870.tei.xml"
+# Maximum seconds for a cold import of the entry points, see benchmark_imports
+IMPORT_TIME_BUDGETS: Dict[str, float] = {"main": 0.25, "server": 0.35, "client": 0.35}
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+# Scales of the bundled TEI in the stage benchmarks of the suite, see scale_tei
+SUITE_SCALES: List[int] = [1, 10]
+# Relative slowdown of a stage median against the baseline reported as regression
+SUITE_TOLERANCE: float = 0.2
+# Names resolved by the search_pubchem stage
+SUITE_NAMES: int = 20
+
+
+def measure(func: Callable[[], Any], repeat: int = 5, number: int = 10) -> Dict[str, float]:
+    """Time a function with timeit.
+
+    Args:
+        func (Callable[[], Any]): Function to time
+        repeat (int, optional): Number of timing runs. Defaults to 5.
+        number (int, optional): Calls of func per timing run. Defaults to 10.
+
+    Returns:
+        Dict[str, float]: Best and median seconds per call
+    """
+    runs = [run / number for run in timeit.repeat(func, repeat=repeat, number=number)]
+    return {"best": min(runs), "median": statistics.median(runs)}
+
+
+def _clean_xml_retag(path: str) -> etree._Element:
+    """Reference implementation of the former clean_xml: parse, then retag every element."""
+    with open(path, "rb") as file:
+        xml_tree = etree.fromstring(file.read())
+    for elem in xml_tree.iter():
+        try:
+            elem.tag = etree.QName(elem).localname
+        except ValueError:
+            logging.warning(f"Element {elem.tag} has no name.")
+    etree.cleanup_namespaces(xml_tree)
+    return xml_tree
+
+
+def benchmark_tei_loading(path: str = BENCHMARK_TEI, repeat: int = 5, number: int = 20) -> Dict[str, Any]:
+    """Compare the single pass load_tei with parsing and retagging every element.
+
+    Args:
+        path (str, optional): TEI file. Defaults to BENCHMARK_TEI.
+        repeat (int, optional): Number of timing runs. Defaults to 5.
+        number (int, optional): Loads per timing run. Defaults to 20.
+
+    Returns:
+        Dict[str, Any]: Timings of both loaders, speedup of the medians and whether the trees are identical
+    """
+    identical = etree.tostring(load_tei(path)) == etree.tostring(_clean_xml_retag(path))
+    retag = measure(lambda: _clean_xml_retag(path), repeat, number)
+    single_pass = measure(lambda: load_tei(path), repeat, number)
+    return {
+        "retag": retag,
+        "load_tei": single_pass,
+        "speedup": retag["median"] / single_pass["median"],
+        "identical": identical,
+    }
+
+
+def _xpath_classify_elements(reader, root):
+    return (
+        reader._xpath(reader.metadata_title_xpath, root),
+        reader._xpath(reader.headings_xpath, root),
+        reader._xpath(reader.figures_xpath, root),
+        reader._xpath(reader.tables_xpath, root),
+        reader._xpath(reader.references_text_xpath, root),
+        reader._xpath(reader.metadata_xpath, root),
+    )
+
+
+def _xpath_reader():
+    """Reference reader, which classifies the elements with one xpath query per kind of element."""
+    from tei_reader import TeiXmlReader
+
+    reader = TeiXmlReader()
+    reader._classify_elements = partial(_xpath_classify_elements, reader)
+    return reader
+
+
+def scale_tei(root: etree._Element, scale: int) -> etree._Element:
+    """Large TEI tree for benchmarks, the content of the body is repeated scale times.
+
+    Args:
+        root (etree._Element): TEI root element without namespaces
+        scale (int): Number of copies of the body content
+
+    Returns:
+        etree._Element: New TEI root element
+    """
+    root = deepcopy(root)
+    body = root.find(".//body")
+    content = list(body)
+    for _ in range(scale - 1):
+        body.extend(deepcopy(child) for child in content)
+    return root
+
+
+def benchmark_parse(
+    path: str = BENCHMARK_TEI, scale: int = 10, repeat: int = 3, number: int = 3
+) -> Dict[str, Any]:
+    """Compare the single walk element classification of TeiXmlReader.parse with xpath queries per kind
+       of element, for the classification alone and for the whole parse stage.
+
+    Args:
+        path (str, optional): TEI file. Defaults to BENCHMARK_TEI.
+        scale (int, optional): Copies of the body content, see scale_tei. Defaults to 10.
+        repeat (int, optional): Number of timing runs. Defaults to 3.
+        number (int, optional): Calls per timing run. Defaults to 3.
+
+    Returns:
+        Dict[str, Any]: Timings, speedups of the medians and whether the results are identical
+    """
+    from tei_reader import TeiXmlReader
+
+    root = scale_tei(load_tei(path), scale)
+    reader, xpath_reader = TeiXmlReader(), _xpath_reader()
+    identical = reader._classify_elements(root) == tuple(xpath_reader._classify_elements(root))
+    classify_xpath = measure(lambda: xpath_reader._classify_elements(root), repeat, number)
+    classify_walk = measure(lambda: reader._classify_elements(root), repeat, number)
+    # parse modifies the tree, both variants parse a fresh copy
+    parse_xpath = measure(lambda: _xpath_reader().parse(deepcopy(root)), repeat, number)
+    parse_walk = measure(lambda: TeiXmlReader().parse(deepcopy(root)), repeat, number)
+    return {
+        "elements": sum(1 for _ in root.iter()),
+        "classify_xpath": classify_xpath,
+        "classify_walk": classify_walk,
+        "classify_speedup": classify_xpath["median"] / classify_walk["median"],
+        "parse_xpath": parse_xpath,
+        "parse_walk": parse_walk,
+        "parse_speedup": parse_xpath["median"] / parse_walk["median"],
+        "identical": identical,
+    }
+
+
+def benchmark_sharded_ner(
+    path: str = BENCHMARK_TEI, scale: int = 10, shard_size: int = 200, workers: Optional[int] = None
+) -> Dict[str, Any]:
+    """Compare the NER of a whole document with the NER of its shards in parallel processes. The records
+       are extracted once per variant, the first call of CDE is slow enough for a single run.
+
+    Args:
+        path (str, optional): TEI file. Defaults to BENCHMARK_TEI.
+        scale (int, optional): Copies of the body content, see scale_tei. Defaults to 10.
+        shard_size (int, optional): Elements per shard. Defaults to 200 (NER_SHARD_SIZE).
+        workers (int, optional): Number of worker processes. Defaults to the number of cores.
+
+    Returns:
+        Dict[str, Any]: Seconds of both variants, speedup, whether the same names and the same records are
+                        found and the records found by only one of the variants
+    """
+    from ner import extract_records, get_ner_pool
+    from tei_reader import TeiXmlReader
+
+    root = scale_tei(load_tei(path), scale)
+    # Fork the workers before the timed run
+    get_ner_pool(workers)
+    # Elements cache their tokens and tags, both variants get freshly parsed elements
+    elements = TeiXmlReader().parse_elements(deepcopy(root))
+    start = time.perf_counter()
+    whole = extract_records(elements, shard_size=None)
+    whole_seconds = time.perf_counter() - start
+    elements = TeiXmlReader().parse_elements(deepcopy(root))
+    start = time.perf_counter()
+    sharded = extract_records(elements, shard_size=shard_size, workers=workers)
+    sharded_seconds = time.perf_counter() - start
+    whole_records, sharded_records = _canonical_records(whole), _canonical_records(sharded)
+    return {
+        "elements": len(elements),
+        "whole": whole_seconds,
+        "sharded": sharded_seconds,
+        "speedup": whole_seconds / sharded_seconds,
+        "same_names": _names(whole) == _names(sharded),
+        "same_records": whole_records == sharded_records,
+        "only_whole": len(whole_records - sharded_records),
+        "only_sharded": len(sharded_records - whole_records),
+    }
+
+
+def benchmark_ner_cache(path: str = BENCHMARK_TEI, runs: int = 2) -> Dict[str, Any]:
+    """Extract the records of a document repeatedly with an empty NER cache. The first run tags every
+       sentence, later runs are served from the cache.
+
+    Args:
+        path (str, optional): TEI file. Defaults to BENCHMARK_TEI.
+        runs (int, optional): Number of extractions. Defaults to 2.
+
+    Returns:
+        Dict[str, Any]: Seconds per run and the hit ratio of the cache
+    """
+    from ner import NER_VERSION, extract_records
+    from tei_reader import TeiXmlReader
+
+    root = load_tei(path)
+    seconds = []
+    with tempfile.TemporaryDirectory() as directory:
+        cache = NerCache(NER_VERSION, path=os.path.join(directory, "ner_cache.sqlite"))
+        for _ in range(runs):
+            elements = TeiXmlReader().parse_elements(deepcopy(root))
+            start = time.perf_counter()
+            extract_records(elements, shard_size=None, cache=cache)
+            seconds.append(time.perf_counter() - start)
+        stats = cache.stats().get("sentence", {})
+        cache.close()
+    return {"seconds": seconds, "hit_ratio": stats.get("hit_ratio", 0.0)}
+
+
+def _names(records: List[Dict[str, Any]]) -> Set[str]:
+    return {name for record in records for name in record.get("Compound", {}).get("names", [])}
+
+
+def _canonical_records(records: List[Dict[str, Any]]) -> Set[str]:
+    """Records as JSON with the lists sorted, merged records list their names and labels in another order."""
+
+    def canonical(value: Any) -> Any:
+        if isinstance(value, dict):
+            return {key: canonical(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return sorted((canonical(item) for item in value), key=lambda item: json.dumps(item, sort_keys=True))
+        return value
+
+    return {json.dumps(canonical(record), sort_keys=True) for record in records}
+
+
+def measure_import_time(module: str) -> Dict[str, Any]:
+    """Imports a module in a fresh interpreter with python -X importtime.
+
+    Args:
+        module (str): Module name, imported with the directory of this file on the path
+
+    Returns:
+        Dict[str, Any]: Cumulative seconds of the import and the ten slowest modules imported by it
+                        (seconds without their own imports)
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=directory,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds, modules = 0.0, []
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        modules.append((name, int(self_us) / 1e6))
+        # Lines are printed after the imports of a module, top level imports have an indent of one space
+        if len(indent) == 1:
+            if name == module:
+                seconds = int(cumulative_us) / 1e6
+                break
+            # Imported by the interpreter startup, not by the module
+            modules = []
+    modules.sort(key=lambda item: -item[1])
+    return {"seconds": seconds, "slowest": dict(modules[:10])}
+
+
+def benchmark_imports(budgets: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """Measures the cold import time of the entry points and compares it with their budgets.
+
+    Args:
+        budgets (Dict[str, float], optional): Seconds by module name. Defaults to IMPORT_TIME_BUDGETS.
+
+    Returns:
+        Dict[str, Any]: Import time, budget and slowest imports by module, "passed" if all are within budget
+    """
+    budgets = budgets or IMPORT_TIME_BUDGETS
+    results: Dict[str, Any] = {}
+    for module, budget in budgets.items():
+        results[module] = {**measure_import_time(module), "budget": budget}
+        results[module]["passed"] = results[module]["seconds"] <= budget
+    results["passed"] = all(result["passed"] for result in results.values())
+    return results
+
+
+def _timed(func: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def benchmark_stages(
+    path: str = BENCHMARK_TEI, scales: Sequence[int] = SUITE_SCALES, repeat: int = 3, names: int = SUITE_NAMES
+) -> Dict[str, Any]:
+    """Times the stages of the extraction: clean_xml, TeiXmlReader.parse and the CDE records on the TEI
+       file at several scales, search_pubchem and get_structure_img on its first names with an empty
+       and with a warm cache, and compare_documents on two new pdf files. The network stages use the
+       services configured in definitions.py, run_suite points them to the stand-ins.
+
+    Args:
+        path (str, optional): TEI file. Defaults to BENCHMARK_TEI.
+        scales (Sequence[int], optional): Copies of the body content, see scale_tei. Defaults to SUITE_SCALES.
+        repeat (int, optional): Number of timing runs of the local stages. Defaults to 3.
+        names (int, optional): Number of names resolved with PubChem. Defaults to SUITE_NAMES.
+
+    Returns:
+        Dict[str, Any]: Timings (best and median seconds) by stage name, "<stage>@<scale>" for scaled stages
+    """
+    from cache import PubChemCache
+    from definitions import PDF_FILES
+    from image_store import ImageStore
+    from main import compare_documents
+    from ner import extract_records
+    from parser import clean_xml
+    from pubchem import get_structure_img, search_pubchem
+    from tei_reader import TeiXmlReader
+    from utils import create_session
+
+    results: Dict[str, Any] = {}
+    root = load_tei(path)
+    chem_names: List[str] = []
+    for scale in scales:
+        tei = etree.tostring(scale_tei(root, scale))
+        results[f"clean_xml@{scale}"] = measure(lambda: clean_xml(tei), repeat, 1)
+        results[f"parse@{scale}"] = measure(lambda: TeiXmlReader().parse(clean_xml(tei)), repeat, 1)
+        # CDE caches tokens and tags on the elements, every run extracts from freshly parsed elements
+        runs = []
+        for _ in range(repeat):
+            elements = TeiXmlReader().parse_elements(clean_xml(tei))
+            runs.append(_timed(lambda: chem_names.extend(_names(extract_records(elements, shard_size=None)))))
+        results[f"records@{scale}"] = {"best": min(runs), "median": statistics.median(runs)}
+    search_terms = list(dict.fromkeys(chem_names))[:names]
+    session = create_session()
+    with tempfile.TemporaryDirectory() as directory:
+        cache = PubChemCache(os.path.join(directory, "pubchem_cache.sqlite"))
+        cids: List[int] = []
+        for state in ("cold", "warm"):
+            start = time.perf_counter()
+            for term in search_terms:
+                compounds = search_pubchem(term, session, cache=cache)
+                cids.extend(compound[1]["cid"] for compound in compounds if compound[1]["cid"] is not None)
+            seconds = time.perf_counter() - start
+            results[f"search_pubchem_{state}"] = {"names": len(search_terms), "seconds": seconds}
+        # Images of the searched compounds are stored by search_pubchem, get_structure_img starts empty
+        store = ImageStore(os.path.join(directory, "image_files"))
+        for state in ("cold", "warm"):
+            seconds = _timed(lambda: [get_structure_img(cid, session, store) for cid in set(cids)])
+            results[f"get_structure_img_{state}"] = {"images": len(set(cids)), "seconds": seconds}
+    # Distinct contents, so that the manifest has no results for them yet
+    pdf_names = []
+    for document in ("source", "recommendation"):
+        pdf_name = f"benchmark-{document}-{time.time_ns()}.pdf"
+        with open(PDF_FILES + pdf_name, "wb") as file:
+            file.write(b"%PDF-1.4 " + pdf_name.encode("ascii"))
+        pdf_names.append(pdf_name)
+    try:
+        results["compare_documents"] = {"seconds": _timed(lambda: compare_documents(*pdf_names, session=session))}
+    finally:
+        for pdf_name in pdf_names:
+            os.remove(PDF_FILES + pdf_name)
+    return results
+
+
+def _seconds(result: Dict[str, Any]) -> Optional[float]:
+    return result.get("median", result.get("seconds"))
+
+
+def compare_with_baseline(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = SUITE_TOLERANCE
+) -> Dict[str, Any]:
+    """Compares stage timings with a baseline run.
+
+    Args:
+        results (Dict[str, Any]): Stage timings, see benchmark_stages
+        baseline (Dict[str, Any]): Stage timings of the baseline
+        tolerance (float, optional): Relative slowdown reported as regression. Defaults to SUITE_TOLERANCE.
+
+    Returns:
+        Dict[str, Any]: Seconds, baseline seconds and ratio by stage present in both, the names of the
+                        regressed stages under "regressions"
+    """
+    comparison: Dict[str, Any] = {}
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        seconds, baseline_seconds = _seconds(result), _seconds(baseline[stage])
+        if seconds is None or not baseline_seconds:
+            continue
+        ratio = seconds / baseline_seconds
+        comparison[stage] = {"seconds": seconds, "baseline": baseline_seconds, "ratio": ratio}
+        if ratio > 1 + tolerance:
+            regressions.append(stage)
+    comparison["regressions"] = regressions
+    return comparison
+
+
+def run_suite(
+    output: Optional[str] = None,
+    baseline: Optional[str] = None,
+    latency: Union[float, Dict[str, float]] = 0.0,
+    recordings_dir: Optional[str] = None,
+    scales: Sequence[int] = SUITE_SCALES,
+    tolerance: float = SUITE_TOLERANCE,
+) -> Dict[str, Any]:
+    """Runs benchmark_stages offline: PubChem, Hyplag and Grobid are replaced by local stand-ins (see
+       stand_ins.py) and all caches, the manifest, the token and the data folders are temporary, so that
+       runs are reproducible. The stages run in a new interpreter, which reads the stand-in URLs and paths
+       from the environment in definitions.py.
+
+    Args:
+        output (str, optional): JSON file for the results. Defaults to None.
+        baseline (str, optional): JSON file of earlier results to compare with. Defaults to None.
+        latency (Union[float, Dict[str, float]], optional): Seconds added to every stand-in response, or by
+                                                             service. Defaults to 0.
+        recordings_dir (str, optional): Recorded responses replayed by the stand-ins, see StandInServices.
+                                        Defaults to None (synthetic responses).
+        scales (Sequence[int], optional): Copies of the body content. Defaults to SUITE_SCALES.
+        tolerance (float, optional): Relative slowdown reported as regression. Defaults to SUITE_TOLERANCE.
+
+    Returns:
+        Dict[str, Any]: Stage timings under "stages", stand-in request counts under "requests" and the
+                        comparison with the baseline under "baseline" if given
+    """
+    from stand_ins import StandInServices
+
+    with open(BENCHMARK_TEI, "rb") as file:
+        tei = file.read()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as data, StandInServices(tei, latency, recordings_dir) as services:
+        environment = {
+            **os.environ,
+            **services.environment(),
+            "PDF_FILES": os.path.join(data, "pdf_files") + os.sep,
+            "IMAGE_FILES": os.path.join(data, "image_files") + os.sep,
+            "TOKEN": os.path.join(data, "token.txt"),
+            "PUBCHEM_CACHE": os.path.join(data, "pubchem_cache.sqlite"),
+            "MANIFEST": os.path.join(data, "manifest.sqlite"),
+            "DOCUMENT_INDEX": os.path.join(data, "document_index.sqlite"),
+            "NER_CACHE": os.path.join(data, "ner_cache.sqlite"),
+            "RATE_LIMITS": os.path.join(data, "rate_limits.sqlite"),
+        }
+        os.makedirs(environment["PDF_FILES"])
+        command = [sys.executable, os.path.abspath(__file__), "stages", "--scales", *map(str, scales)]
+        # Paths in definitions.py are relative to the repository
+        process = subprocess.run(
+            command, cwd=os.path.dirname(directory), env=environment, capture_output=True, text=True, check=True
+        )
+        results: Dict[str, Any] = {"stages": json.loads(process.stdout), "requests": services.requests()}
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+    if baseline:
+        with open(baseline) as file:
+            results["baseline"] = compare_with_baseline(results["stages"], json.load(file)["stages"], tolerance)
+    return results
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Benchmarks of the extraction.")
+    argument_parser.add_argument(
+        "benchmark",
+        nargs="?",
+        default="components",
+        choices=["components", "imports", "stages", "suite"],
+        help="components: loading, parsing and NER variants, imports: startup check, stages: stage timings "
+        "against the configured services, suite: stage timings against local stand-ins",
+    )
+    argument_parser.add_argument("--scales", type=int, nargs="+", default=SUITE_SCALES)
+    argument_parser.add_argument("--output", help="JSON file for the suite results")
+    argument_parser.add_argument("--baseline", help="JSON file of earlier suite results")
+    argument_parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to stand-in responses")
+    argument_parser.add_argument("--recordings", help="Directory of recorded stand-in responses")
+    arguments = argument_parser.parse_args()
+    if arguments.benchmark == "imports":
+        # Startup check: python benchmark.py imports
+        imports = benchmark_imports()
+        print(json.dumps(imports, indent=2))
+        sys.exit(0 if imports["passed"] else 1)
+    if arguments.benchmark == "stages":
+        print(json.dumps(benchmark_stages(scales=arguments.scales)))
+    elif arguments.benchmark == "suite":
+        suite = run_suite(
+            arguments.output, arguments.baseline, arguments.latency, arguments.recordings, arguments.scales
+        )
+        print(json.dumps(suite, indent=2))
+        sys.exit(1 if suite.get("baseline", {}).get("regressions") else 0)
+    else:
+        print(
+            json.dumps(
+                {
+                    "tei_loading": benchmark_tei_loading(),
+                    "parse": benchmark_parse(),
+                    "ner": benchmark_sharded_ner(),
+                    "ner_cache": benchmark_ner_cache(),
+                },
+                indent=2,
+            )
+        )
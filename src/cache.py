@@ -0,0 +1,331 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from definitions import (
+    PUBCHEM_CACHE,
+    PUBCHEM_CACHE_TTL,
+    PUBCHEM_CACHE_NEGATIVE_TTL,
+    PUBCHEM_CACHE_MAX_SIZE,
+    NER_CACHE,
+    NER_CACHE_MAX_SIZE,
+)
+from metrics import increment
+
+# Access times of hits are written in one transaction after this many hits or seconds, not per hit
+ACCESS_FLUSH_SIZE: int = 256
+ACCESS_FLUSH_INTERVAL: float = 5.0
+
+
+class SqliteLruCache:
+    """Persistent key/value store in a SQLite file with TTL expiry, size-bounded LRU eviction and
+       hit/miss counters. Entries are grouped by kind, values are stored as raw bytes. Lookups are
+       read-only, the access times of hits are collected and written in batches (see ACCESS_FLUSH_SIZE).
+
+    Args:
+        path (str): Path of the SQLite file, ":memory:" for a non persistent cache.
+        ttl (float, optional): Seconds until an entry expires, None for no expiry.
+        max_size (int, optional): Maximum number of value bytes kept before the least recently used
+                                  entries are evicted.
+    """
+
+    # Value of the cache label of the lookup metrics
+    metric_name: str = "sqlite"
+
+    def __init__(self, path: str, ttl: Optional[float] = None, max_size: int = PUBCHEM_CACHE_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._connection: Optional[sqlite3.Connection] = None
+        # Access times of hits not written yet by (kind, key)
+        self._accessed: Dict[Tuple[str, str], float] = {}
+        self._accessed_flushed = time.time()
+        self._size: int = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections must not be shared with forked worker processes
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (kind TEXT, key TEXT, value BLOB, expires REAL, "
+                "accessed REAL, size INTEGER, PRIMARY KEY (kind, key))"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, kind: str, key: str) -> Optional[bytes]:
+        """Get a value and mark it as recently used.
+
+        Args:
+            kind (str): Kind of the entry.
+            key (str): Key of the entry.
+
+        Returns:
+            Optional[bytes]: Stored value, None if the entry is missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value, expires FROM entries WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+            if row is None:
+                self.misses[kind] += 1
+                increment("cache_lookups_total", cache=self.metric_name, kind=kind, result="miss")
+                return None
+            value, expires = row
+            # Expired entries are removed by the next set or eviction
+            if expires is not None and expires < now:
+                self.misses[kind] += 1
+                increment("cache_lookups_total", cache=self.metric_name, kind=kind, result="miss")
+                return None
+            self._accessed[(kind, key)] = now
+            if len(self._accessed) >= ACCESS_FLUSH_SIZE or now - self._accessed_flushed >= ACCESS_FLUSH_INTERVAL:
+                self._flush_accessed()
+                self.connection.commit()
+            self.hits[kind] += 1
+            increment("cache_lookups_total", cache=self.metric_name, kind=kind, result="hit")
+            return bytes(value)
+
+    def set(self, kind: str, key: str, value: bytes, ttl: Optional[float] = None):
+        """Store a value and evict least recently used entries if the cache is too large.
+
+        Args:
+            kind (str): Kind of the entry.
+            key (str): Key of the entry.
+            value (bytes): Value to store.
+            ttl (Optional[float], optional): Seconds until the entry expires. Defaults to the cache ttl.
+        """
+        self.set_many(kind, [(key, value)], ttl)
+
+    def set_many(self, kind: str, items: Iterable[Tuple[str, bytes]], ttl: Optional[float] = None):
+        """Store several values of a kind in a single transaction, see set.
+
+        Args:
+            kind (str): Kind of the entries.
+            items (Iterable[Tuple[str, bytes]]): Keys and values to store.
+            ttl (Optional[float], optional): Seconds until the entries expire. Defaults to the cache ttl.
+        """
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            self._flush_accessed()
+            for key, value in items:
+                self._delete(kind, key)
+                self.connection.execute(
+                    "INSERT INTO entries (kind, key, value, expires, accessed, size) VALUES (?, ?, ?, ?, ?, ?)",
+                    (kind, key, sqlite3.Binary(value), expires, now, len(value)),
+                )
+                self._size += len(value)
+            if self._size > self.max_size:
+                self._evict()
+            self.connection.commit()
+
+    def _flush_accessed(self):
+        """Write the collected access times, the caller commits."""
+        if self._accessed:
+            self.connection.executemany(
+                "UPDATE entries SET accessed = ? WHERE kind = ? AND key = ?",
+                [(accessed, kind, key) for (kind, key), accessed in self._accessed.items()],
+            )
+            self._accessed.clear()
+        self._accessed_flushed = time.time()
+
+    def flush(self):
+        """Write the access times of recent hits."""
+        with self._lock:
+            self._flush_accessed()
+            self.connection.commit()
+
+    def _delete(self, kind: str, key: str):
+        row = self.connection.execute(
+            "SELECT size FROM entries WHERE kind = ? AND key = ?", (kind, key)
+        ).fetchone()
+        if row is not None:
+            self.connection.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+            self._size -= row[0]
+
+    def _evict(self):
+        """Remove expired entries, then least recently used entries until 90% of max_size is free."""
+        self.connection.execute("DELETE FROM entries WHERE expires < ?", (time.time(),))
+        self._size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        target = int(self.max_size * 0.9)
+        cursor = self.connection.execute("SELECT kind, key, size FROM entries ORDER BY accessed")
+        evicted = []
+        for kind, key, size in cursor:
+            if self._size <= target:
+                break
+            evicted.append((kind, key))
+            self._size -= size
+        self.connection.executemany("DELETE FROM entries WHERE kind = ? AND key = ?", evicted)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Hit and miss counters per kind of entry.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: {kind: {"hits": int, "misses": int, "hit_ratio": float}}
+        """
+        stats = {}
+        for kind in set(self.hits) | set(self.misses):
+            total = self.hits[kind] + self.misses[kind]
+            stats[kind] = {
+                "hits": self.hits[kind],
+                "misses": self.misses[kind],
+                "hit_ratio": self.hits[kind] / total if total else 0.0,
+            }
+        return stats
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._accessed.clear()
+            self.connection.execute("DELETE FROM entries")
+            self.connection.commit()
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._flush_accessed()
+            self.connection.commit()
+            self.connection.close()
+
+
+class PubChemCache(SqliteLruCache):
+    """Cache for PubChem lookups: name -> CID and formula -> CID resolutions (including negative
+       results), per CID properties (PROPERTIES) and synonyms. Structure images are kept in the
+       image store (see image_store.py).
+
+    Args:
+        path (str, optional): Path of the SQLite file. Defaults to PUBCHEM_CACHE.
+        ttl (float, optional): Seconds until an entry expires. Defaults to PUBCHEM_CACHE_TTL.
+        negative_ttl (float, optional): Seconds until a name without results expires.
+                                        Defaults to PUBCHEM_CACHE_NEGATIVE_TTL.
+        max_size (int, optional): Maximum cache size in bytes. Defaults to PUBCHEM_CACHE_MAX_SIZE.
+    """
+
+    metric_name = "pubchem"
+
+    def __init__(
+        self,
+        path: str = PUBCHEM_CACHE,
+        ttl: Optional[float] = PUBCHEM_CACHE_TTL,
+        negative_ttl: Optional[float] = PUBCHEM_CACHE_NEGATIVE_TTL,
+        max_size: int = PUBCHEM_CACHE_MAX_SIZE,
+    ):
+        super().__init__(path, ttl=ttl, max_size=max_size)
+        self.negative_ttl = negative_ttl
+
+    @staticmethod
+    def normalize_name(name: str) -> str:
+        """PubChem name search is case insensitive, so names are stored lower case and stripped."""
+        return " ".join(name.split()).lower()
+
+    def _get_json(self, kind: str, key: str) -> Any:
+        value = self.get(kind, key)
+        return json.loads(value) if value is not None else None
+
+    def _set_json(self, kind: str, key: str, value: Any, ttl: Optional[float] = None):
+        self.set(kind, key, json.dumps(value).encode("utf-8"), ttl=ttl)
+
+    def get_cids(self, name: str) -> Optional[List[int]]:
+        """CIDs found by a name search, an empty list if PubChem had no result and None if the name is not cached."""
+        return self._get_json("name", self.normalize_name(name))
+
+    def set_cids(self, name: str, cids: List[int]):
+        ttl = None if cids else self.negative_ttl
+        self._set_json("name", self.normalize_name(name), cids, ttl=ttl)
+
+    @staticmethod
+    def normalize_formula(formula: str) -> str:
+        """PubChem formula search is case sensitive (CO is not Co), formulas are only stripped."""
+        return " ".join(formula.split())
+
+    def get_formula_cids(self, formula: str) -> Optional[List[int]]:
+        """CIDs found by a formula search, an empty list if PubChem had no result and None if not cached."""
+        return self._get_json("formula", self.normalize_formula(formula))
+
+    def set_formula_cids(self, formula: str, cids: List[int]):
+        ttl = None if cids else self.negative_ttl
+        self._set_json("formula", self.normalize_formula(formula), cids, ttl=ttl)
+
+    def get_properties(self, cid: int) -> Optional[Dict[str, Any]]:
+        return self._get_json("properties", str(cid))
+
+    def set_properties(self, cid: int, properties: Dict[str, Any]):
+        self._set_json("properties", str(cid), properties)
+
+    def get_synonyms(self, cid: int) -> Optional[List[str]]:
+        return self._get_json("synonyms", str(cid))
+
+    def set_synonyms(self, cid: int, synonyms: List[str]):
+        self._set_json("synonyms", str(cid), synonyms)
+
+
+_default_cache: Optional[PubChemCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_pubchem_cache() -> PubChemCache:
+    """Returns the process wide PubChem cache stored at PUBCHEM_CACHE.
+
+    Returns:
+        PubChemCache: Shared cache object.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PubChemCache()
+        return _default_cache
+
+
+class NerCache(SqliteLruCache):
+    """Cache for the chemical entities extracted by CDE from single sentences. Sentences are keyed by
+       the hash of their normalized text and the version of the extraction, entries do not expire.
+
+    Args:
+        version (str): Version of CDE and its models, entries of other versions are not used.
+        path (str, optional): Path of the SQLite file. Defaults to NER_CACHE.
+        max_size (int, optional): Maximum cache size in bytes. Defaults to NER_CACHE_MAX_SIZE.
+    """
+
+    metric_name = "ner"
+
+    def __init__(self, version: str, path: str = NER_CACHE, max_size: int = NER_CACHE_MAX_SIZE):
+        super().__init__(path, ttl=None, max_size=max_size)
+        self.version = version
+
+    @staticmethod
+    def normalize_sentence(sentence: str) -> str:
+        """Sentences are compared with collapsed whitespace, the case is kept because the NER depends on it."""
+        return " ".join(sentence.split())
+
+    def sentence_key(self, sentence: str) -> str:
+        text = f"{self.version}\0{self.normalize_sentence(sentence)}"
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_sentence(self, sentence: str) -> Optional[Dict[str, Any]]:
+        """Entities of a sentence, see ner.sentence_entities, None if the sentence is not cached."""
+        value = self.get("sentence", self.sentence_key(sentence))
+        return json.loads(value) if value is not None else None
+
+    def set_sentence(self, sentence: str, entities: Dict[str, Any]):
+        self.set_sentences({sentence: entities})
+
+    def set_sentences(self, entities: Dict[str, Dict[str, Any]]):
+        """Store the entities of several sentences in a single transaction."""
+        self.set_many(
+            "sentence",
+            [(self.sentence_key(sentence), json.dumps(value).encode("utf-8")) for sentence, value in entities.items()],
+        )
@@ -0,0 +1,246 @@
+import math
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional
+from definitions import DOCUMENT_INDEX
+
+OVERLAP: str = "overlap"
+JACCARD: str = "jaccard"
+WEIGHTED_JACCARD: str = "weighted_jaccard"
+
+
+class Match(NamedTuple):
+    """Document sharing compounds with the query.
+
+    Args:
+        doc_id (str): Id of the matched document.
+        score (float): Similarity score.
+        index_pairs (List[List[int]]): Index pairs [i, j] of same entities, i in the query and j in the
+                                       matched document, as returned by compare_documents.
+    """
+
+    doc_id: str
+    score: float
+    index_pairs: List[List[int]]
+
+
+class CidIndex:
+    """Persistent inverted index from CIDs to the documents containing them. Queries only read the
+       posting lists of the CIDs of the query document and the rows of the matched documents. For the
+       weighted Jaccard score each document keeps the sum of log(1 + df) over its CIDs, which is
+       updated when a document frequency changes, so the total idf weight of a document is
+       size * (log(1 + N) + 1) - df_log_sum without reading its postings.
+
+    Args:
+        path (str, optional): Path of the SQLite file. Defaults to DOCUMENT_INDEX.
+    """
+
+    def __init__(self, path: str = DOCUMENT_INDEX):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections must not be shared with forked worker processes
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.executescript(
+                "PRAGMA journal_mode=WAL;"
+                "CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, size INTEGER);"
+                "CREATE TABLE IF NOT EXISTS postings (cid INTEGER, doc_id TEXT, position INTEGER, "
+                "PRIMARY KEY (cid, doc_id));"
+                "CREATE INDEX IF NOT EXISTS postings_doc_id ON postings (doc_id);"
+                "CREATE TABLE IF NOT EXISTS frequencies (cid INTEGER PRIMARY KEY, df INTEGER);"
+                # CIDs of the current query, joined instead of bound as parameters (at most 999 before SQLite 3.32)
+                "CREATE TEMP TABLE IF NOT EXISTS query_cids (cid INTEGER PRIMARY KEY, position INTEGER);"
+            )
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(documents)")]
+            if "df_log_sum" not in columns:
+                self._add_df_log_sums(self._connection)
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def _add_df_log_sums(connection: sqlite3.Connection):
+        """Adds the column df_log_sum to an index created without it."""
+        connection.execute("ALTER TABLE documents ADD COLUMN df_log_sum REAL DEFAULT 0")
+        sums: Dict[str, float] = defaultdict(float)
+        for doc_id, df in connection.execute("SELECT doc_id, df FROM postings JOIN frequencies USING (cid)"):
+            sums[doc_id] += math.log(1 + df)
+        connection.executemany(
+            "UPDATE documents SET df_log_sum = ? WHERE doc_id = ?", [(value, doc_id) for doc_id, value in sums.items()]
+        )
+        connection.commit()
+
+    def _update_frequencies(self, cids: List[int], change: int):
+        """Changes the document frequencies of cids by change (1 or -1) and the df_log_sum of the other
+        documents containing them."""
+        connection = self.connection
+        frequencies = dict(
+            connection.execute(
+                "SELECT cid, df FROM frequencies WHERE cid IN (SELECT cid FROM temp.query_cids)"
+            ).fetchall()
+        )
+        updates = []
+        for cid in cids:
+            df = frequencies.get(cid, 0)
+            updates.append((math.log(1 + df + change) - math.log(1 + df), cid))
+        connection.executemany(
+            "UPDATE documents SET df_log_sum = df_log_sum + ? "
+            "WHERE doc_id IN (SELECT doc_id FROM postings WHERE cid = ?)",
+            updates,
+        )
+        connection.executemany(
+            "INSERT INTO frequencies (cid, df) VALUES (?, ?) ON CONFLICT (cid) DO UPDATE SET df = df + ?",
+            [(cid, max(change, 0), change) for cid in cids],
+        )
+
+    def _set_query_cids(self, positions: Dict[int, int]):
+        connection = self.connection
+        connection.execute("DELETE FROM temp.query_cids")
+        connection.executemany("INSERT INTO temp.query_cids (cid, position) VALUES (?, ?)", positions.items())
+
+    def add_document(self, doc_id: str, cids: List[Optional[int]]):
+        """Add or replace a document.
+
+        Args:
+            doc_id (str): Document id, for example the pdf name
+            cids (List[Optional[int]]): CIDs of the chemical entities of the document in order
+        """
+        positions: Dict[int, int] = {}
+        for position, cid in enumerate(cids):
+            if cid is not None and cid not in positions:
+                positions[cid] = position
+        with self._lock:
+            connection = self.connection
+            self._remove(doc_id)
+            # The frequencies are updated before the document is added, its own df_log_sum is computed after
+            self._set_query_cids(positions)
+            self._update_frequencies(list(positions), 1)
+            df_log_sum = sum(
+                math.log(1 + df)
+                for (df,) in connection.execute(
+                    "SELECT df FROM frequencies WHERE cid IN (SELECT cid FROM temp.query_cids)"
+                )
+            )
+            connection.execute(
+                "INSERT INTO documents (doc_id, size, df_log_sum) VALUES (?, ?, ?)",
+                (doc_id, len(positions), df_log_sum),
+            )
+            connection.executemany(
+                "INSERT INTO postings (cid, doc_id, position) VALUES (?, ?, ?)",
+                [(cid, doc_id, position) for cid, position in positions.items()],
+            )
+            connection.commit()
+
+    def remove_document(self, doc_id: str):
+        """Remove a document from the index.
+
+        Args:
+            doc_id (str): Document id
+        """
+        with self._lock:
+            self._remove(doc_id)
+            self.connection.commit()
+
+    def _remove(self, doc_id: str):
+        connection = self.connection
+        positions = dict(connection.execute("SELECT cid, position FROM postings WHERE doc_id = ?", (doc_id,)))
+        connection.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+        connection.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+        if positions:
+            self._set_query_cids(positions)
+            self._update_frequencies(list(positions), -1)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def query(
+        self, cids: List[Optional[int]], k: int = 10, metric: str = OVERLAP, exclude: Optional[str] = None
+    ) -> List[Match]:
+        """Top k documents sharing the most compounds with the query.
+
+        Args:
+            cids (List[Optional[int]]): CIDs of the chemical entities of the query document in order
+            k (int, optional): Number of matches. Defaults to 10.
+            metric (str, optional): OVERLAP (number of shared CIDs), JACCARD or WEIGHTED_JACCARD
+                                    (CIDs weighted by their inverse document frequency). Defaults to OVERLAP.
+            exclude (str, optional): Document id excluded from the matches, for example the query itself.
+
+        Returns:
+            List[Match]: Matches ordered by descending score
+        """
+        positions: Dict[int, int] = {}
+        for position, cid in enumerate(cids):
+            if cid is not None and cid not in positions:
+                positions[cid] = position
+        if not positions:
+            return []
+        with self._lock:
+            connection = self.connection
+            self._set_query_cids(positions)
+            num_documents = connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            frequencies = dict(
+                connection.execute("SELECT cid, df FROM frequencies JOIN temp.query_cids USING (cid)").fetchall()
+            )
+            shared: Dict[str, List[List[int]]] = defaultdict(list)
+            sizes: Dict[str, int] = {}
+            df_log_sums: Dict[str, float] = {}
+            # Only the postings of the query CIDs and the rows of their documents are read
+            for query_position, doc_id, position, size, df_log_sum in connection.execute(
+                "SELECT query_cids.position, postings.doc_id, postings.position, documents.size, "
+                "documents.df_log_sum FROM temp.query_cids JOIN postings USING (cid) JOIN documents USING (doc_id)"
+            ):
+                if doc_id != exclude:
+                    shared[doc_id].append([query_position, position])
+                    sizes[doc_id] = size
+                    df_log_sums[doc_id] = df_log_sum
+            connection.execute("DELETE FROM temp.query_cids")
+            connection.commit()
+
+        position_cids = {position: cid for cid, position in positions.items()}
+        query_weight = sum(_idf(num_documents, frequencies.get(cid, 0)) for cid in positions)
+        matches: List[Match] = []
+        for doc_id, index_pairs in shared.items():
+            index_pairs.sort()
+            if metric == OVERLAP:
+                score = float(len(index_pairs))
+            elif metric == JACCARD:
+                score = len(index_pairs) / (len(positions) + sizes[doc_id] - len(index_pairs))
+            elif metric == WEIGHTED_JACCARD:
+                shared_weight = sum(_idf(num_documents, frequencies[position_cids[i]]) for i, _ in index_pairs)
+                document_weight = sizes[doc_id] * (math.log(1 + num_documents) + 1) - df_log_sums[doc_id]
+                union_weight = query_weight + document_weight - shared_weight
+                score = shared_weight / union_weight if union_weight > 0 else 0.0
+            else:
+                raise ValueError(f"Unknown metric {metric}.")
+            matches.append(Match(doc_id, score, index_pairs))
+        matches.sort(key=lambda match: (-match.score, match.doc_id))
+        return matches[:k]
+
+
+def _idf(num_documents: int, df: int) -> float:
+    """Smoothed inverse document frequency, positive for CIDs contained in every document."""
+    return math.log((1 + num_documents) / (1 + df)) + 1
+
+
+_default_index: Optional[CidIndex] = None
+_default_index_lock = threading.Lock()
+
+
+def get_cid_index() -> CidIndex:
+    """Returns the process wide CID index stored at DOCUMENT_INDEX.
+
+    Returns:
+        CidIndex: Shared index object.
+    """
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = CidIndex()
+        return _default_index
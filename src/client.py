@@ -0,0 +1,69 @@
+import time
+import requests as r
+from typing import Any, List, Optional
+from definitions import SERVICE_URL
+
+
+class ExtractionClient:
+    """Client of the extraction service (see server.py), replaces direct calls of process_pdf and
+       compare_documents. Structure images are returned as {"cid": int, "digest": Optional[str]}.
+
+    Args:
+        url (str, optional): Base URL of the service. Defaults to SERVICE_URL.
+        timeout (float, optional): Seconds to wait for a response, None to wait until the document is
+                                   processed. Defaults to None.
+    """
+
+    def __init__(self, url: str = SERVICE_URL, timeout: Optional[float] = None):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = r.Session()
+
+    def _post(self, endpoint: str, **body) -> Any:
+        response = self.session.post(f"{self.url}/{endpoint}", json=body, timeout=self.timeout)
+        if not response.ok:
+            raise r.HTTPError(f"{response.status_code}: {response.text}", response=response)
+        return response.json()
+
+    def process_pdf(self, pdf_name: str, eager_images: bool = False) -> List[List[Any]]:
+        """Chemical entities of a pdf file in PDF_FILES folder, see main.process_pdf."""
+        return self._post("process_pdf", pdf_name=pdf_name, eager_images=eager_images)
+
+    def compare_documents(self, source_pdf: str, recommendation_pdf: str) -> List[List[Any]]:
+        """Chemical entities of both pdf files and index pairs of same entities, see main.compare_documents."""
+        return self._post("compare_documents", source_pdf=source_pdf, recommendation_pdf=recommendation_pdf)
+
+    def health(self) -> bool:
+        try:
+            return self.session.get(f"{self.url}/health", timeout=5).ok
+        except r.exceptions.RequestException:
+            return False
+
+    def ready(self) -> bool:
+        try:
+            return self.session.get(f"{self.url}/ready", timeout=5).ok
+        except r.exceptions.RequestException:
+            return False
+
+    def wait_until_ready(self, timeout: float = 120, interval: float = 0.5) -> bool:
+        """Polls /ready until the service has loaded its models.
+
+        Args:
+            timeout (float, optional): Seconds to wait. Defaults to 120.
+            interval (float, optional): Seconds between polls. Defaults to 0.5.
+
+        Returns:
+            bool: True if the service is ready
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.ready():
+                return True
+            time.sleep(interval)
+        return False
+
+
+if __name__ == "__main__":
+    client = ExtractionClient()
+    if client.wait_until_ready():
+        print(client.compare_documents("acssuschemeng.7b03870.pdf", "acssuschemeng.7b03870.pdf")[2])
@@ -1,11 +1,49 @@
-HYPLAG_BACKEND: str = "https://hyplag.w.ckurs.de:443"
+import os
+
+# Service URLs and data paths read with _env can be overridden by the environment variable of the same
+# name, for example to run against the local stand-in services of the benchmark suite (see stand_ins.py)
+
+
+def _env(name: str, default: str) -> str:
+    return os.environ.get(name, default)
+
+
+HYPLAG_BACKEND: str = _env("HYPLAG_BACKEND", "https://hyplag.w.ckurs.de:443")
 HYPLAG_BACKEND_AUTH_TOKEN: str = HYPLAG_BACKEND + "/token/create"
 HYPLAG_BACKEND_POST_DOCUMENT: str = HYPLAG_BACKEND + "/indexing"
 HYPLAG_BACKEND_GET_DOCUMENT: str = HYPLAG_BACKEND + "/document/"
 HYPLAG_USER: str = "hiwi"
 HYPLAG_PASSWORD: str = "vBAXHwny"
 HYPLAG_ID: str = "regviz_chemistry"
-PDF_FILES: str = "src/pdf_files/"
+PDF_FILES: str = _env("PDF_FILES", "src/pdf_files/")
 XML_FILES: str = "src/xml_files/"
 HTML_FILES: str = "src/html_files/"
-TOKEN: str = "src/token.txt"
+IMAGE_FILES: str = _env("IMAGE_FILES", "src/image_files/")
+IMAGE_FILES_TTL: float = 30 * 24 * 60 * 60
+IMAGE_FILES_MAX_SIZE: int = 256 * 1024 * 1024
+TOKEN: str = _env("TOKEN", "src/token.txt")
+PUBCHEM_API_BASE: str = _env("PUBCHEM_API_BASE", "https://pubchem.ncbi.nlm.nih.gov/rest/pug")
+# Grobid server as http://host:port, empty to read it from grobid_config.json
+GROBID_URL: str = _env("GROBID_URL", "")
+PUBCHEM_CACHE: str = _env("PUBCHEM_CACHE", "src/pubchem_cache.sqlite")
+PUBCHEM_CACHE_TTL: float = 30 * 24 * 60 * 60
+PUBCHEM_CACHE_NEGATIVE_TTL: float = 7 * 24 * 60 * 60
+PUBCHEM_CACHE_MAX_SIZE: int = 512 * 1024 * 1024
+MANIFEST: str = _env("MANIFEST", "src/manifest.sqlite")
+# Increase when a change alters stored artifacts, so that documents are processed again
+PIPELINE_VERSION: str = "1"
+DOCUMENT_INDEX: str = _env("DOCUMENT_INDEX", "src/document_index.sqlite")
+NER_CACHE: str = _env("NER_CACHE", "src/ner_cache.sqlite")
+NER_CACHE_MAX_SIZE: int = 256 * 1024 * 1024
+# Offline name -> CID index built from PubChem bulk files with name_index.py, not used if missing
+NAME_INDEX: str = _env("NAME_INDEX", "src/name_index.bin")
+# Token buckets of the rate limits shared by all processes (see throttle.SharedTokenBucket)
+RATE_LIMITS: str = _env("RATE_LIMITS", "src/rate_limits.sqlite")
+SERVICE_HOST: str = "127.0.0.1"
+SERVICE_PORT: int = 8765
+SERVICE_URL: str = f"http://{SERVICE_HOST}:{SERVICE_PORT}"
+# Non-empty to record metrics (see metrics.py), exported periodically and at exit to the files which are set
+METRICS: str = _env("METRICS", "")
+METRICS_JSONL: str = _env("METRICS_JSONL", "")
+METRICS_PROMETHEUS: str = _env("METRICS_PROMETHEUS", "")
+METRICS_EXPORT_INTERVAL: float = float(_env("METRICS_EXPORT_INTERVAL", "60"))
@@ -0,0 +1,240 @@
+import re
+import numpy as np
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Optional, Sequence, Tuple
+from periodic_table import ATOMIC_WEIGHTS, ELEMENTS, ELEMENT_INDEX
+
+# Longest text parsed as a formula, longer entities are names
+FORMULA_MAX_LENGTH: int = 100
+ATOMIC_WEIGHT_ARRAY: np.ndarray = np.array(ATOMIC_WEIGHTS, dtype=np.float64)
+# Symbol, count, opening or closing bracket
+_TOKEN = re.compile(r"([A-Z][a-z]?)(\d*)|([(\[{])|([)\]}])(\d*)")
+# Separators of the parts of hydrates and adducts, e.g. CuSO4·5H2O
+_PART_SEPARATOR = re.compile(r"\s*[·•∙*.]\s*(?=\d|[A-Z(\[{])")
+# Trailing charge: ^2-, ^+, PubChem style -2, +3, only signs, or 3- after the bracket of a complex ion
+# like [Fe(CN)6]3-. Elsewhere a single digit before a sign is a count, e.g. NH4+ or NO3-.
+_CHARGE = re.compile(r"(?:\^(\d*)([+-])|(?<=\])(\d+)([+-])|([+-])(\d*)|([+-]+))$")
+# Metals, whose monatomic cations with a charge of 2 to 4 are written with the charge after the symbol,
+# e.g. Ca2+, Fe3+ or Ce4+. Elsewhere a single digit before the sign is a count: H2+ is the dihydrogen
+# cation and Na2+ a sodium dimer.
+# fmt: off
+_ION_METALS: Tuple[str, ...] = (
+    "Be", "Mg", "Ca", "Sr", "Ba", "Ra", "Al", "Ga", "In", "Tl", "Ge", "Sn", "Pb", "Bi",
+    "Sc", "Ti", "V", "Cr", "Mn", "Fe", "Co", "Ni", "Cu", "Zn", "Y", "Zr", "Nb", "Mo", "Ru", "Rh", "Pd", "Ag",
+    "Cd", "Hf", "Ta", "W", "Re", "Os", "Ir", "Pt", "Au", "Hg",
+    "La", "Ce", "Pr", "Nd", "Pm", "Sm", "Eu", "Gd", "Tb", "Dy", "Ho", "Er", "Tm", "Yb", "Lu", "Th", "U", "Pu",
+)
+# fmt: on
+_MONATOMIC_ION = re.compile(r"(%s)([2-4])\+" % "|".join(_ION_METALS))
+# Several digits before a trailing sign, count and charge can not be told apart, e.g. SO42- or CO32-
+_AMBIGUOUS_CHARGE = re.compile(r"(?<=[A-Za-z)])\d{2,}[+-]$")
+_CLOSING = {"(": ")", "[": "]", "{": "}"}
+# Hints that a text is a formula rather than an abbreviation like CO or PVP, see looks_like_formula
+_FORMULA_HINT = re.compile(r"[a-z\d()\[\]{}·•∙*^+-]")
+# Plural of an abbreviation in capitals, e.g. BOCs or COs, which would be read as caesium or osmium
+_PLURAL = re.compile(r"[A-Z]{2}s\s*$")
+# Elements from americium (Z = 95) on are only made in laboratories, their symbols in a text are rather
+# parts of abbreviations, e.g. Ts in CNTs (carbon nanotubes) or No
+_SYNTHETIC_ELEMENTS: FrozenSet[str] = frozenset(ELEMENTS[ELEMENT_INDEX["Am"] :])
+
+
+class Formula(NamedTuple):
+    """Parsed molecular formula.
+
+    Args:
+        counts (Dict[str, int]): Number of atoms by element symbol
+        charge (int): Net charge
+    """
+
+    counts: Dict[str, int]
+    charge: int
+
+
+def _split_charge(text: str) -> Optional[Tuple[str, int]]:
+    """Formula without its trailing charge and the charge, None if the charge is ambiguous."""
+    ion = _MONATOMIC_ION.fullmatch(text)
+    if ion is not None:
+        return ion.group(1), int(ion.group(2))
+    if _AMBIGUOUS_CHARGE.search(text):
+        return None
+    match = _CHARGE.search(text)
+    if match is None:
+        return text, 0
+    if match.group(2):
+        magnitude, sign = int(match.group(1) or 1), match.group(2)
+    elif match.group(4):
+        magnitude, sign = int(match.group(3)), match.group(4)
+    elif match.group(5):
+        magnitude, sign = int(match.group(6) or 1), match.group(5)
+    else:
+        magnitude, sign = len(match.group(7)), match.group(7)[0]
+    return text[: match.start()], magnitude if sign == "+" else -magnitude
+
+
+def _parse_part(part: str) -> Optional[Dict[str, int]]:
+    multiplier = re.match(r"\d*", part).group()
+    position = len(multiplier)
+    # Stack of (counts, opening bracket) of the enclosing groups
+    stack: List[Tuple[Dict[str, int], str]] = [({}, "")]
+    while position < len(part):
+        token = _TOKEN.match(part, position)
+        if token is None:
+            return None
+        position = token.end()
+        symbol, count, opening, closing, group_count = token.groups()
+        if symbol:
+            if symbol not in ELEMENT_INDEX:
+                return None
+            counts = stack[-1][0]
+            counts[symbol] = counts.get(symbol, 0) + int(count or 1)
+        elif opening:
+            stack.append(({}, opening))
+        else:
+            counts, bracket = stack.pop()
+            if not bracket or _CLOSING[bracket] != closing or not counts:
+                return None
+            for element, element_count in counts.items():
+                stack[-1][0][element] = stack[-1][0].get(element, 0) + element_count * int(group_count or 1)
+    if len(stack) != 1 or not stack[0][0]:
+        return None
+    return {element: count * int(multiplier or 1) for element, count in stack[0][0].items()}
+
+
+def parse_formula(text: str) -> Optional[Formula]:
+    """Parses a molecular formula with brackets, hydrates or adducts and a trailing charge, e.g.
+       "Ca(OH)2", "[Fe(CN)6]3-", "CuSO4·5H2O", "SO4^2-", "O4S-2" or "Ca2+". A digit before the sign of a
+       monatomic metal cation (see _ION_METALS) is its charge, a single digit before the sign of other
+       formulas is a count (NH4+, H2+). Several digits (SO42-) are ambiguous, such texts are not parsed.
+
+    Args:
+        text (str): Formula
+
+    Returns:
+        Optional[Formula]: Atom counts and charge, None if the text is not a formula of known elements
+                           or its charge is ambiguous
+    """
+    text = "".join(text.split())
+    if not text or len(text) > FORMULA_MAX_LENGTH:
+        return None
+    split = _split_charge(text)
+    if split is None:
+        return None
+    text, charge = split
+    counts: Dict[str, int] = {}
+    for part in _PART_SEPARATOR.split(text):
+        part_counts = _parse_part(part)
+        if part_counts is None:
+            return None
+        for element, count in part_counts.items():
+            counts[element] = counts.get(element, 0) + count
+    counts = {element: count for element, count in counts.items() if count}
+    if not counts:
+        return None
+    return Formula(counts, charge)
+
+
+def looks_like_formula(text: str) -> bool:
+    """Whether a chemical entity is a formula which can be resolved locally. Formulas of single letter
+       symbols only (CO, NO, PVP), their plurals (BOCs) and formulas of synthetic elements (CNTs) are
+       also common abbreviations of names and are not taken as formulas.
+
+    Args:
+        text (str): Chemical entity
+
+    Returns:
+        bool: The text is a formula with a count, bracket, charge, hydrate or two letter symbol
+    """
+    if not _FORMULA_HINT.search(text) or _PLURAL.search(text):
+        return False
+    formula = parse_formula(text)
+    return formula is not None and _SYNTHETIC_ELEMENTS.isdisjoint(formula.counts)
+
+
+def hill_order(symbols: Sequence[str]) -> List[str]:
+    """Element symbols in Hill order: C, H and the others alphabetically, all alphabetically without C."""
+    if "C" not in symbols:
+        return sorted(symbols)
+    return ["C"] + (["H"] if "H" in symbols else []) + sorted(set(symbols) - {"C", "H"})
+
+
+def hill_formula(formula: Formula) -> str:
+    """Formula in Hill notation with the charge in PubChem style, e.g. "CuH10O9S" or "O4S-2".
+
+    Args:
+        formula (Formula): Parsed formula
+
+    Returns:
+        str: Normalized formula
+    """
+    counts, charge = formula
+    text = "".join(f"{symbol}{counts[symbol] if counts[symbol] != 1 else ''}" for symbol in hill_order(counts))
+    if charge:
+        text += ("+" if charge > 0 else "-") + (str(abs(charge)) if abs(charge) != 1 else "")
+    return text
+
+
+def normalize_formula(text: str) -> Optional[str]:
+    """Formula in Hill notation, see hill_formula. None if the text is not a formula."""
+    formula = parse_formula(text)
+    return hill_formula(formula) if formula is not None else None
+
+
+def formula_matrix(formulas: Sequence[Optional[Formula]]) -> np.ndarray:
+    """Atom counts of many formulas as matrix with a column per element of ELEMENTS.
+
+    Args:
+        formulas (Sequence[Optional[Formula]]): Parsed formulas, None gives a row of zeros
+
+    Returns:
+        np.ndarray: int64 matrix of shape (len(formulas), len(ELEMENTS))
+    """
+    rows, columns, values = [], [], []
+    for row, formula in enumerate(formulas):
+        if formula is None:
+            continue
+        for symbol, count in formula.counts.items():
+            rows.append(row)
+            columns.append(ELEMENT_INDEX[symbol])
+            values.append(count)
+    matrix = np.zeros((len(formulas), len(ELEMENTS)), dtype=np.int64)
+    matrix[rows, columns] = values
+    return matrix
+
+
+def molecular_weights(matrix: np.ndarray) -> np.ndarray:
+    """Molecular weights in g/mol of the rows of a formula_matrix, rounded like PubChem to 3 decimals."""
+    return np.round(matrix @ ATOMIC_WEIGHT_ARRAY, 3)
+
+
+def formula_properties(texts: Sequence[str]) -> List[Optional[Dict[str, Any]]]:
+    """Properties of pubchem.PROPERTIES computed locally from formulas, without a CID and IUPAC name.
+       All formulas of a document are handled at once, the weights as one matrix product.
+
+    Args:
+        texts (Sequence[str]): Formulas
+
+    Returns:
+        List[Optional[Dict[str, Any]]]: {"iupac_name": None, "cid": None, "elements", "molecular_weight",
+                                         "molecular_formula"} per formula, None if the text is not a formula
+    """
+    formulas = [parse_formula(text) for text in texts]
+    weights = molecular_weights(formula_matrix(formulas))
+    properties: List[Optional[Dict[str, Any]]] = []
+    for formula, weight in zip(formulas, weights.tolist()):
+        if formula is None:
+            properties.append(None)
+            continue
+        properties.append(
+            {
+                "iupac_name": None,
+                "cid": None,
+                "elements": hill_order(formula.counts),
+                "molecular_weight": weight,
+                "molecular_formula": hill_formula(formula),
+            }
+        )
+    return properties
+
+
+if __name__ == "__main__":
+    for properties in formula_properties(["H2O", "CuSO4·5H2O", "[Fe(CN)6]^3-", "CH3COOH", "Ca(OH)2", "water"]):
+        print(properties)
@@ -1,119 +1,414 @@
 import os
+import json
 import requests
-from typing import Dict, List, Tuple
+from typing import IO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 from pathlib import Path
 from definitions import (TOKEN, HYPLAG_USER, HYPLAG_PASSWORD, HYPLAG_BACKEND_AUTH_TOKEN, HYPLAG_ID, 
                         HYPLAG_BACKEND_POST_DOCUMENT, HYPLAG_BACKEND_GET_DOCUMENT, XML_FILES, 
-                        PDF_FILES)
+                        PDF_FILES, GROBID_URL)
+from metrics import observe, record_response, set_gauge, timer
+from throttle import MemoryBudget, backoff_delay
 from glob import glob
 from datetime import datetime, timedelta
-from grobid_client.grobid_client import GrobidClient
+import collections
 import concurrent.futures
+import heapq
+import itertools
+import logging
+import threading
+import time
+import uuid
+from requests.adapters import HTTPAdapter
+
+GROBID_CONFIG: str = "./grobid_config.json"
+GROBID_FULLTEXT_SERVICE: str = "processFulltextDocument"
+# Upper bound of concurrent Grobid requests, the engine adapts below it to the busy responses of the server
+GROBID_CONCURRENCY: int = 10
+GROBID_RETRIES: int = 5
+# Single thread writing xml files in the background, see save_xml_doc_async
+_xml_writer: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_xml_writer_lock = threading.Lock()
+# Tokens issued by the backend are valid for two hours, they are replaced ten minutes before
+HYPLAG_TOKEN_LIFETIME: timedelta = timedelta(hours=2)
+HYPLAG_TOKEN_REFRESH_MARGIN: timedelta = timedelta(minutes=10)
+# Connections kept alive to the backend, one per thread of post_documents_from_list/get_documents_from_list
+HYPLAG_POOL_SIZE: int = 10
+# Statuses of TEI requests for documents which are still processed, unknown documents (404) fail
+HYPLAG_NOT_READY_STATUSES: Tuple[int, ...] = (202, 204)
+# Seconds before the first poll of a posted document, doubled with every poll up to the maximum
+HYPLAG_POLL_DELAY: float = 1
+HYPLAG_POLL_MAX_DELAY: float = 30
+HYPLAG_POLL_TIMEOUT: float = 600
+# Uploads stream pdf files in chunks, all uploads of the process together buffer at most the budget
+HYPLAG_UPLOAD_CHUNK_SIZE: int = 64 * 1024
+HYPLAG_UPLOAD_BUDGET = MemoryBudget(4 * 1024 * 1024)
+HYPLAG_UPLOAD_RETRIES: int = 3
+
+
+class TokenManager:
+    """Thread-safe cache of the Hyplag JWT in memory and in the token file. The token is requested again
+       refresh_margin before it expires, so that requests in flight never use an expired token. The token
+       file holds the UTC time the token was issued and the token on two lines.
+
+    Args:
+        path (str, optional): Token file. Defaults to TOKEN.
+        lifetime (timedelta, optional): Validity of a token. Defaults to HYPLAG_TOKEN_LIFETIME.
+        refresh_margin (timedelta, optional): Time before expiry the token is replaced.
+                                              Defaults to HYPLAG_TOKEN_REFRESH_MARGIN.
+        session (requests.Session, optional): Session for the token requests. Defaults to the shared
+                                              Hyplag session.
+    """
+
+    def __init__(
+        self,
+        path: str = TOKEN,
+        lifetime: timedelta = HYPLAG_TOKEN_LIFETIME,
+        refresh_margin: timedelta = HYPLAG_TOKEN_REFRESH_MARGIN,
+        session: Optional[requests.Session] = None,
+    ):
+        self.path = path
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self.session = session
+        self._token: Optional[str] = None
+        self._issued: Optional[datetime] = None
+        self._lock = threading.Lock()
+
+    def _fresh(self, issued: Optional[datetime]) -> bool:
+        return issued is not None and datetime.utcnow() < issued + self.lifetime - self.refresh_margin
+
+    def _read(self) -> Tuple[Optional[str], Optional[datetime]]:
+        try:
+            with open(self.path) as file:
+                issued, token = file.readline().strip(), file.readline().strip()
+            return token or None, datetime.fromisoformat(issued)
+        except (OSError, ValueError):
+            return None, None
+
+    def _write(self, token: str, issued: datetime):
+        # Written atomically, other processes read either the old or the new token
+        temporary = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "w") as file:
+            file.writelines([str(issued) + "\n", token])
+        os.replace(temporary, self.path)
+
+    def token(self) -> str:
+        """Returns the cached token, the token of the token file or a new token, whichever is fresh first.
+
+        Returns:
+            str: JWT authentication
+        """
+        with self._lock:
+            if self._token and self._fresh(self._issued):
+                return self._token
+            token, issued = self._read()
+            if not token or not self._fresh(issued):
+                token, issued_time = get_auth_token(session=self.session)
+                issued = datetime.fromisoformat(issued_time)
+                self._write(token, issued)
+            self._token, self._issued = token, issued
+            return token
+
+    def invalidate(self, token: Optional[str] = None):
+        """Forgets the token, e.g. after the backend rejected it. The next call of token requests a new one.
+
+        Args:
+            token (str, optional): Rejected token. If given, the token is only forgotten if it is still the
+                                   current one, so that requests rejected at the same time renew it once.
+        """
+        with self._lock:
+            if token is not None and token != (self._token or self._read()[0]):
+                return
+            self._token = self._issued = None
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+_default_token_manager: Optional[TokenManager] = None
+_default_session: Optional[requests.Session] = None
+_default_session_pool_size: int = 0
+_default_lock = threading.Lock()
+
+
+def get_token_manager() -> TokenManager:
+    """Returns the process wide token manager of the token file TOKEN.
+
+    Returns:
+        TokenManager: Shared token manager.
+    """
+    global _default_token_manager
+    with _default_lock:
+        if _default_token_manager is None:
+            _default_token_manager = TokenManager()
+        return _default_token_manager
+
+
+def get_hyplag_session(pool_size: int = HYPLAG_POOL_SIZE) -> requests.Session:
+    """Returns the keep-alive session shared by all requests to the Hyplag backend. The connection pool
+       holds at least pool_size connections, it is enlarged if a caller uses more threads.
+
+    Args:
+        pool_size (int, optional): Number of threads sending requests. Defaults to HYPLAG_POOL_SIZE.
+
+    Returns:
+        requests.Session: Shared session.
+    """
+    global _default_session, _default_session_pool_size
+    with _default_lock:
+        if _default_session is None:
+            _default_session = requests.Session()
+        if pool_size > _default_session_pool_size:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            _default_session.mount("http://", adapter)
+            _default_session.mount("https://", adapter)
+            _default_session_pool_size = pool_size
+        return _default_session
 
 
 def get_current_token() -> str:
     """Return JWT (Java Web Token) for authentication if avaiable and valid, else requests one from
-       the Hyplag backend.
+       the Hyplag backend. Thread-safe, see TokenManager.
 
     Returns:
         str: JWT authentication
     """
-    if os.path.exists(TOKEN):
-        with open(TOKEN, "w+") as file:
-            token_time: str = file.readline()[:-1]
-            if token_time:
-                token_time = datetime.strptime(token_time, "%Y-%m-%d %H:%M:%S.%f")
-                old_token: str = file.readline()
-                current_time = datetime.utcnow()
-                time_diff = current_time - token_time
-                if time_diff < timedelta(hours=2):
-                    token = old_token
-                else:
-                    token, token_time = get_auth_token()
-            else:
-                token, token_time = get_auth_token()
-            file.writelines([str(token_time) + "\n", token])
-    else:
-        with open(TOKEN, "x") as file:
-            token, token_time = get_auth_token()
-            file.writelines([str(token_time) + "\n", token])
-    return token
+    return get_token_manager().token()
 
 
 def get_auth_token(
-    username: str = HYPLAG_USER, password: str = HYPLAG_PASSWORD
+    username: str = HYPLAG_USER, password: str = HYPLAG_PASSWORD, session: Optional[requests.Session] = None
 ) -> Tuple[str, str]:
     """ HTTP GET request for requesting a JWT.
 
     Args:
         username (str, optional): Hyplag username. Defaults to HYPLAG_USER.
         password (str, optional): Hyplag password. Defaults to HYPLAG_PASSWORD.
+        session (requests.Session, optional): Session for the request. Defaults to the shared Hyplag session.
 
     Returns:
         Tuple[str, str]: (JWT, utc time)
     """
+    session = session or get_hyplag_session()
     token_time = str(datetime.utcnow())
     headers: Dict[str, str] = {"Content-Type": "application/json", "Accept": "application/json"}
     payload: str = f'{{"name": "{username}",                        "password": "{password}"}}'
-    response = requests.post(url=HYPLAG_BACKEND_AUTH_TOKEN, data=payload, headers=headers)
+    response = record_response("hyplag", session.post(url=HYPLAG_BACKEND_AUTH_TOKEN, data=payload, headers=headers))
     return response.json()["token"], token_time
 
 
-def post_document(path_to_document: Path, token: str, external_id: str = HYPLAG_ID) -> int:
-    """Post document to the Hyplag backend.
+class MultipartFileBody:
+    """multipart/form-data body of form fields and one file, which is streamed from disk in chunks of
+       chunk_size bytes instead of being loaded into memory. The length of the body is known in advance,
+       so requests sends it with Content-Length. The file is opened on enter and closed on exit; while
+       open, the body holds chunk_size bytes of the memory budget.
+
+    Args:
+        fields (Dict[str, str]): Form fields sent before the file.
+        file_field (str): Form field of the file.
+        path (Union[str, Path]): Path of the file.
+        content_type (str, optional): Content type of the file. Defaults to "application/pdf".
+        chunk_size (int, optional): Bytes per read from disk. Defaults to HYPLAG_UPLOAD_CHUNK_SIZE.
+        budget (MemoryBudget, optional): Budget shared by concurrent uploads. Defaults to no budget.
+    """
+
+    def __init__(
+        self,
+        fields: Dict[str, str],
+        file_field: str,
+        path: Union[str, Path],
+        content_type: str = "application/pdf",
+        chunk_size: int = HYPLAG_UPLOAD_CHUNK_SIZE,
+        budget: Optional[MemoryBudget] = None,
+    ):
+        self.path = Path(path)
+        self.chunk_size = chunk_size
+        self.budget = budget
+        self.boundary = uuid.uuid4().hex
+        parts = [
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{_quote(name)}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        ]
+        parts.append(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{_quote(file_field)}"; '
+            f'filename="{_quote(self.path.name)}"\r\nContent-Type: {content_type}\r\n\r\n'
+        )
+        self._head = "".join(parts).encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("ascii")
+        self._file_size = os.path.getsize(self.path)
+        self._file: Optional[IO[bytes]] = None
+        self._position = 0
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def __enter__(self) -> "MultipartFileBody":
+        if self.budget is not None:
+            self.budget.acquire(self.chunk_size)
+        try:
+            self._file = open(self.path, "rb")
+        except OSError:
+            if self.budget is not None:
+                self.budget.release(self.chunk_size)
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if self.budget is not None:
+                self.budget.release(self.chunk_size)
+
+    def rewind(self):
+        """Restarts the body for a retry, the file is read again from disk."""
+        self._file.seek(0)
+        self._position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        """Next bytes of the body, at most chunk_size."""
+        size = self.chunk_size if size is None or size < 0 else min(size, self.chunk_size)
+        head, file_end = len(self._head), len(self._head) + self._file_size
+        if self._position < head:
+            data = self._head[self._position : self._position + size]
+        elif self._position < file_end:
+            data = self._file.read(min(size, file_end - self._position))
+            if not data:
+                raise IOError(f"{self.path} changed during the upload.")
+        else:
+            data = self._tail[self._position - file_end : self._position - file_end + size]
+        self._position += len(data)
+        return data
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in iter(lambda: self.read(self.chunk_size), b""):
+            yield chunk
+
+
+def _send_authorized(send: Callable[[str], requests.Response], token: str) -> Tuple[requests.Response, str]:
+    """Sends a request with the token. If the backend rejects the token (401), it is invalidated and the
+       request is sent once more with a new token of the shared token manager.
+
+    Args:
+        send (Callable[[str], requests.Response]): Sends the request with the given token
+        token (str): JWT
+
+    Returns:
+        Tuple[requests.Response, str]: Response and the token it was sent with
+    """
+    response = send(token)
+    if response.status_code == 401:
+        logging.info("Hyplag backend rejected the token, requesting a new one.")
+        manager = get_token_manager()
+        manager.invalidate(token)
+        token = manager.token()
+        response = send(token)
+    return response, token
+
+
+def _quote(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\r", " ").replace("\n", " ")
+
+
+def post_document(
+    path_to_document: Path,
+    token: str,
+    external_id: str = HYPLAG_ID,
+    session: Optional[requests.Session] = None,
+    retries: int = HYPLAG_UPLOAD_RETRIES,
+) -> int:
+    """Post document to the Hyplag backend. The pdf file is streamed from disk within the memory budget
+       HYPLAG_UPLOAD_BUDGET shared by all uploads of the process. Uploads which fail with a connection
+       error or a server error are sent again from the start of the file, the backend has no resumable
+       uploads. A rejected token is replaced once, see _send_authorized.
 
     Args:
         path_to_document (Path): Path to pdf document.
         token (str): JWT.
         external_id (str, optional): ID for Hyplag. Defaults to HYPLAG_ID.
+        session (requests.Session, optional): Session for the request. Defaults to the shared Hyplag session.
+        retries (int, optional): Number of retries. Defaults to HYPLAG_UPLOAD_RETRIES.
+
+    Raises:
+        requests.exceptions.RequestException: The upload failed on the last retry.
 
     Returns:
         int: Document id.
     """
-    headers: Dict = {"Authorization": f"Bearer {token}"}
-    files = {
-        "external_id": (None, f"{external_id}"),
-        "multipartFile": (path_to_document.name, open(path_to_document, "rb")),
-    }
-    response = requests.post(url=HYPLAG_BACKEND_POST_DOCUMENT, headers=headers, files=files)
+    session = session or get_hyplag_session()
+    body = MultipartFileBody(
+        {"external_id": external_id}, "multipartFile", path_to_document, budget=HYPLAG_UPLOAD_BUDGET
+    )
+
+    def send(token: str) -> requests.Response:
+        body.rewind()
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": body.content_type}
+        return record_response("hyplag", session.post(url=HYPLAG_BACKEND_POST_DOCUMENT, headers=headers, data=body))
+
+    with body:
+        for attempt in range(retries + 1):
+            try:
+                response, token = _send_authorized(send, token)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == retries:
+                    raise
+            else:
+                if response.status_code < 500 or attempt == retries:
+                    break
+            time.sleep(backoff_delay(attempt, 0.5, 30))
+    response.raise_for_status()
     return response.json()
 
 
 def post_documents_from_list(
-    list_of_documents: List[Path], token: str, external_id: str = HYPLAG_ID, num_threads: int = 10
+    list_of_documents: List[Path], token: Optional[str] = None, external_id: str = HYPLAG_ID, num_threads: int = 10
 ) -> List[int]:
-    """Posts documents from list of file pathes to the Hyplag backend.
+    """Posts documents from list of file pathes to the Hyplag backend. The threads share the keep-alive
+       Hyplag session.
 
     Args:
         list_of_documents (List[Path]): List of pathes to pdf document.
-        token (str): JWT.
+        token (str, optional): JWT. Defaults to the token of the shared token manager, which is refreshed
+                               during long uploads.
         external_id (str, optional): ID for Hyplag. Defaults to HYPLAG_ID.
         num_threads (int, optional): Number of threads to use. Defaults to 10.
 
     Returns:
-        List[int]: List of document ids.
+        List[int]: List of document ids in the order of list_of_documents.
     """
+    session = get_hyplag_session(num_threads)
     document_id_list = []
     with concurrent.futures.ThreadPoolExecutor(
         max_workers=min(num_threads, len(list_of_documents))
     ) as executor:
         doc_ids = [
-            executor.submit(post_document, str(path), token, external_id)
+            executor.submit(
+                lambda path: post_document(Path(path), token or get_current_token(), external_id, session), path
+            )
             for path in list_of_documents
         ]
-        for doc_id in concurrent.futures.as_completed(doc_ids):
+        # Ids in the order of list_of_documents
+        for doc_id in doc_ids:
             document_id_list.append(doc_id.result())
     return document_id_list
 
 
 def post_documents_from_folder(
-    folder: Path, token: str, external_id: str = HYPLAG_ID
+    folder: Path, token: Optional[str] = None, external_id: str = HYPLAG_ID
 ) -> List[int]:
     """Post documents from folder to the Hyplag backend.
 
     Args:
         folder (Path): Path to folder with pdf documents.
-        token (str): JWT.
+        token (str, optional): JWT. Defaults to the token of the shared token manager.
         external_id (str, optional): ID for Hyplag. Defaults to HYPLAG_ID.
 
     Returns:
@@ -124,72 +419,528 @@ def post_documents_from_folder(
     return document_id_list
 
 
-def get_document(document_id: int, token: str) -> str:
-    """Get xml document of the given id from Hyplag backend.
+def get_document(document_id: int, token: str, session: Optional[requests.Session] = None) -> bytes:
+    """Get xml document of the given id from Hyplag backend. A rejected token is replaced once, see
+       _send_authorized.
 
     Args:
         document_id (int): Hyplag document id.
         token (str): JWT.
+        session (requests.Session, optional): Session for the request. Defaults to the shared Hyplag session.
 
     Returns:
-        str: XML file string.
+        bytes: XML file content as sent by the backend.
     """
+    session = session or get_hyplag_session()
     get_url = HYPLAG_BACKEND_GET_DOCUMENT + str(document_id) + "/tei"
-    headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
-    response = requests.get(url=get_url, headers=headers)
-    return response.text
 
+    def send(token: str) -> requests.Response:
+        headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
+        return record_response("hyplag", session.get(url=get_url, headers=headers))
 
-def get_documents_from_list(list_document_ids: List[int], token: str, num_threads: int = 10) -> List[str]:
-    """Get xml documents from the given list of document ids from the Hyplag backend.
+    response, _ = _send_authorized(send, token)
+    return response.content
+
+
+def fetch_tei(document_id: int, token: str, session: Optional[requests.Session] = None) -> Optional[bytes]:
+    """Get the TEI xml of a document if the backend has finished processing it. A rejected token is
+       replaced once, see _send_authorized.
 
     Args:
-        list_document_ids (List[int]): List of Hyplagd document ids.
+        document_id (int): Hyplag document id.
         token (str): JWT.
+        session (requests.Session, optional): Session for the request. Defaults to the shared Hyplag session.
+
+    Raises:
+        requests.exceptions.HTTPError: The backend rejected the request.
+
+    Returns:
+        Optional[bytes]: XML file content, None while the document is processed.
+    """
+    session = session or get_hyplag_session()
+    get_url = HYPLAG_BACKEND_GET_DOCUMENT + str(document_id) + "/tei"
+
+    def send(token: str) -> requests.Response:
+        headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
+        return record_response("hyplag", session.get(url=get_url, headers=headers))
+
+    response, _ = _send_authorized(send, token)
+    if response.status_code in HYPLAG_NOT_READY_STATUSES or (response.ok and not response.content.strip()):
+        return None
+    response.raise_for_status()
+    return response.content
+
+
+def _transient(error: BaseException) -> bool:
+    """Whether a failed request may succeed later: connection errors, timeouts and server errors."""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.exceptions.HTTPError) and response is not None and (
+        response.status_code >= 500 or response.status_code == 429
+    )
+
+
+def poll_delay(
+    attempt: int, base_delay: float = HYPLAG_POLL_DELAY, max_delay: float = HYPLAG_POLL_MAX_DELAY
+) -> float:
+    """Seconds before the next poll of a document, doubled with every attempt up to max_delay."""
+    return min(max_delay, base_delay * 2 ** attempt)
+
+
+def wait_for_document(
+    document_id: int,
+    token: Optional[str] = None,
+    timeout: float = HYPLAG_POLL_TIMEOUT,
+    session: Optional[requests.Session] = None,
+) -> bytes:
+    """Polls the backend with exponential backoff until the TEI xml of a posted document is ready.
+
+    Args:
+        document_id (int): Hyplag document id.
+        token (str, optional): JWT. Defaults to the token of the shared token manager.
+        timeout (float, optional): Seconds to wait. Defaults to HYPLAG_POLL_TIMEOUT.
+        session (requests.Session, optional): Session for the requests. Defaults to the shared Hyplag session.
+
+    Raises:
+        TimeoutError: The document was not ready within timeout.
+        requests.exceptions.RequestException: A poll failed with an error which is not transient, or with
+                                              a transient error (see _transient) after the timeout.
+
+    Returns:
+        bytes: XML file content.
+    """
+    deadline = time.monotonic() + timeout
+    for attempt in itertools.count():
+        delay = poll_delay(attempt)
+        try:
+            tei = fetch_tei(document_id, token or get_current_token(), session)
+        except requests.exceptions.RequestException as error:
+            if not _transient(error) or time.monotonic() + delay > deadline:
+                raise
+            logging.info(f"Poll of Hyplag document {document_id} failed, retrying: {error}")
+        else:
+            if tei is not None:
+                return tei
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"Hyplag document {document_id} not ready after {timeout} seconds.")
+        time.sleep(delay)
+
+
+class HyplagResult(NamedTuple):
+    """Result of a document of process_documents_hyplag.
+
+    Args:
+        path (str): Path of the pdf file.
+        document_id (Optional[int]): Hyplag document id, None if the upload failed.
+        tei (Optional[bytes]): TEI xml, None if the document failed.
+        error (Optional[BaseException]): Exception of the failed upload or download.
+        upload_seconds (float): Seconds of the upload.
+        ready_seconds (float): Seconds from the end of the upload until the TEI was ready.
+        download_seconds (float): Seconds of the request which returned the TEI.
+        polls (int): Number of TEI requests.
+    """
+
+    path: str
+    document_id: Optional[int] = None
+    tei: Optional[bytes] = None
+    error: Optional[BaseException] = None
+    upload_seconds: float = 0.0
+    ready_seconds: float = 0.0
+    download_seconds: float = 0.0
+    polls: int = 0
+
+
+def process_documents_hyplag(
+    paths: List[Union[str, Path]],
+    token: Optional[str] = None,
+    external_id: str = HYPLAG_ID,
+    num_threads: int = 10,
+    timeout: float = HYPLAG_POLL_TIMEOUT,
+) -> Dict[str, HyplagResult]:
+    """Converts many pdf files with the Hyplag backend. Every document is polled with exponential backoff
+       as soon as its upload returned, so uploads, polls and downloads overlap. At most num_threads
+       requests are in flight; due polls are sent before further uploads, so that finished documents
+       are not held back by the remaining uploads. Polls failing with a transient error (see _transient)
+       are repeated with the same backoff until the timeout.
+
+    Args:
+        paths (List[Union[str, Path]]): Paths of the pdf files.
+        token (str, optional): JWT. Defaults to the token of the shared token manager, which is refreshed
+                               during long runs.
+        external_id (str, optional): ID for Hyplag. Defaults to HYPLAG_ID.
+        num_threads (int, optional): Maximum number of concurrent requests. Defaults to 10.
+        timeout (float, optional): Seconds to wait for the TEI of a document after its upload.
+                                   Defaults to HYPLAG_POLL_TIMEOUT.
+
+    Raises:
+        ValueError: num_threads is smaller than 1.
+
+    Returns:
+        Dict[str, HyplagResult]: Results by path in the order of paths.
+    """
+    if num_threads < 1:
+        raise ValueError(f"Number of threads has to be at least 1, got {num_threads}.")
+    session = get_hyplag_session(num_threads)
+    results: Dict[str, HyplagResult] = {str(path): HyplagResult(str(path)) for path in paths}
+    uploads = collections.deque(results)
+    # Due time, sequence number (ties), path, attempt and end of the upload of scheduled polls
+    polls: List[Tuple[float, int, str, int, float]] = []
+    sequence = itertools.count()
+    in_flight: Dict[concurrent.futures.Future, Tuple[str, int, float]] = {}
+
+    def upload(path: str) -> Tuple[int, float]:
+        start = time.perf_counter()
+        document_id = post_document(Path(path), token or get_current_token(), external_id, session)
+        return document_id, time.perf_counter() - start
+
+    def poll(document_id: int) -> Tuple[Optional[bytes], float]:
+        start = time.perf_counter()
+        tei = fetch_tei(document_id, token or get_current_token(), session)
+        return tei, time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        while uploads or polls or in_flight:
+            now = time.monotonic()
+            while len(in_flight) < num_threads and polls and polls[0][0] <= now:
+                _, _, path, attempt, uploaded = heapq.heappop(polls)
+                in_flight[executor.submit(poll, results[path].document_id)] = (path, attempt, uploaded)
+            while len(in_flight) < num_threads and uploads:
+                path = uploads.popleft()
+                in_flight[executor.submit(upload, path)] = (path, -1, 0.0)
+            wait = max(0.0, polls[0][0] - now) if polls else None
+            if not in_flight:
+                time.sleep(wait)
+                continue
+            done, _ = concurrent.futures.wait(
+                in_flight, timeout=wait, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                path, attempt, uploaded = in_flight.pop(future)
+                result = results[path]
+                try:
+                    value, seconds = future.result()
+                except Exception as error:
+                    now = time.monotonic()
+                    if attempt >= 0 and _transient(error) and now - uploaded + poll_delay(attempt + 1) <= timeout:
+                        logging.info(f"Poll of Hyplag document {result.document_id} failed, retrying: {error}")
+                        due = now + poll_delay(attempt + 1)
+                        heapq.heappush(polls, (due, next(sequence), path, attempt + 1, uploaded))
+                        continue
+                    logging.warning(f"Hyplag conversion of {path} failed: {error}")
+                    results[path] = result._replace(error=error, polls=max(0, attempt + 1))
+                    continue
+                now = time.monotonic()
+                if attempt < 0:
+                    observe("hyplag_stage_seconds", seconds, stage="upload")
+                    results[path] = result._replace(document_id=value, upload_seconds=seconds)
+                    heapq.heappush(polls, (now + poll_delay(0), next(sequence), path, 0, now))
+                elif value is not None:
+                    observe("hyplag_stage_seconds", now - uploaded, stage="ready")
+                    observe("hyplag_stage_seconds", seconds, stage="download")
+                    results[path] = result._replace(
+                        tei=value, ready_seconds=now - uploaded, download_seconds=seconds, polls=attempt + 1
+                    )
+                elif now - uploaded + poll_delay(attempt + 1) > timeout:
+                    error = TimeoutError(f"Hyplag document {result.document_id} not ready after {timeout} seconds.")
+                    logging.warning(str(error))
+                    results[path] = result._replace(error=error, polls=attempt + 1)
+                else:
+                    due = now + poll_delay(attempt + 1)
+                    heapq.heappush(polls, (due, next(sequence), path, attempt + 1, uploaded))
+    return results
+
+
+def get_documents_from_list(
+    list_document_ids: List[int], token: Optional[str] = None, num_threads: int = 10
+) -> List[bytes]:
+    """Get xml documents from the given list of document ids from the Hyplag backend. The threads share
+       the keep-alive Hyplag session.
+
+    Args:
+        list_document_ids (List[int]): List of Hyplagd document ids.
+        token (str, optional): JWT. Defaults to the token of the shared token manager.
         num_threads (int):  Number of threads to use. Defaults to 10.
 
     Returns:
-        List[str]: List of xml file strings.
+        List[bytes]: List of xml file contents in the order of list_document_ids.
     """
     assert num_threads >= 1, "Number of threads has to be equal or greater than 1."
+    session = get_hyplag_session(num_threads)
     xml_document_list = []
     with concurrent.futures.ThreadPoolExecutor(
         max_workers=min(num_threads, len(list_document_ids))
     ) as executor:
         paper_xml_download = [
-            executor.submit(get_document, doc_id, token) for doc_id in list_document_ids
+            executor.submit(lambda doc_id: get_document(doc_id, token or get_current_token(), session), doc_id)
+            for doc_id in list_document_ids
         ]
-        for xml in concurrent.futures.as_completed(paper_xml_download):
+        for xml in paper_xml_download:
             xml_document_list.append(xml.result())
     return xml_document_list
 
 
-def save_xml_doc(file_name: str, xml_doc: str):
+def save_xml_doc(file_name: str, xml_doc: Union[str, bytes]):
     """Save xml file to XML_FILES.
 
     Args:
         file_name (str): File name of save file. 
-        xml_doc (str): XML string.
+        xml_doc (Union[str, bytes]): XML string or content.
     """
-    with open(XML_FILES + str(file_name), "w") as file:
+    if isinstance(xml_doc, str):
+        xml_doc = xml_doc.encode("utf-8")
+    with open(XML_FILES + str(file_name), "wb") as file:
         file.write(xml_doc)
 
 
-def process_documents_grobid(path_to_pdf: Path = Path(PDF_FILES), num_threads: int = 10):
+def save_xml_doc_async(file_name: str, xml_doc: Union[str, bytes]) -> concurrent.futures.Future:
+    """Save xml file to XML_FILES in a background thread.
+
+    Args:
+        file_name (str): File name of save file.
+        xml_doc (Union[str, bytes]): XML string or content.
+
+    Returns:
+        concurrent.futures.Future: Future of the write.
+    """
+    global _xml_writer
+    with _xml_writer_lock:
+        if _xml_writer is None:
+            _xml_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    return _xml_writer.submit(save_xml_doc, file_name, xml_doc)
+
+
+def grobid_url(service: str = GROBID_FULLTEXT_SERVICE, config_path: str = GROBID_CONFIG) -> str:
+    """URL of a Grobid service, the server is GROBID_URL if set, else it is read from the Grobid config.
+
+    Args:
+        service (str, optional): Grobid service. Defaults to GROBID_FULLTEXT_SERVICE.
+        config_path (str, optional): Path to grobid_config.json. Defaults to GROBID_CONFIG.
+
+    Returns:
+        str: Service URL
+    """
+    if GROBID_URL:
+        return f"{GROBID_URL.rstrip('/')}/api/{service}"
+    with open(config_path) as file:
+        config = json.load(file)
+    server = config["grobid_server"]
+    if not server.startswith("http"):
+        server = "http://" + server
+    if config.get("grobid_port"):
+        server += ":" + str(config["grobid_port"])
+    return f"{server}/api/{service}"
+
+
+class GrobidResult(NamedTuple):
+    """Result of a document of GrobidEngine.process_stream.
+
+    Args:
+        path (str): Path of the pdf file.
+        tei (Optional[bytes]): TEI xml, None if the conversion failed.
+        error (Optional[BaseException]): Exception of the failed conversion.
+        seconds (float): Seconds from the first request until the result, including waits while busy.
+    """
+
+    path: str
+    tei: Optional[bytes] = None
+    error: Optional[BaseException] = None
+    seconds: float = 0.0
+
+
+class GrobidEngine:
+    """Converts pdf files with a Grobid server over a pooled keep-alive session. The number of concurrent
+       requests adapts to the server (AIMD): it is halved when Grobid answers 503 because its pool is busy,
+       and grows by one per round of successful requests up to max_concurrency. Busy requests are retried
+       with backoff, so a batch slows down instead of failing.
+
+    Args:
+        url (str, optional): URL of the fulltext service. Defaults to grobid_url().
+        max_concurrency (int, optional): Upper bound of concurrent requests. Defaults to GROBID_CONCURRENCY.
+        min_concurrency (int, optional): Lower bound of concurrent requests. Defaults to 1.
+        timeout (float, optional): Request timeout in seconds. Defaults to 60.
+        retries (int, optional): Retries of a document while Grobid is busy. Defaults to GROBID_RETRIES.
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        max_concurrency: int = GROBID_CONCURRENCY,
+        min_concurrency: int = 1,
+        timeout: float = 60,
+        retries: int = GROBID_RETRIES,
+    ):
+        self.url = url or grobid_url()
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.limit = float(max_concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def concurrency(self) -> int:
+        """Current number of concurrent requests."""
+        return int(self.limit)
+
+    def _acquire(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+
+    def _release(self, busy: Optional[bool]):
+        """Frees a request slot, busy is None for requests without response, which leave the limit unchanged."""
+        with self._condition:
+            self._in_flight -= 1
+            if busy:
+                self.limit = max(float(self.min_concurrency), self.limit / 2)
+            elif busy is not None:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+        set_gauge("grobid_concurrency", int(self.limit))
+
+    def process(self, path_to_pdf: Union[str, Path]) -> bytes:
+        """Converts a pdf file and returns the TEI xml without writing it to disk.
+
+        Args:
+            path_to_pdf (Union[str, Path]): Path to the pdf file.
+
+        Raises:
+            requests.exceptions.RequestException: Grobid is not available, stayed busy or could not
+                                                  process the file.
+
+        Returns:
+            bytes: TEI xml content.
+        """
+        for attempt in range(self.retries + 1):
+            self._acquire()
+            busy = None
+            try:
+                with open(path_to_pdf, "rb") as pdf, timer("stage_seconds", stage="grobid"):
+                    response = self.session.post(
+                        url=self.url,
+                        files={"input": (Path(path_to_pdf).name, pdf, "application/pdf")},
+                        data={"consolidateHeader": "0"},
+                        timeout=self.timeout,
+                    )
+                busy = record_response("grobid", response).status_code == 503
+            finally:
+                self._release(busy)
+            if not busy:
+                break
+            if attempt < self.retries:
+                time.sleep(backoff_delay(attempt, 0.5, 10))
+        response.raise_for_status()
+        return response.content
+
+    def _result(self, path: str) -> GrobidResult:
+        start = time.perf_counter()
+        try:
+            return GrobidResult(path, tei=self.process(path), seconds=time.perf_counter() - start)
+        except Exception as error:
+            return GrobidResult(path, error=error, seconds=time.perf_counter() - start)
+
+    def process_stream(self, paths: Iterable[Union[str, Path]]) -> Iterator[GrobidResult]:
+        """Converts a stream of pdf files. Paths are read from the stream as request slots become free, so
+           the stream may be a generator of files which are still downloaded.
+
+        Args:
+            paths (Iterable[Union[str, Path]]): Paths of the pdf files.
+
+        Returns:
+            Iterator[GrobidResult]: Results in order of completion, failed documents carry their error.
+        """
+        paths = iter(paths)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            pending = set()
+            for path in itertools.islice(paths, 2 * self.max_concurrency):
+                pending.add(executor.submit(self._result, str(path)))
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for path in itertools.islice(paths, 1):
+                        pending.add(executor.submit(self._result, str(path)))
+                    yield future.result()
+
+    def process_batch(self, paths: List[Union[str, Path]]) -> Dict[str, GrobidResult]:
+        """Converts a batch of pdf files, see process_stream.
+
+        Args:
+            paths (List[Union[str, Path]]): Paths of the pdf files.
+
+        Returns:
+            Dict[str, GrobidResult]: Results by path in the order of paths.
+        """
+        results = {result.path: result for result in self.process_stream(paths)}
+        return {str(path): results[str(path)] for path in paths}
+
+
+_default_grobid_engine: Optional[GrobidEngine] = None
+_default_grobid_engine_pid: Optional[int] = None
+
+
+def get_grobid_engine() -> GrobidEngine:
+    """Returns the Grobid engine of the process, shared by all threads so that they adapt to the server
+    together. Forked processes create their own engine, connections are not shared with the parent.
+
+    Returns:
+        GrobidEngine: Shared engine.
+    """
+    global _default_grobid_engine, _default_grobid_engine_pid
+    with _default_lock:
+        if _default_grobid_engine is None or _default_grobid_engine_pid != os.getpid():
+            _default_grobid_engine = GrobidEngine()
+            _default_grobid_engine_pid = os.getpid()
+        return _default_grobid_engine
+
+
+def process_document_grobid(path_to_pdf: Path, timeout: float = 60) -> bytes:
+    """Process a pdf file with Grobid and return the TEI xml without writing it to disk.
+
+    Args:
+        path_to_pdf (Path): Path to the pdf file.
+        timeout (float, optional): Request timeout in seconds. Defaults to 60.
+
+    Raises:
+        requests.exceptions.RequestException: Grobid is not available or could not process the file.
+
+    Returns:
+        bytes: TEI xml content.
+    """
+    engine = get_grobid_engine()
+    if timeout == engine.timeout:
+        return engine.process(path_to_pdf)
+    engine = GrobidEngine(engine.url, engine.max_concurrency, timeout=timeout)
+    return engine.process(path_to_pdf)
+
+
+def process_documents_grobid(
+    path_to_pdf: Path = Path(PDF_FILES), num_threads: int = GROBID_CONCURRENCY
+) -> Dict[str, GrobidResult]:
     """Process pdf files from path_to_pdf with grobid and output them as xml file to XML_FILES.
 
     Args:
         path_to_pdf (Path, optional): Path to pdf files. Defaults to Path(PDF_FILES).
-        num_threads (int, optional): Number of threads. Defaults to 10.
-    """
-    client = GrobidClient(config_path="./grobid_config.json")
-    client.process(
-        service="processFulltextDocument",
-        input_path=str(path_to_pdf),
-        output=str(XML_FILES),
-        n=num_threads,
-        consolidate_header=False,
-    )
+        num_threads (int, optional): Maximum number of concurrent requests. Defaults to GROBID_CONCURRENCY.
+
+    Returns:
+        Dict[str, GrobidResult]: Results by path of the pdf file
+    """
+    engine = get_grobid_engine()
+    if num_threads != engine.max_concurrency:
+        engine = GrobidEngine(engine.url, num_threads)
+    results = engine.process_batch(sorted(glob(str(path_to_pdf) + "/*.pdf")))
+    for path, result in results.items():
+        if result.tei is not None:
+            save_xml_doc(Path(path).stem + ".tei.xml", result.tei)
+        else:
+            logging.warning(f"Grobid failed for {path}: {result.error}")
+    return results
 
 
 if __name__ == "__main__":
@@ -0,0 +1,283 @@
+import base64
+import concurrent.futures
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import requests as r
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from definitions import IMAGE_FILES, IMAGE_FILES_MAX_SIZE, IMAGE_FILES_TTL
+from metrics import increment
+from pubchem import fetch_structure_png
+from utils import create_session
+
+
+class ImageStore:
+    """Content-addressed on-disk store for PubChem structure images. Each PNG is saved once under
+       its SHA-256 digest in objects/, the index cid/ maps a CID to the digest of its image and the
+       time it was stored. The modification time of an index file is the last access of the image,
+       which is used to evict the least recently used images if the store grows beyond max_size.
+
+    Args:
+        path (str, optional): Directory of the store. Defaults to IMAGE_FILES.
+        session (r.Session, optional): Session for downloading missing images. Created on first use.
+        num_threads (int, optional): Number of threads for prefetching. Defaults to 4.
+        ttl (float, optional): Seconds until a stored image is downloaded again, None to keep images
+            until they are evicted. Defaults to IMAGE_FILES_TTL.
+        max_size (int, optional): Maximum number of image bytes kept before the least recently used
+            images are evicted. Defaults to IMAGE_FILES_MAX_SIZE.
+    """
+
+    def __init__(
+        self,
+        path: str = IMAGE_FILES,
+        session: Optional[r.Session] = None,
+        num_threads: int = 4,
+        ttl: Optional[float] = IMAGE_FILES_TTL,
+        max_size: int = IMAGE_FILES_MAX_SIZE,
+    ):
+        self.path = Path(path)
+        self.num_threads = num_threads
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._session = session
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        (self.path / "objects").mkdir(parents=True, exist_ok=True)
+        (self.path / "cid").mkdir(parents=True, exist_ok=True)
+        self._size = sum(self._object_sizes().values())
+
+    @property
+    def session(self) -> r.Session:
+        with self._lock:
+            if self._session is None:
+                self._session = create_session()
+            return self._session
+
+    def _object_path(self, digest: str) -> Path:
+        return self.path / "objects" / digest[:2] / (digest + ".png")
+
+    def _index_path(self, cid: int) -> Path:
+        return self.path / "cid" / str(cid)
+
+    def _object_sizes(self) -> Dict[str, int]:
+        return {path.stem: path.stat().st_size for path in (self.path / "objects").glob("*/*.png")}
+
+    @staticmethod
+    def _read_index(path: Path) -> Optional[Tuple[str, float]]:
+        """Digest and storage time of an index file, files without a storage time count from their last access."""
+        try:
+            fields = path.read_text().split()
+            return fields[0], float(fields[1]) if len(fields) > 1 else path.stat().st_mtime
+        except (FileNotFoundError, IndexError, ValueError):
+            return None
+
+    def _expired(self, stored: float, now: float) -> bool:
+        return self.ttl is not None and stored + self.ttl < now
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+    def digest(self, cid: int) -> Optional[str]:
+        """Digest of the stored image of a CID.
+
+        Args:
+            cid (int): PubChem Identifier for chemical
+
+        Returns:
+            Optional[str]: SHA-256 hex digest, None if the image is not stored or expired
+        """
+        index = self._read_index(self._index_path(cid))
+        if index is None or self._expired(index[1], time.time()):
+            return None
+        return index[0]
+
+    def put(self, cid: int, png: bytes) -> str:
+        """Store the image of a CID, identical images are only saved once. Evicts expired and least
+           recently used images if the store is too large.
+
+        Args:
+            cid (int): PubChem Identifier for chemical
+            png (bytes): PNG file
+
+        Returns:
+            str: SHA-256 hex digest of the image
+        """
+        digest = hashlib.sha256(png).hexdigest()
+        object_path = self._object_path(digest)
+        index_path = self._index_path(cid)
+        now = time.time()
+        with self._lock:
+            if not object_path.exists():
+                self._write_atomic(object_path, png)
+                self._size += len(png)
+            self._write_atomic(index_path, f"{digest} {now}".encode("ascii"))
+            os.utime(index_path, (now, now))
+            if self._size > self.max_size:
+                self._evict()
+        return digest
+
+    def _evict(self):
+        """Remove expired images, then least recently used images until 90% of max_size is free. The
+           sizes are read from the directory, which may be shared with other processes."""
+        now = time.time()
+        sizes = self._object_sizes()
+        entries = []
+        for path in (self.path / "cid").iterdir():
+            index = self._read_index(path)
+            if index is not None:
+                try:
+                    entries.append((path.stat().st_mtime, path, index))
+                except FileNotFoundError:
+                    pass
+        references = Counter(digest for _, _, (digest, _) in entries)
+        self._size = sum(sizes.values())
+        target = int(self.max_size * 0.9)
+        entries.sort(key=lambda entry: entry[0])
+        for _, path, (digest, stored) in entries:
+            if self._size <= target and not self._expired(stored, now):
+                continue
+            path.unlink(missing_ok=True)
+            references[digest] -= 1
+            if references[digest] == 0 and digest in sizes:
+                self._object_path(digest).unlink(missing_ok=True)
+                self._size -= sizes.pop(digest)
+        # Objects left without an index file
+        for digest in [digest for digest in sizes if references[digest] <= 0]:
+            self._object_path(digest).unlink(missing_ok=True)
+            self._size -= sizes.pop(digest)
+
+    def get(self, cid: int) -> Optional[bytes]:
+        """Stored image of a CID without downloading it.
+
+        Args:
+            cid (int): PubChem Identifier for chemical
+
+        Returns:
+            Optional[bytes]: PNG file, None if the image is not stored or expired
+        """
+        index_path = self._index_path(cid)
+        index = self._read_index(index_path)
+        now = time.time()
+        png = None
+        if index is not None and not self._expired(index[1], now):
+            try:
+                png = self._object_path(index[0]).read_bytes()
+                os.utime(index_path, (now, now))
+            except FileNotFoundError:
+                png = None
+        with self._lock:
+            if png is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        increment("cache_lookups_total", cache="images", kind="png", result="miss" if png is None else "hit")
+        return png
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit and miss counters of get.
+
+        Returns:
+            Dict[str, Any]: {"hits": int, "misses": int, "hit_ratio": float}
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / total if total else 0.0}
+
+    def fetch(self, cid: int, session: Optional[r.Session] = None) -> Optional[bytes]:
+        """Image of a CID, which is downloaded from PubChem and stored if it is missing.
+
+        Args:
+            cid (int): PubChem Identifier for chemical
+            session (r.Session, optional): Session for the download. Defaults to the session of the store.
+
+        Returns:
+            Optional[bytes]: PNG file, None if the download failed
+        """
+        png = self.get(cid)
+        if png is None:
+            png = fetch_structure_png(cid, session if session is not None else self.session)
+            if png is not None:
+                self.put(cid, png)
+        return png
+
+    def prefetch(self, cids: Iterable[int]) -> List[concurrent.futures.Future]:
+        """Download the images of the CIDs in the background.
+
+        Args:
+            cids (Iterable[int]): PubChem Identifiers
+
+        Returns:
+            List[concurrent.futures.Future]: Futures of the downloads
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads)
+        return [self._executor.submit(self.fetch, cid) for cid in dict.fromkeys(cids)]
+
+    def handle(self, cid: int) -> "StructureImage":
+        return StructureImage(cid, self)
+
+
+class StructureImage:
+    """Lazy reference to the structure image of a CID, the image is loaded from the ImageStore
+       (and downloaded if necessary) when it is accessed.
+
+    Args:
+        cid (int): PubChem Identifier for chemical
+        store (ImageStore): Image store
+    """
+
+    __slots__ = ("cid", "store")
+
+    def __init__(self, cid: int, store: ImageStore):
+        self.cid = cid
+        self.store = store
+
+    @property
+    def digest(self) -> Optional[str]:
+        return self.store.digest(self.cid)
+
+    def load(self) -> Optional[bytes]:
+        """PNG file of the structure image, None if it is not available."""
+        return self.store.fetch(self.cid)
+
+    def base64(self) -> Optional[str]:
+        """Base64 encoded PNG file of the structure image, None if it is not available."""
+        png = self.load()
+        return base64.b64encode(png).decode("ascii") if png is not None else None
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, StructureImage) and self.cid == other.cid and self.store.path == other.store.path
+
+    def __hash__(self) -> int:
+        return hash((self.cid, self.store.path))
+
+    def __repr__(self) -> str:
+        return f"StructureImage(cid={self.cid})"
+
+
+_default_store: Optional[ImageStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_image_store() -> ImageStore:
+    """Returns the process wide image store in IMAGE_FILES.
+
+    Returns:
+        ImageStore: Shared image store.
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = ImageStore()
+        return _default_store
@@ -1,111 +1,634 @@
-from hyplag_backend import (
-    process_documents_grobid,
-    get_current_token,
-    post_document,
-    get_document,
-    save_xml_doc,
-)
-from parser import clean_xml, TeiXmlReader
-from pubchem import search_pubchem
+from cid_index import CidIndex, Match, get_cid_index, OVERLAP
+from manifest import Manifest, get_manifest, content_hash, TEI_STAGE, NAMES_STAGE, ROWS_STAGE
+from pipeline import Stage, PipelineResult, run_pipeline, PROCESS
+from metrics import call_recording, increment, merge_recorded, observe, timer
+from functools import partial
 from pathlib import Path
 from definitions import PDF_FILES
-from utils import create_session
-from typing import List, Any
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Any, Optional, Tuple, Union
+import itertools
+import logging
+import multiprocessing
+import os
+
+# chemdataextractor, pubchempy, grobid_client, requests and numpy are imported by the functions using them,
+# so that importing main (and the service and client built on it) stays fast
+if TYPE_CHECKING:
+    from chemdataextractor.doc import Document
+    from pubchem import NameResolution
+    from requests import Session
 
 
 CID_INDEX: int = 1
+# Documents processed by a worker process before it is replaced, bounds the memory per worker
+MAX_TASKS_PER_WORKER: int = 50
+# Pdf files converted together by convert_pdfs in process_corpus and stream_corpus
+CONVERSION_BATCH_SIZE: int = 16
+
 
-def process_pdf(pdf_name: str) -> List[Any]:
-    """Processes the input pdf file and extracts all chemical entities.
+def process_pdf(
+    pdf_name: str,
+    eager_images: bool = False,
+    prefetch_images: bool = False,
+    manifest: Optional[Manifest] = None,
+    shard_size: Optional[int] = None,
+    session: Optional["Session"] = None,
+) -> List[Any]:
+    """Processes the input pdf file and extracts all chemical entities. Stages completed in an earlier
+       run for the same file content are read from the manifest instead of being processed again.
 
     Args:
         pdf_name (str): Name of the pdf file in PDF_FILES folder
+        eager_images (bool, optional): Download the structure images and add them base64 encoded.
+                                       Defaults to False.
+        prefetch_images (bool, optional): Download the structure images into the image store in the
+                                          background, if they are not eager. Defaults to False.
+        manifest (Manifest, optional): Manifest of stage artifacts. Defaults to the shared manifest.
+        shard_size (int, optional): Run the NER of large documents in parallel on shards of this many
+                                    elements, see extract_records. The entities are neither read from nor
+                                    recorded in the manifest. Defaults to None (no sharding).
+        session (Session, optional): requests.Session object for the PubChem requests. Created if not given.
 
     Returns:
         List[List[Any]]: List of chemical entities. Each element consists of:
-                         [Iupac name, CID, List of Atoms, Molecule Weight, Molecular Formula, 
-                          Base64 encoded image of molecular structure]
+                         [Iupac name, CID, List of Atoms, Molecule Weight, Molecular Formula,
+                          Structure image (StructureImage handle, base64 encoded string if eager_images)]
+    """
+    from pubchem import resolve_names_with_failures
+    from utils import create_session
+
+    manifest = manifest if manifest is not None else get_manifest()
+    key = content_hash(PDF_FILES + pdf_name)
+    session = session or create_session()
+    # The manifest only records the entities of the NER of the whole document
+    chemical_list = manifest.get(key, ROWS_STAGE) if not shard_size else None
+    if chemical_list is None:
+        chem_names = extract_names_from_pdf(pdf_name, manifest, key, shard_size)
+        with timer("stage_seconds", stage="resolve"):
+            resolution = resolve_names_with_failures(chem_names, session, include_images=False)
+        chemical_list = resolution.chemical_list
+        if not shard_size:
+            store_rows(manifest, key, pdf_name, resolution)
+    observe("document_entities", len(chemical_list))
+    return attach_structure_images(chemical_list, session, eager_images, prefetch_images)
+
+
+def store_rows(manifest: Manifest, key: str, pdf_name: str, resolution: "NameResolution"):
+    """Stores the chemical entities of a document in the manifest, unless PubChem lookups failed. Those
+       entities would be missing for good, the document is resolved again next time instead.
+
+    Args:
+        manifest (Manifest): Manifest of stage artifacts
+        key (str): Content hash of the pdf file
+        pdf_name (str): Name of the pdf file in PDF_FILES folder
+        resolution (NameResolution): Result of resolve_names_with_failures
+    """
+    if resolution.failed:
+        logging.warning(f"Not storing the entities of {pdf_name}, {resolution.failed} PubChem lookups failed")
+        increment("rows_not_stored_total")
+        return
+    manifest.set(key, ROWS_STAGE, resolution.chemical_list, PDF_FILES + pdf_name)
+
+
+def convert_pdf(pdf_name: str, save_xml: bool = False) -> bytes:
+    """Converts the pdf file to TEI xml with Grobid, or with the Hyplag backend if Grobid is not
+       available. The TEI xml is kept in memory.
+
+    Args:
+        pdf_name (str): Name of the pdf file in PDF_FILES folder
+        save_xml (bool, optional): Also save the TEI xml to XML_FILES in the background. Defaults to False.
+
+    Returns:
+        bytes: TEI xml content
     """
+    from hyplag_backend import process_document_grobid, get_current_token, post_document, wait_for_document
+    from hyplag_backend import save_xml_doc_async
+
     try:
-        process_documents_grobid(Path(PDF_FILES + pdf_name))
-    except:
-        token = get_current_token()
-        document_id = post_document(Path(PDF_FILES + pdf_name), token)
-        document = get_document(document_id, token)
-        save_xml_doc(Path(pdf_name[:-4] + ".xml"), document)
-    xml_name = pdf_name[:-4] + ".xml"
-    xml_root = clean_xml(xml_name)
-    cde_document = TeiXmlReader().parse(xml_root)
-    chemical_list = []
-    session = create_session()
-    cid_list = []
-    for chem in cde_document.records.serialize():
-        chemical = []
-        # Extracted chemical compounds
-        compound = chem.get("Compound")
-        if compound:
-            chem_names = compound.get("names")
-            if not chem_names:
-                continue
+        document = process_document_grobid(Path(PDF_FILES + pdf_name))
+        increment("conversions_total", converter="grobid")
+    except Exception as error:
+        logging.warning(f"Grobid failed for {pdf_name}, falling back to the Hyplag backend: {error}")
+        with timer("stage_seconds", stage="hyplag"):
+            token = get_current_token()
+            document_id = post_document(Path(PDF_FILES + pdf_name), token)
+            document = wait_for_document(document_id)
+        increment("conversions_total", converter="hyplag")
+    if save_xml:
+        save_xml_doc_async(pdf_name[:-4] + ".xml", document)
+    return document
+
+
+def convert_pdfs(pdf_names: List[str], save_xml: bool = False) -> Dict[str, Union[bytes, BaseException]]:
+    """Converts a batch of pdf files to TEI xml with the shared Grobid engine. Only the files Grobid failed
+       to convert are sent to the Hyplag backend.
+
+    Args:
+        pdf_names (List[str]): Names of the pdf files in PDF_FILES folder
+        save_xml (bool, optional): Also save the TEI xml to XML_FILES in the background. Defaults to False.
+
+    Returns:
+        Dict[str, Union[bytes, BaseException]]: TEI xml content, or the exception of the Hyplag fallback if
+                                                both conversions failed, by pdf name in the order of pdf_names
+    """
+    from hyplag_backend import get_grobid_engine, process_documents_hyplag, save_xml_doc_async
+
+    paths = {PDF_FILES + pdf_name: pdf_name for pdf_name in pdf_names}
+    documents: Dict[str, Union[bytes, BaseException]] = {}
+    failed = []
+    for path, result in get_grobid_engine().process_batch(list(paths)).items():
+        if result.tei is not None:
+            documents[paths[path]] = result.tei
         else:
-            continue
-        for name in chem_names:
-            # Further information from pubchem
-            temp_name = name
-            compound_properties = search_pubchem(temp_name, session)
-            if not compound_properties and "." in temp_name:
-                compound_properties = search_pubchem(temp_name.replace(".", ","), session)
-            if not compound_properties and " " in temp_name:
-                compound_properties = search_pubchem(temp_name.replace(" ", ""), session)
-
-            if compound_properties:
-                # If chemical is already extracted skip it
-                cid = compound_properties[0][1]["cid"]
-                if cid in cid_list:
-                    continue
-                # Set of elements
-                compound_properties[0][1]["elements"] = list(
-                    set(compound_properties[0][1]["elements"])
-                )
-                # Name 
-                iupac_name = compound_properties[0][1]["iupac_name"]
-                if iupac_name:
-                    compound_properties[0][1]["iupac_name"] = iupac_name.replace(";", " ")
-                cid_list.append(cid)
-                chemical.extend(list(compound_properties[0][1].values()))
-                # Use extracted name if no iupac name avaiable
-                if compound_properties[0][1]["iupac_name"] is None:
-                    chemical[0] = name
-                chemical.append(compound_properties[0][2])
-            else:
-                # If no results form pubchem, skip the chemical entity
+            logging.warning(f"Grobid failed for {paths[path]}, falling back to the Hyplag backend: {result.error}")
+            failed.append(path)
+    increment("conversions_total", len(documents), converter="grobid")
+    if failed:
+        for path, result in process_documents_hyplag(failed).items():
+            documents[paths[path]] = result.tei if result.tei is not None else result.error
+        increment("conversions_total", len(failed), converter="hyplag")
+    if save_xml:
+        for pdf_name, document in documents.items():
+            if isinstance(document, bytes):
+                save_xml_doc_async(pdf_name[:-4] + ".xml", document)
+    return {pdf_name: documents[pdf_name] for pdf_name in pdf_names}
+
+
+def _convert_pending(
+    documents: List[Tuple[str, str]], manifest: Manifest, batch_size: int = CONVERSION_BATCH_SIZE
+) -> Iterator[List[Tuple[str, str]]]:
+    """Converts the pdf files without TEI in the manifest in batches with convert_pdfs and records the TEI.
+
+    Args:
+        documents (List[Tuple[str, str]]): (pdf name, content hash) pairs
+        manifest (Manifest): Manifest of stage artifacts
+        batch_size (int, optional): Files per call of convert_pdfs. Defaults to CONVERSION_BATCH_SIZE.
+
+    Returns:
+        Iterator[List[Tuple[str, str]]]: Batches of the documents with TEI in the manifest, documents
+                                         which could not be converted are left out
+    """
+    ready, missing = [], []
+    for document in documents:
+        (missing if manifest.last_stage(document[1]) is None else ready).append(document)
+    if ready:
+        yield ready
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start : start + batch_size]
+        converted = convert_pdfs([pdf_name for pdf_name, _ in batch])
+        ready = []
+        for pdf_name, key in batch:
+            tei = converted[pdf_name]
+            if isinstance(tei, BaseException):
+                logging.error(f"Conversion of {pdf_name} failed: {tei}")
                 continue
-            if chemical:
-                chemical_list.append(chemical)
+            manifest.set(key, TEI_STAGE, tei, PDF_FILES + pdf_name)
+            ready.append((pdf_name, key))
+        yield ready
+
+
+def _convert_batches(
+    pdf_names: Iterable[str], documents: Dict[str, Union[bytes, BaseException]], batch_size: int
+) -> Iterator[str]:
+    """Converts the pdf files in batches with convert_pdfs while they are consumed. The TEI is kept in
+       documents until the tei stage takes it, see _take_document.
+
+    Args:
+        pdf_names (Iterable[str]): Names of the pdf files in PDF_FILES folder, consumed lazily
+        documents (Dict[str, Union[bytes, BaseException]]): TEI or conversion error by pdf name
+        batch_size (int): Files per call of convert_pdfs
+
+    Returns:
+        Iterator[str]: Names of the converted pdf files
+    """
+    names = iter(pdf_names)
+    while True:
+        batch = list(itertools.islice(names, batch_size))
+        if not batch:
+            return
+        documents.update(convert_pdfs(batch))
+        yield from batch
+
+
+def _take_document(pdf_name: str, documents: Dict[str, Union[bytes, BaseException]]) -> bytes:
+    """TEI of a pdf file converted by _convert_batches, raises the error if the conversion failed."""
+    document = documents.pop(pdf_name)
+    if isinstance(document, BaseException):
+        raise document
+    return document
+
+
+def extract_names_from_pdf(
+    pdf_name: str,
+    manifest: Optional[Manifest] = None,
+    key: Optional[str] = None,
+    shard_size: Optional[int] = None,
+    use_ner_cache: bool = False,
+) -> List[str]:
+    """Converts the pdf file and extracts the names of all chemical compounds with CDE. The TEI file and
+       the names are recorded in the manifest, stages with recorded artifacts are skipped. Names of
+       sharded or cached extractions can differ from the NER of the whole document, they are not
+       recorded.
+
+    Args:
+        pdf_name (str): Name of the pdf file in PDF_FILES folder
+        manifest (Manifest, optional): Manifest of stage artifacts. Defaults to the shared manifest.
+        key (str, optional): Content hash of the pdf file. Computed if not given.
+        shard_size (int, optional): Run the NER in parallel on shards of this many elements, see
+                                    extract_records. Not available in daemon worker processes.
+                                    Defaults to None (no sharding).
+        use_ner_cache (bool, optional): Extract sentence by sentence with the shared NER cache, see
+                                        extract_records_cached. The names can differ from the extraction of
+                                        the whole document. Defaults to False.
+
+    Returns:
+        List[str]: Chemical names in order of occurence
+    """
+    from parser import clean_xml
+    from tei_reader import TeiXmlReader
+    from ner import extract_records, get_ner_cache
+
+    manifest = manifest if manifest is not None else get_manifest()
+    key = key or content_hash(PDF_FILES + pdf_name)
+    record_names = not (shard_size or use_ner_cache)
+    chem_names = manifest.get(key, NAMES_STAGE) if record_names else None
+    if chem_names is not None:
+        return chem_names
+    tei = manifest.get(key, TEI_STAGE)
+    if tei is None:
+        tei = convert_pdf(pdf_name)
+        manifest.set(key, TEI_STAGE, tei, PDF_FILES + pdf_name)
+    if shard_size or use_ner_cache:
+        elements = TeiXmlReader().parse_elements(clean_xml(tei))
+        cache = get_ner_cache() if use_ner_cache else None
+        with timer("stage_seconds", stage="ner"):
+            chem_names = names_from_records(extract_records(elements, shard_size, cache=cache))
+    else:
+        document = parse_xml(tei)
+        with timer("stage_seconds", stage="ner"):
+            chem_names = extract_chemical_names(document)
+    if record_names:
+        manifest.set(key, NAMES_STAGE, chem_names, PDF_FILES + pdf_name)
+    return chem_names
+
+
+def resolve_chemical_names(
+    chem_names: List[str], session: "Session", eager_images: bool = False, prefetch_images: bool = False
+) -> List[List[Any]]:
+    """Resolves chemical names with PubChem into the chemical entities returned by process_pdf.
+
+    Args:
+        chem_names (List[str]): Chemical names in order of occurence
+        session (Session): requests.Session object for the PubChem requests
+        eager_images (bool, optional): Add base64 encoded structure images. Defaults to False.
+        prefetch_images (bool, optional): Prefetch structure images in the background. Defaults to False.
+
+    Returns:
+        List[List[Any]]: List of chemical entities, see process_pdf.
+    """
+    from pubchem import resolve_names
+
+    chemical_list = resolve_names(chem_names, session, include_images=False)
+    return attach_structure_images(chemical_list, session, eager_images, prefetch_images)
+
+
+def attach_structure_images(
+    chemical_list: List[List[Any]], session: "Session", eager_images: bool = False, prefetch_images: bool = False
+) -> List[List[Any]]:
+    """Appends the structure image to each chemical entity, as lazy StructureImage handle or base64 encoded.
+
+    Args:
+        chemical_list (List[List[Any]]): Chemical entities without image
+        session (Session): requests.Session object for the PubChem requests
+        eager_images (bool, optional): Add base64 encoded structure images. Defaults to False.
+        prefetch_images (bool, optional): Prefetch structure images in the background. Defaults to False.
+
+    Returns:
+        List[List[Any]]: List of chemical entities, see process_pdf.
+    """
+    from image_store import get_image_store
+    from pubchem import get_structure_imgs
+
+    cids = [chemical[CID_INDEX] for chemical in chemical_list]
+    # Both forms are served from the image store
+    image_store = get_image_store()
+    if eager_images:
+        with timer("stage_seconds", stage="images"):
+            images = get_structure_imgs(cids, session, image_store)
+    else:
+        images = [image_store.handle(cid) for cid in cids]
+        if prefetch_images:
+            image_store.prefetch(cids)
+    for chemical, image in zip(chemical_list, images):
+        chemical.append(image)
     return chemical_list
 
-def compare_documents(source_pdf: str, recommendation_pdf: str) -> List[List[Any]]:
+
+def extract_chemical_names(cde_document: "Document", use_ner_cache: bool = False) -> List[str]:
+    """Collects the names of all chemical compounds extracted from a CDE document.
+
+    Args:
+        cde_document (Document): CDE document
+        use_ner_cache (bool, optional): Extract sentence by sentence with the shared NER cache, see
+                                        extract_records_cached. Defaults to False.
+
+    Returns:
+        List[str]: Chemical names in order of occurence
+    """
+    if use_ner_cache:
+        from ner import extract_records_cached, get_ner_cache
+
+        return names_from_records(extract_records_cached(list(cde_document.elements), get_ner_cache(), None))
+    return names_from_records(cde_document.records.serialize())
+
+
+def names_from_records(records: List[Dict[str, Any]]) -> List[str]:
+    """Collects the names of all chemical compounds of serialized CDE records.
+
+    Args:
+        records (List[Dict[str, Any]]): Serialized records, see extract_records
+
+    Returns:
+        List[str]: Chemical names in order of occurence
+    """
+    chem_names: List[str] = []
+    for chem in records:
+        # Extracted chemical compounds
+        compound = chem.get("Compound")
+        if compound and compound.get("names"):
+            chem_names.extend(compound["names"])
+    return chem_names
+
+
+def _extract_names_worker(document: Tuple[str, str]) -> Optional[List[str]]:
+    """Worker of process_corpus for a (pdf name, content hash) pair, returns None if the document could
+    not be processed."""
+    pdf_name, key = document
+    try:
+        return extract_names_from_pdf(pdf_name, key=key)
+    except Exception:
+        logging.exception(f"Extraction of {pdf_name} failed.")
+        return None
+
+
+def process_corpus(
+    paths: List[str],
+    workers: Optional[int] = None,
+    max_tasks_per_worker: int = MAX_TASKS_PER_WORKER,
+    eager_images: bool = False,
+) -> Dict[str, Optional[List[List[Any]]]]:
+    """Processes many pdf files with a process pool and extracts all chemical entities. The CDE models
+       are loaded once before the worker processes are forked, so that they are shared copy-on-write.
+       The parent converts the pdf files in batches with convert_pdfs while the workers parse and run
+       the named entity recognition on the converted batches. The PubChem resolution runs in the
+       parent process with the shared cache and rate limiter. Documents with results in the manifest
+       are not processed again.
+
+    Args:
+        paths (List[str]): Names of the pdf files in PDF_FILES folder
+        workers (int, optional): Number of worker processes. Defaults to the number of cores.
+        max_tasks_per_worker (int, optional): Documents processed by a worker before it is replaced.
+                                              Defaults to MAX_TASKS_PER_WORKER.
+        eager_images (bool, optional): Add base64 encoded structure images. Defaults to False.
+
+    Returns:
+        Dict[str, Optional[List[List[Any]]]]: Chemical entities (see process_pdf) by pdf file name in the
+                                              order of paths, None for documents which failed.
+    """
+    from parser import preload_models
+    from pubchem import resolve_names_with_failures
+    from utils import create_session
+
+    workers = workers or os.cpu_count() or 1
+    preload_models()
+    context = _fork_context()
+    session = create_session()
+    manifest = get_manifest()
+    keys = {pdf_name: content_hash(PDF_FILES + pdf_name) for pdf_name in paths}
+    chemical_lists = {pdf_name: manifest.get(keys[pdf_name], ROWS_STAGE) for pdf_name in paths}
+    pending = [(pdf_name, keys[pdf_name]) for pdf_name in paths if chemical_lists[pdf_name] is None]
+
+    def resolve(pdf_name: str, key: str, task: "multiprocessing.pool.AsyncResult"):
+        chem_names = next(merge_recorded([task.get()]))
+        if chem_names is None:
+            return
+        resolution = resolve_names_with_failures(chem_names, session, include_images=False)
+        chemical_lists[pdf_name] = resolution.chemical_list
+        store_rows(manifest, key, pdf_name, resolution)
+
+    if pending:
+        with context.Pool(processes=min(workers, len(pending)), maxtasksperchild=max_tasks_per_worker) as pool:
+            tasks: List[Tuple[str, str, "multiprocessing.pool.AsyncResult"]] = []
+            # The next batch is converted while the workers process the previous ones
+            for batch in _convert_pending(pending, manifest):
+                for document in batch:
+                    task = pool.apply_async(call_recording, (_extract_names_worker, document))
+                    tasks.append((*document, task))
+                while tasks and tasks[0][2].ready():
+                    resolve(*tasks.pop(0))
+            for task in tasks:
+                resolve(*task)
+    results: Dict[str, Optional[List[List[Any]]]] = {}
+    for pdf_name in paths:
+        chemical_list = chemical_lists[pdf_name]
+        if chemical_list is not None:
+            chemical_list = attach_structure_images(chemical_list, session, eager_images)
+        results[pdf_name] = chemical_list
+    return results
+
+
+def _fork_context() -> multiprocessing.context.BaseContext:
+    """Fork context if available, so that worker processes share the preloaded CDE models."""
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def parse_xml(xml_name: Union[str, bytes]) -> "Document":
+    """Parses the TEI xml file into a CDE document.
+
+    Args:
+        xml_name (Union[str, bytes]): Name of the xml file in XML_FILES folder or its content
+
+    Returns:
+        Document: CDE document
+    """
+    from parser import clean_xml
+    from tei_reader import TeiXmlReader
+
+    return TeiXmlReader().parse(clean_xml(xml_name))
+
+
+def _download_pdf(download_url: str, session: "Session") -> str:
+    from scrape import download_pdf, pdf_name_from_url
+
+    download_pdf(download_url, PDF_FILES, session)
+    return pdf_name_from_url(download_url)
+
+
+def extraction_stages(
+    conversion_workers: int = 4,
+    parse_workers: int = 2,
+    ner_workers: Optional[int] = None,
+    resolve_workers: int = 2,
+    eager_images: bool = False,
+    use_ner_cache: bool = False,
+) -> List[Stage]:
+    """Pipeline stages from a pdf file in PDF_FILES to its chemical entities: TEI conversion, parsing,
+       named entity recognition and PubChem resolution.
+
+    Args:
+        conversion_workers (int, optional): Threads converting pdf files to TEI. Defaults to 4.
+        parse_workers (int, optional): Threads parsing TEI files. Defaults to 2.
+        ner_workers (int, optional): Processes running CDE. Defaults to the number of cores.
+        resolve_workers (int, optional): Threads resolving names with PubChem. Defaults to 2.
+        eager_images (bool, optional): Add base64 encoded structure images. Defaults to False.
+        use_ner_cache (bool, optional): Extract the entities with the shared NER cache, see
+                                        extract_chemical_names. Defaults to False.
+
+    Returns:
+        List[Stage]: Pipeline stages
+    """
+    from utils import create_session
+
+    session = create_session()
+    return [
+        Stage("tei", convert_pdf, conversion_workers),
+        Stage("parse", parse_xml, parse_workers),
+        Stage(
+            "ner",
+            partial(extract_chemical_names, use_ner_cache=use_ner_cache),
+            ner_workers or os.cpu_count() or 1,
+            PROCESS,
+        ),
+        Stage("resolve", partial(resolve_chemical_names, session=session, eager_images=eager_images), resolve_workers),
+    ]
+
+
+def stream_corpus(
+    pdf_names: Iterable[str], conversion_batch_size: int = CONVERSION_BATCH_SIZE, **stage_options
+) -> Iterator[PipelineResult]:
+    """Streams pdf files through the extraction pipeline, see extraction_stages. The pdf files are
+       converted in batches with convert_pdfs as they are read from pdf_names, the tei stage takes the
+       converted TEI. Results are yielded as soon as a document is resolved, while later documents are
+       still converted.
+
+    Args:
+        pdf_names (Iterable[str]): Names of the pdf files in PDF_FILES folder, consumed lazily
+        conversion_batch_size (int, optional): Files per call of convert_pdfs.
+                                               Defaults to CONVERSION_BATCH_SIZE.
+        **stage_options: Options of extraction_stages
+
+    Returns:
+        Iterator[PipelineResult]: Results with the pdf name as key and the chemical entities
+                                  (see process_pdf) as value
+    """
+    from parser import preload_models
+
+    preload_models()
+    documents: Dict[str, Union[bytes, BaseException]] = {}
+    stages = extraction_stages(**stage_options)
+    stages[0] = stages[0]._replace(func=partial(_take_document, documents=documents))
+    source = _convert_batches(pdf_names, documents, conversion_batch_size)
+    return run_pipeline(source, stages, mp_context=_fork_context())
+
+
+def stream_acs_search(
+    search_string: str, num_papers: int, download_workers: int = 4, **stage_options
+) -> Iterator[PipelineResult]:
+    """Searches https://pubs.acs.org/, downloads the papers and streams them through the extraction
+       pipeline. Extraction starts with the first downloaded paper.
+
+    Args:
+        search_string (str): Search string
+        num_papers (int): Number of papers
+        download_workers (int, optional): Threads downloading pdf files. Defaults to 4.
+        **stage_options: Options of extraction_stages
+
+    Returns:
+        Iterator[PipelineResult]: Results with the pdf url as key and the chemical entities
+                                  (see process_pdf) as value
+    """
+    from parser import preload_models
+    from scrape import iter_acs_pdf_urls
+    from utils import create_session
+
+    preload_models()
+    session = create_session()
+    stages = [Stage("acquire", partial(_download_pdf, session=session), download_workers)]
+    stages.extend(extraction_stages(**stage_options))
+    return run_pipeline(iter_acs_pdf_urls(search_string, num_papers, session=session), stages, _fork_context())
+
+
+def compare_documents(
+    source_pdf: str, recommendation_pdf: str, session: Optional["Session"] = None
+) -> List[List[Any]]:
     """Compares chemical entities of two scientific papers. Returns
-    their chemical entities and the indexes of same entities.
+    their chemical entities and the indexes of same entities. Entities of
+    papers processed before are read from the manifest.
 
     Args:
         source_pdf (str): Source pdf file of comparison
         recommendation_pdf (str): Target pdf of for comparison
+        session (Session, optional): requests.Session object for the PubChem requests. Created if not given.
 
     Returns:
         List[List[Any]]: [Chemical entities of source document, Chemical entities of target document,
                           Index pairs for same entities [i, j]]
     """
-    index_list: List[List[int]] = []
-    source_chemical_list = process_pdf(source_pdf)
-    recommendation_chemical_list = process_pdf(recommendation_pdf)
-    for i, source_chemical in enumerate(source_chemical_list):
-        for j, recommendation_chemical in enumerate(recommendation_chemical_list):
-            if source_chemical[CID_INDEX] == recommendation_chemical[CID_INDEX]:
-                index_list.append([i, j])
-                break
+    from records import cid_column, shared_cid_pairs
+    from utils import create_session
+
+    session = session or create_session()
+    source_chemical_list = process_pdf(source_pdf, session=session)
+    recommendation_chemical_list = process_pdf(recommendation_pdf, session=session)
+    index_list: List[List[int]] = shared_cid_pairs(
+        cid_column(source_chemical_list), cid_column(recommendation_chemical_list)
+    ).tolist()
     return source_chemical_list, recommendation_chemical_list, index_list
 
 
+def index_document(pdf_name: str, cid_index: Optional[CidIndex] = None) -> List[List[Any]]:
+    """Processes the pdf file and adds its CIDs to the inverted CID index.
+
+    Args:
+        pdf_name (str): Name of the pdf file in PDF_FILES folder
+        cid_index (CidIndex, optional): CID index. Defaults to the shared index.
+
+    Returns:
+        List[List[Any]]: List of chemical entities, see process_pdf.
+    """
+    cid_index = cid_index if cid_index is not None else get_cid_index()
+    chemical_list = process_pdf(pdf_name)
+    cid_index.add_document(pdf_name, [chemical[CID_INDEX] for chemical in chemical_list])
+    return chemical_list
+
+
+def find_similar_documents(
+    pdf_name: str,
+    k: int = 10,
+    metric: str = OVERLAP,
+    cid_index: Optional[CidIndex] = None,
+    add_to_index: bool = False,
+) -> List[Match]:
+    """Finds the indexed documents sharing the most compounds with the pdf file.
+
+    Args:
+        pdf_name (str): Name of the pdf file in PDF_FILES folder
+        k (int, optional): Number of documents. Defaults to 10.
+        metric (str, optional): Similarity metric of CidIndex.query. Defaults to OVERLAP.
+        cid_index (CidIndex, optional): CID index. Defaults to the shared index.
+        add_to_index (bool, optional): Also add the pdf file to the index, see index_document.
+                                       Defaults to False.
+
+    Returns:
+        List[Match]: Matched documents with their score and the index pairs [i, j] of same entities,
+                     i in the chemical entities of pdf_name and j in those of the matched document.
+    """
+    cid_index = cid_index if cid_index is not None else get_cid_index()
+    chemical_list = index_document(pdf_name, cid_index) if add_to_index else process_pdf(pdf_name)
+    return cid_index.query([chemical[CID_INDEX] for chemical in chemical_list], k, metric, exclude=pdf_name)
+
+
 if __name__ == "__main__":
     chem_list = process_pdf("acssuschemeng.7b03870.pdf")
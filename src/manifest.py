@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+from definitions import MANIFEST, PIPELINE_VERSION
+from metrics import increment
+
+# Stages with artifacts in the manifest, in processing order
+TEI_STAGE: str = "tei"
+NAMES_STAGE: str = "names"
+ROWS_STAGE: str = "rows"
+STAGES = (TEI_STAGE, NAMES_STAGE, ROWS_STAGE)
+
+
+def content_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 digest of a file, read in chunks.
+
+    Args:
+        path (str): Path to the file
+        chunk_size (int, optional): Bytes per read. Defaults to 1 MiB.
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """SQLite manifest of the artifacts of each pipeline stage, keyed by the content hash of the pdf file
+       and the pipeline version. Stages whose artifact is stored are skipped, an interrupted run resumes
+       after the last completed stage of each document.
+
+    Args:
+        path (str, optional): Path of the SQLite file. Defaults to MANIFEST.
+        version (str, optional): Pipeline/config version, artifacts of other versions are ignored.
+                                 Defaults to PIPELINE_VERSION.
+    """
+
+    def __init__(self, path: str = MANIFEST, version: str = PIPELINE_VERSION):
+        self.path = path
+        self.version = version
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections must not be shared with forked worker processes
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS artifacts (content_hash TEXT, version TEXT, stage TEXT, "
+                "source TEXT, value BLOB, updated REAL, PRIMARY KEY (content_hash, version, stage))"
+            )
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, key: str, stage: str) -> Any:
+        """Stored artifact of a stage.
+
+        Args:
+            key (str): Content hash of the pdf file
+            stage (str): Stage name, one of STAGES
+
+        Returns:
+            Any: TEI bytes for TEI_STAGE, decoded JSON for the other stages, None if the stage is not completed
+        """
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value FROM artifacts WHERE content_hash = ? AND version = ? AND stage = ?",
+                (key, self.version, stage),
+            ).fetchone()
+        increment("cache_lookups_total", cache="manifest", kind=stage, result="miss" if row is None else "hit")
+        if row is None:
+            return None
+        return bytes(row[0]) if stage == TEI_STAGE else json.loads(row[0])
+
+    def set(self, key: str, stage: str, value: Any, source: Optional[str] = None):
+        """Record the artifact of a completed stage.
+
+        Args:
+            key (str): Content hash of the pdf file
+            stage (str): Stage name, one of STAGES
+            value (Any): TEI bytes for TEI_STAGE, JSON serializable artifact for the other stages
+            source (str, optional): Path of the pdf file, for reference.
+        """
+        data = value if stage == TEI_STAGE else json.dumps(value).encode("utf-8")
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO artifacts (content_hash, version, stage, source, value, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, self.version, stage, source, sqlite3.Binary(data), time.time()),
+            )
+            self.connection.commit()
+
+    def last_stage(self, key: str) -> Optional[str]:
+        """Last completed stage of a document.
+
+        Args:
+            key (str): Content hash of the pdf file
+
+        Returns:
+            Optional[str]: Stage name, None if no stage is completed
+        """
+        with self._lock:
+            completed = {
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT stage FROM artifacts WHERE content_hash = ? AND version = ?", (key, self.version)
+                )
+            }
+        for stage in reversed(STAGES):
+            if stage in completed:
+                return stage
+        return None
+
+
+_default_manifest: Optional[Manifest] = None
+_default_manifest_lock = threading.Lock()
+
+
+def get_manifest() -> Manifest:
+    """Returns the process wide manifest stored at MANIFEST.
+
+    Returns:
+        Manifest: Shared manifest object.
+    """
+    global _default_manifest
+    with _default_manifest_lock:
+        if _default_manifest is None:
+            _default_manifest = Manifest()
+        return _default_manifest
@@ -0,0 +1,434 @@
+import atexit
+import bisect
+import functools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, ContextManager, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+from definitions import METRICS, METRICS_EXPORT_INTERVAL, METRICS_JSONL, METRICS_PROMETHEUS
+
+# Upper bounds of the histogram buckets of durations in seconds
+SECONDS_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Upper bounds of the histogram buckets of counts, e.g. entities per document
+COUNT_BUCKETS: Tuple[float, ...] = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Histograms whose values are not durations
+HISTOGRAM_BUCKETS: Dict[str, Tuple[float, ...]] = {"document_entities": COUNT_BUCKETS}
+# Path segments of URLs replaced in the endpoint label, keeps the number of label values bounded
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+Labels = Tuple[Tuple[str, str], ...]
+# Counters, gauges and histograms recorded by a worker process, see MetricsRegistry.drain
+Recorded = Tuple[
+    Dict[Tuple[str, Labels], float], Dict[Tuple[str, Labels], float], Dict[Tuple[str, Labels], "Histogram"]
+]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket upper bounds, sum and count of the observed values."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def add(self, other: "Histogram"):
+        """Adds the observations of a histogram with the same buckets."""
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """(upper bound, observations <= bound) per bucket, the last bound is infinity."""
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry:
+    """Thread-safe counters, gauges and histograms with labels. A disabled registry returns from every
+       call right away, so instrumented code costs a function call and an attribute check. Metrics are
+       per process, worker processes of process_corpus, the pipeline and the NER pool record into their
+       own registry and return what they recorded with each result, see call_recording.
+
+    Args:
+        enabled (bool, optional): Record metrics. Defaults to False.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.exporters: List["Exporter"] = []
+        self._lock = threading.Lock()
+        self._export_thread: Optional[threading.Thread] = None
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """Add value to a counter."""
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """Set a gauge to value."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[(name, _labels(labels))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """Add a value to a histogram, the buckets are HISTOGRAM_BUCKETS[name] or SECONDS_BUCKETS."""
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(HISTOGRAM_BUCKETS.get(name, SECONDS_BUCKETS))
+            histogram.observe(value)
+
+    def timer(self, name: str, **labels) -> ContextManager:
+        """Context manager observing the seconds of its block in the histogram name."""
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name, labels)
+
+    @contextmanager
+    def _timer(self, name: str, labels: Dict[str, Any]) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def drain(self) -> Optional[Recorded]:
+        """Removes and returns the metrics recorded so far, None if the registry is disabled.
+
+        Returns:
+            Optional[Recorded]: Counters, gauges and histograms, see merge
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            recorded = (self.counters, self.gauges, self.histograms)
+            self.counters, self.gauges, self.histograms = {}, {}, {}
+        return recorded
+
+    def merge(self, recorded: Optional[Recorded]):
+        """Adds metrics drained from another registry, e.g. of a worker process. Counters and histograms
+           are added, gauges are replaced.
+
+        Args:
+            recorded (Optional[Recorded]): Metrics, see drain
+        """
+        if not self.enabled or recorded is None:
+            return
+        counters, gauges, histograms = recorded
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(gauges)
+            for key, other in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(other.buckets)
+                histogram.add(other)
+
+    def _after_fork(self):
+        # The parent keeps the metrics recorded before the fork, the lock may be held by another thread
+        self._lock = threading.Lock()
+        self.counters, self.gauges, self.histograms = {}, {}, {}
+
+    def cache_hit_ratios(self) -> Dict[Labels, float]:
+        """Hit ratio by cache and kind, from the counter cache_lookups_total (see SqliteLruCache.get)."""
+        lookups: Dict[Labels, List[float]] = {}
+        with self._lock:
+            for (name, labels), value in self.counters.items():
+                if name != "cache_lookups_total":
+                    continue
+                result = dict(labels).get("result")
+                key = tuple(label for label in labels if label[0] != "result")
+                hits_total = lookups.setdefault(key, [0, 0])
+                hits_total[0] += value if result == "hit" else 0
+                hits_total[1] += value
+        return {labels: hits / total for labels, (hits, total) in lookups.items() if total}
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        """All metrics in a JSON serializable form, cache hit ratios are added as gauge cache_hit_ratio.
+
+        Returns:
+            Dict[str, List[Dict[str, Any]]]: {"counters": [...], "gauges": [...], "histograms": [...]}, each
+                                             metric as {"name": str, "labels": Dict[str, str], ...}
+        """
+        hit_ratios = self.cache_hit_ratios()
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            gauges = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.gauges.items())
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": [
+                        [bound if bound != math.inf else "+Inf", count] for bound, count in histogram.cumulative()
+                    ],
+                }
+                for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])
+            ]
+        gauges.extend(
+            {"name": "cache_hit_ratio", "labels": dict(labels), "value": ratio} for labels, ratio in hit_ratios.items()
+        )
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def add_exporter(self, exporter: "Exporter"):
+        self.exporters.append(exporter)
+
+    def export(self):
+        """Writes a snapshot with every exporter. Worker processes do not export, their metrics are merged
+        into the registry of the parent process."""
+        if not self.enabled or not self.exporters or multiprocessing.parent_process() is not None:
+            return
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            exporter.export(snapshot)
+
+    def start_export(self, interval: float):
+        """Exports every interval seconds in a daemon thread, so that long running processes like the
+        service write their metrics before they exit."""
+        if self._export_thread is not None or interval <= 0:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.export()
+                except OSError as error:
+                    logging.warning(f"Export of metrics failed: {error}")
+
+        self._export_thread = threading.Thread(target=run, name="metrics-export", daemon=True)
+        self._export_thread.start()
+
+
+class Exporter:
+    """Writes metric snapshots somewhere, see MetricsRegistry.export."""
+
+    def export(self, snapshot: Dict[str, List[Dict[str, Any]]]):
+        raise NotImplementedError
+
+
+class JsonLinesExporter(Exporter):
+    """Appends every snapshot with a timestamp as one JSON line to a file.
+
+    Args:
+        path (str): Path of the JSON lines file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, snapshot: Dict[str, List[Dict[str, Any]]]):
+        with open(self.path, "a") as file:
+            file.write(json.dumps({"time": time.time(), "pid": os.getpid(), **snapshot}) + "\n")
+
+
+def _prometheus_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = (f'{key}="{_escape_label(value)}"' for key, value in sorted(labels.items()))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def prometheus_text(snapshot: Dict[str, List[Dict[str, Any]]]) -> str:
+    """Snapshot in the Prometheus text exposition format.
+
+    Args:
+        snapshot (Dict[str, List[Dict[str, Any]]]): Snapshot, see MetricsRegistry.snapshot
+
+    Returns:
+        str: Metrics with a TYPE line per metric name
+    """
+    lines: List[str] = []
+    typed = set()
+    for kind, prometheus_type in (("counters", "counter"), ("gauges", "gauge"), ("histograms", "histogram")):
+        for metric in snapshot[kind]:
+            name = metric["name"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} {prometheus_type}")
+                typed.add(name)
+            if kind != "histograms":
+                lines.append(f"{name}{_prometheus_labels(metric['labels'])} {metric['value']}")
+                continue
+            for bound, count in metric["buckets"]:
+                labels = _prometheus_labels({**metric["labels"], "le": str(bound)})
+                lines.append(f"{name}_bucket{labels} {count}")
+            lines.append(f"{name}_sum{_prometheus_labels(metric['labels'])} {metric['sum']}")
+            lines.append(f"{name}_count{_prometheus_labels(metric['labels'])} {metric['count']}")
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusExporter(Exporter):
+    """Replaces a file with the latest snapshot in the Prometheus text format, for example for the
+       textfile collector of the node exporter. The file is written atomically.
+
+    Args:
+        path (str): Path of the .prom file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, snapshot: Dict[str, List[Dict[str, Any]]]):
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as file:
+            file.write(prometheus_text(snapshot))
+        os.replace(temporary, self.path)
+
+
+def endpoint(url: str) -> str:
+    """Path of a URL with numeric segments (document ids, CIDs) replaced by ":id", used as label."""
+    return _ID_SEGMENT.sub("/:id", urlsplit(url).path) or "/"
+
+
+def record_response(service: str, response) -> Any:
+    """Counts a HTTP response by service, endpoint and status and observes its latency (until the
+       response headers arrived) in http_request_seconds. Returns the response.
+
+    Args:
+        service (str): Service name, e.g. "pubchem"
+        response (requests.Response): Response
+
+    Returns:
+        requests.Response: The response
+    """
+    registry = _default_registry
+    if not registry.enabled:
+        return response
+    labels = {"service": service, "method": response.request.method, "endpoint": endpoint(response.request.url)}
+    registry.increment("http_requests_total", status=response.status_code, **labels)
+    registry.observe("http_request_seconds", response.elapsed.total_seconds(), **labels)
+    return response
+
+
+def timed(name: str, **labels) -> Callable[[Callable], Callable]:
+    """Decorator observing the seconds of every call in the histogram name of the shared registry."""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _default_registry.enabled:
+                return func(*args, **kwargs)
+            with _default_registry.timer(name, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+_default_registry = MetricsRegistry(enabled=bool(METRICS))
+if METRICS_JSONL:
+    _default_registry.add_exporter(JsonLinesExporter(METRICS_JSONL))
+if METRICS_PROMETHEUS:
+    _default_registry.add_exporter(PrometheusExporter(METRICS_PROMETHEUS))
+atexit.register(_default_registry.export)
+os.register_at_fork(after_in_child=_default_registry._after_fork)
+if _default_registry.enabled and _default_registry.exporters and multiprocessing.parent_process() is None:
+    _default_registry.start_export(METRICS_EXPORT_INTERVAL)
+
+
+def get_metrics() -> MetricsRegistry:
+    """Returns the registry shared by the instrumented modules, enabled if the environment variable
+    METRICS is set."""
+    return _default_registry
+
+
+def increment(name: str, value: float = 1, **labels):
+    _default_registry.increment(name, value, **labels)
+
+
+def set_gauge(name: str, value: float, **labels):
+    _default_registry.set_gauge(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    _default_registry.observe(name, value, **labels)
+
+
+def timer(name: str, **labels) -> ContextManager:
+    return _default_registry.timer(name, **labels)
+
+
+def call_recording(func: Callable[..., Any], *args) -> Tuple[Any, Optional[Recorded]]:
+    """Calls func in a worker process and returns its result with the metrics the worker recorded since
+       its last call, which the parent adds with merge_recorded. Use functools.partial to submit it.
+
+    Args:
+        func (Callable[..., Any]): Picklable function
+        *args: Arguments of func
+
+    Returns:
+        Tuple[Any, Optional[Recorded]]: Result of func and the recorded metrics
+    """
+    return func(*args), _default_registry.drain()
+
+
+def merge_recorded(results: Iterable[Tuple[Any, Optional[Recorded]]]) -> Iterator[Any]:
+    """Merges the metrics of the results of call_recording into the shared registry and yields the results.
+
+    Args:
+        results (Iterable[Tuple[Any, Optional[Recorded]]]): Results of call_recording
+
+    Returns:
+        Iterator[Any]: Results of the called function
+    """
+    for value, recorded in results:
+        _default_registry.merge(recorded)
+        yield value
+
+
+if __name__ == "__main__":
+    registry = MetricsRegistry(enabled=True)
+    with registry.timer("stage_seconds", stage="example"):
+        time.sleep(0.01)
+    registry.increment("cache_lookups_total", cache="pubchem", kind="cids", result="hit")
+    registry.increment("cache_lookups_total", cache="pubchem", kind="cids", result="miss")
+    print(prometheus_text(registry.snapshot()))
@@ -0,0 +1,454 @@
+import argparse
+import array as pyarray
+import csv
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import numpy as np
+from collections import defaultdict
+from typing import IO, Any, Callable, Container, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from cache import PubChemCache
+from definitions import NAME_INDEX
+
+NAME_INDEX_MAGIC: bytes = b"CHEMNIX\x01"
+NAME_INDEX_ALIGNMENT: int = 64
+# CIDs kept per name, PubChem name searches use only the first ones
+NAME_INDEX_MAX_CIDS: int = 10
+# Synonyms kept per CID, search_pubchem returns the first five
+NAME_INDEX_SYNONYMS: int = 5
+# Postings sorted in memory per run file of build_name_index
+NAME_INDEX_RUN_SIZE: int = 1 << 20
+# Name hash, is no title, rank among the synonyms of the CID, CID and length of the name of a run file posting
+_POSTING = struct.Struct("<QBqqI")
+# Values buffered by _ArrayWriter before they are written
+_WRITE_CHUNK_SIZE: int = 1 << 16
+# Text fields per CID in the text table
+_TEXT_FIELDS: Tuple[str, ...] = ("IUPACName", "MolecularFormula", "Synonyms")
+
+
+def name_variants(name: str) -> List[str]:
+    """Spelling variants of a chemical name, which are tried in order until PubChem finds the compound:
+       the name itself, "." replaced by "," and spaces removed.
+
+    Args:
+        name (str): Chemical name
+
+    Returns:
+        List[str]: Distinct name variants
+    """
+    name = " ".join(name.split())
+    variants = [name]
+    if "." in name:
+        variants.append(name.replace(".", ","))
+    if " " in name:
+        variants.append(name.replace(" ", ""))
+    return list(dict.fromkeys(variants))
+
+
+def name_hash(name: str) -> int:
+    """64 bit key of a normalized name (see PubChemCache.normalize_name)."""
+    return int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class NameIndex:
+    """Offline name -> CID dictionary with the properties of the CIDs, built from PubChem bulk files with
+       build_name_index. The file is memory-mapped, so opening is instant and processes share its pages.
+       Names are looked up by binary search in the sorted table of their 64 bit hashes and compared with
+       the stored name, CIDs by binary search in the sorted CID table.
+
+    Args:
+        path (str, optional): Path of the index file. Defaults to NAME_INDEX.
+    """
+
+    ARRAYS: Tuple[str, ...] = (
+        "name_hash",
+        "name_offsets",
+        "name_bytes",
+        "posting_offsets",
+        "postings",
+        "cid",
+        "molecular_weight",
+        "text_offsets",
+        "text_bytes",
+    )
+
+    def __init__(self, path: str = NAME_INDEX):
+        self.path = path
+        with open(path, "rb") as file:
+            self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._buffer[: len(NAME_INDEX_MAGIC)] != NAME_INDEX_MAGIC:
+            raise ValueError(f"{path} is not a name index file.")
+        (header_length,) = struct.unpack_from("<Q", self._buffer, len(NAME_INDEX_MAGIC))
+        header_start = len(NAME_INDEX_MAGIC) + 8
+        self.header = json.loads(self._buffer[header_start : header_start + header_length].decode("utf-8"))
+        data_start = _align(header_start + header_length)
+        for array, layout in self.header["arrays"].items():
+            setattr(
+                self,
+                array,
+                np.frombuffer(
+                    self._buffer,
+                    dtype=np.dtype(layout["dtype"]),
+                    count=layout["count"],
+                    offset=data_start + layout["offset"],
+                ),
+            )
+
+    def __len__(self) -> int:
+        return len(self.name_hash)
+
+    def _name(self, i: int) -> bytes:
+        return self.name_bytes[self.name_offsets[i] : self.name_offsets[i + 1]].tobytes()
+
+    def cids(self, name: str) -> Optional[List[int]]:
+        """CIDs of a name, without variants.
+
+        Args:
+            name (str): Chemical name
+
+        Returns:
+            Optional[List[int]]: CIDs in PubChem order, None if the name is not in the index
+        """
+        name = PubChemCache.normalize_name(name)
+        key = np.uint64(name_hash(name))
+        encoded = name.encode("utf-8")
+        i = int(np.searchsorted(self.name_hash, key))
+        # Names with the same hash are adjacent
+        while i < len(self.name_hash) and self.name_hash[i] == key:
+            if self._name(i) == encoded:
+                return self.postings[self.posting_offsets[i] : self.posting_offsets[i + 1]].tolist()
+            i += 1
+        return None
+
+    def resolve(self, name: str) -> List[int]:
+        """CIDs of the first name variant in the index, see name_variants.
+
+        Args:
+            name (str): Chemical name
+
+        Returns:
+            List[int]: CIDs, empty if no variant is in the index
+        """
+        for variant in name_variants(name):
+            cids = self.cids(variant)
+            if cids:
+                return cids
+        return []
+
+    def properties(self, cid: int) -> Optional[Dict[str, Any]]:
+        """Properties of a CID as a row of a PUG-REST property table, with its first synonyms.
+
+        Args:
+            cid (int): PubChem Identifier
+
+        Returns:
+            Optional[Dict[str, Any]]: {"CID", "IUPACName", "MolecularFormula", "MolecularWeight", "Synonyms"},
+                                      None if the CID has no properties in the index
+        """
+        i = int(np.searchsorted(self.cid, cid))
+        if i == len(self.cid) or self.cid[i] != cid:
+            return None
+        start = len(_TEXT_FIELDS) * i
+        bounds = self.text_offsets[start : start + len(_TEXT_FIELDS) + 1]
+        texts = [self.text_bytes[a:b].tobytes().decode("utf-8") for a, b in zip(bounds[:-1], bounds[1:])]
+        weight = float(self.molecular_weight[i])
+        row: Dict[str, Any] = {"CID": cid, **dict(zip(_TEXT_FIELDS, texts))}
+        row["IUPACName"] = row["IUPACName"] or None
+        row["MolecularFormula"] = row["MolecularFormula"] or None
+        row["MolecularWeight"] = None if math.isnan(weight) else weight
+        row["Synonyms"] = row["Synonyms"].split("\n") if row["Synonyms"] else []
+        return row
+
+    def close(self):
+        for array in self.ARRAYS:
+            setattr(self, array, None)
+        self._buffer.close()
+
+
+def _align(size: int) -> int:
+    return (size + NAME_INDEX_ALIGNMENT - 1) // NAME_INDEX_ALIGNMENT * NAME_INDEX_ALIGNMENT
+
+
+def _open_text(path: str) -> IO[str]:
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def read_cid_values(path: str) -> Iterator[Tuple[int, str]]:
+    """(CID, value) rows of a tab separated PubChem bulk file, e.g. CID-Synonym-filtered or CID-Title,
+    plain or gzip compressed."""
+    with _open_text(path) as file:
+        for line in file:
+            cid, _, value = line.rstrip("\n").partition("\t")
+            if value and cid.isdigit():
+                yield int(cid), value
+
+
+def read_properties(path: str) -> Dict[int, Tuple[str, str, float]]:
+    """(IUPACName, MolecularFormula, MolecularWeight) by CID of a PUG-REST property table in CSV format,
+    e.g. downloaded from PubChem with the columns CID, IUPACName, MolecularFormula and MolecularWeight."""
+    properties = {}
+    with _open_text(path) as file:
+        for row in csv.DictReader(file):
+            weight = row.get("MolecularWeight")
+            properties[int(row["CID"])] = (
+                row.get("IUPACName") or "",
+                row.get("MolecularFormula") or "",
+                float(weight) if weight else math.nan,
+            )
+    return properties
+
+
+class _ArrayWriter:
+    """Array of 64 bit integers or bytes which is appended to a temporary file in chunks.
+
+    Args:
+        path (str): Path of the temporary file
+        typecode (str): Type code of the array module, "q", "Q" or "B"
+    """
+
+    dtypes: Dict[str, str] = {"q": "<i8", "Q": "<u8", "B": "|u1"}
+
+    def __init__(self, path: str, typecode: str):
+        self.path = path
+        self.dtype = np.dtype(self.dtypes[typecode])
+        self.count = 0
+        self._values = pyarray.array(typecode)
+        self._file = open(path, "wb")
+
+    @property
+    def nbytes(self) -> int:
+        return self.count * self.dtype.itemsize
+
+    def append(self, value: int):
+        self._values.append(value)
+        if len(self._values) >= _WRITE_CHUNK_SIZE:
+            self._flush()
+
+    def extend(self, values: Union[bytes, Iterable[int]]):
+        if isinstance(values, bytes):
+            self._values.frombytes(values)
+        else:
+            self._values.extend(values)
+        if len(self._values) >= _WRITE_CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        # The index is little-endian
+        if sys.byteorder == "big" and self._values.itemsize > 1:
+            self._values.byteswap()
+        self._values.tofile(self._file)
+        self.count += len(self._values)
+        self._values = pyarray.array(self._values.typecode)
+
+    def close(self):
+        self._flush()
+        self._file.close()
+
+
+def _write_run(postings: List[Tuple[int, bytes, bool, int, int]], path: str):
+    """Sorts postings (name hash, name, is no title, rank, CID) and writes them to a run file."""
+    postings.sort()
+    with open(path, "wb") as file:
+        for key, encoded, no_title, rank, cid in postings:
+            file.write(_POSTING.pack(key, no_title, rank, cid, len(encoded)))
+            file.write(encoded)
+    postings.clear()
+
+
+def _read_run(path: str) -> Iterator[Tuple[int, bytes, bool, int, int]]:
+    with open(path, "rb") as file:
+        while True:
+            header = file.read(_POSTING.size)
+            if not header:
+                return
+            key, no_title, rank, cid, length = _POSTING.unpack(header)
+            yield key, file.read(length), bool(no_title), rank, cid
+
+
+def _name_postings(
+    synonyms: Optional[str],
+    titles: Optional[str],
+    keep: Callable[[int], bool],
+    cid_synonyms: Dict[int, List[str]],
+    synonym_cids: Container[int],
+) -> Iterator[Tuple[int, bytes, bool, int, int]]:
+    """Postings (name hash, name, is no title, rank among the synonyms of the CID, CID) of the bulk files.
+       The synonyms of a CID are listed on consecutive lines of CID-Synonym-filtered, the first ones of
+       the CIDs in synonym_cids are collected in cid_synonyms.
+    """
+    if titles:
+        for cid, title in read_cid_values(titles):
+            if keep(cid):
+                name = PubChemCache.normalize_name(title)
+                yield name_hash(name), name.encode("utf-8"), False, 0, cid
+    if synonyms:
+        current, rank = None, 0
+        for cid, synonym in read_cid_values(synonyms):
+            if not keep(cid):
+                continue
+            if cid != current:
+                current, rank = cid, 0
+            name = PubChemCache.normalize_name(synonym)
+            yield name_hash(name), name.encode("utf-8"), True, rank, cid
+            if rank < NAME_INDEX_SYNONYMS and cid in synonym_cids:
+                cid_synonyms[cid].append(synonym.replace("\n", " "))
+            rank += 1
+
+
+def build_name_index(
+    output: str = NAME_INDEX,
+    synonyms: Optional[str] = None,
+    titles: Optional[str] = None,
+    properties: Optional[str] = None,
+    all_cids: bool = False,
+    max_cids: int = NAME_INDEX_MAX_CIDS,
+    run_size: int = NAME_INDEX_RUN_SIZE,
+) -> Dict[str, int]:
+    """Builds a NameIndex file from PubChem bulk files. The CIDs of a name are ordered like PubChem
+       name searches: CIDs with the name as title first, then by the rank of the name among the synonyms
+       of the CID and by CID. The bulk files are streamed: their postings are sorted in runs of run_size,
+       which are written to temporary files next to the output and merged, so that only the property
+       table and the first synonyms of its CIDs are kept in memory.
+
+    Args:
+        output (str, optional): Path of the index file. Defaults to NAME_INDEX.
+        synonyms (str, optional): CID-Synonym-filtered file. Defaults to None.
+        titles (str, optional): CID-Title file. Defaults to None.
+        properties (str, optional): Property table CSV, see read_properties. Defaults to None.
+        all_cids (bool, optional): Index the names of CIDs without properties, which saves the name
+                                   search but not the property request. Defaults to False (only CIDs
+                                   with properties if a property table is given).
+        max_cids (int, optional): CIDs kept per name. Defaults to NAME_INDEX_MAX_CIDS.
+        run_size (int, optional): Postings sorted in memory per run. Defaults to NAME_INDEX_RUN_SIZE.
+
+    Returns:
+        Dict[str, int]: Number of names and CIDs in the index
+    """
+    property_rows = read_properties(properties) if properties else {}
+    keep = (lambda cid: True) if all_cids or not property_rows else property_rows.__contains__
+    cid_synonyms: Dict[int, List[str]] = defaultdict(list)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as directory:
+        runs: List[str] = []
+        postings: List[Tuple[int, bytes, bool, int, int]] = []
+        for posting in _name_postings(synonyms, titles, keep, cid_synonyms, property_rows):
+            postings.append(posting)
+            if len(postings) >= run_size:
+                runs.append(os.path.join(directory, f"run{len(runs)}"))
+                _write_run(postings, runs[-1])
+        if postings:
+            runs.append(os.path.join(directory, f"run{len(runs)}"))
+            _write_run(postings, runs[-1])
+
+        files = {
+            "name_hash": _ArrayWriter(os.path.join(directory, "name_hash"), "Q"),
+            "name_offsets": _ArrayWriter(os.path.join(directory, "name_offsets"), "q"),
+            "name_bytes": _ArrayWriter(os.path.join(directory, "name_bytes"), "B"),
+            "posting_offsets": _ArrayWriter(os.path.join(directory, "posting_offsets"), "q"),
+            "postings": _ArrayWriter(os.path.join(directory, "postings"), "q"),
+        }
+        files["name_offsets"].append(0)
+        files["posting_offsets"].append(0)
+        name_length, posting_count = 0, 0
+        merged = heapq.merge(*(_read_run(run) for run in runs))
+        # Postings of a name are adjacent, ordered by is no title, rank and CID
+        for (key, encoded), group in itertools.groupby(merged, key=lambda posting: posting[:2]):
+            cids = list(itertools.islice(dict.fromkeys(posting[4] for posting in group), max_cids))
+            files["name_hash"].append(key)
+            files["name_bytes"].extend(encoded)
+            name_length += len(encoded)
+            files["name_offsets"].append(name_length)
+            files["postings"].extend(cids)
+            posting_count += len(cids)
+            files["posting_offsets"].append(posting_count)
+        for file in files.values():
+            file.close()
+
+        sorted_cids = sorted(property_rows)
+        text_offsets, texts = [0], []
+        for cid in sorted_cids:
+            iupac_name, formula, _ = property_rows[cid]
+            for text in (iupac_name, formula, "\n".join(cid_synonyms.get(cid, []))):
+                encoded = text.encode("utf-8")
+                texts.append(encoded)
+                text_offsets.append(text_offsets[-1] + len(encoded))
+        arrays: Dict[str, Union[np.ndarray, _ArrayWriter]] = {
+            **files,
+            "cid": np.array(sorted_cids, dtype="<i8"),
+            "molecular_weight": np.array([property_rows[cid][2] for cid in sorted_cids], dtype="<f8"),
+            "text_offsets": np.array(text_offsets, dtype="<i8"),
+            "text_bytes": np.frombuffer(b"".join(texts), dtype=np.uint8),
+        }
+        layout: Dict[str, Dict[str, Any]] = {}
+        offset = 0
+        for array_name in NameIndex.ARRAYS:
+            values = arrays[array_name]
+            count = values.count if isinstance(values, _ArrayWriter) else len(values)
+            layout[array_name] = {"dtype": values.dtype.str, "count": count, "offset": offset}
+            offset += _align(values.nbytes)
+        header = json.dumps({"arrays": layout}).encode("utf-8")
+        data_start = _align(len(NAME_INDEX_MAGIC) + 8 + len(header))
+        with open(output, "wb") as file:
+            file.write(NAME_INDEX_MAGIC)
+            file.write(struct.pack("<Q", len(header)))
+            file.write(header)
+            file.write(b"\0" * (data_start - file.tell()))
+            for array_name in NameIndex.ARRAYS:
+                values = arrays[array_name]
+                if isinstance(values, _ArrayWriter):
+                    with open(values.path, "rb") as source:
+                        shutil.copyfileobj(source, file)
+                else:
+                    file.write(values.tobytes())
+                file.write(b"\0" * (_align(values.nbytes) - values.nbytes))
+    return {"names": files["name_hash"].count, "cids": len(sorted_cids)}
+
+
+_default_index: Optional[NameIndex] = None
+_default_index_loaded: bool = False
+_default_index_lock = threading.Lock()
+
+
+def get_name_index() -> Optional[NameIndex]:
+    """Returns the process wide name index in NAME_INDEX, None if no index was built.
+
+    Returns:
+        Optional[NameIndex]: Shared name index.
+    """
+    global _default_index, _default_index_loaded
+    with _default_index_lock:
+        if not _default_index_loaded:
+            try:
+                _default_index = NameIndex()
+            except FileNotFoundError:
+                _default_index = None
+            _default_index_loaded = True
+        return _default_index
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Build the offline name -> CID index.")
+    argument_parser.add_argument("--synonyms", help="CID-Synonym-filtered file (.gz)")
+    argument_parser.add_argument("--titles", help="CID-Title file (.gz)")
+    argument_parser.add_argument(
+        "--properties", help="CSV with the columns CID, IUPACName, MolecularFormula and MolecularWeight"
+    )
+    argument_parser.add_argument("--all-cids", action="store_true", help="Also index CIDs without properties")
+    argument_parser.add_argument("--output", default=NAME_INDEX)
+    arguments = argument_parser.parse_args()
+    print(
+        build_name_index(
+            arguments.output, arguments.synonyms, arguments.titles, arguments.properties, arguments.all_cids
+        )
+    )
@@ -0,0 +1,251 @@
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import chemdataextractor
+from chemdataextractor.doc import Document, Figure, Sentence
+from chemdataextractor.doc.element import BaseElement
+from chemdataextractor.model import Compound
+from functools import partial
+from cache import NerCache
+from metrics import call_recording, merge_recorded
+from parser import preload_models
+
+# Elements (paragraphs, headings, captions, ...) per shard of a document
+NER_SHARD_SIZE: int = 200
+
+# Version of the cached sentence entities, increase when sentence_entities changes
+NER_VERSION: str = f"{chemdataextractor.__version__}-1"
+
+_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_pool_workers: int = 0
+_pool_lock = threading.Lock()
+
+
+def get_ner_pool(workers: Optional[int] = None) -> concurrent.futures.ProcessPoolExecutor:
+    """Returns the process pool for sharded NER. The CDE models are loaded before the workers are forked,
+       so that they are shared copy-on-write. The pool is created again if the number of workers changes.
+
+    Args:
+        workers (int, optional): Number of worker processes. Defaults to the number of cores.
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: Process pool
+    """
+    global _pool, _pool_workers
+    workers = workers or os.cpu_count() or 1
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown()
+            preload_models()
+            if "fork" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("fork")
+            else:
+                context = multiprocessing.get_context()
+            _pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _pool_workers = workers
+        return _pool
+
+
+def _shard_records(shard: List[BaseElement]) -> List[Dict[str, Any]]:
+    """Serialized records of a shard of elements."""
+    return Document(*shard, models=[Compound]).records.serialize()
+
+
+def sentence_entities(text: str) -> Dict[str, Any]:
+    """Extracts the chemical entities of a single sentence, independent of the rest of the document.
+
+    Args:
+        text (str): Normalized sentence, see NerCache.normalize_sentence
+
+    Returns:
+        Dict[str, Any]: {"records": serialized Compound records, "cems": [[start, end, text], ...] chemical
+                        entity mentions with character offsets in the sentence}
+    """
+    sentence = Sentence(text)
+    records = Document(sentence, models=[Compound]).records.serialize()
+    return {"records": records, "cems": [[cem.start, cem.end, cem.text] for cem in sentence.cems]}
+
+
+def _sentences_entities(texts: List[str]) -> List[Dict[str, Any]]:
+    return [sentence_entities(text) for text in texts]
+
+
+def _element_sentences(element: BaseElement) -> Optional[List[Sentence]]:
+    """Sentences of text elements and figure captions, None for elements extracted as a whole (tables)."""
+    if isinstance(element, Figure):
+        element = element.caption
+    return getattr(element, "sentences", None)
+
+
+def merge_records(record_lists: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Merges the serialized records of the shards of a document. Compound records sharing a name or
+       a label are merged into the first of them, names and labels are united in order of occurence.
+       A record sharing names or labels with several merged records joins all of them into one.
+
+    Args:
+        record_lists (List[List[Dict[str, Any]]]): Serialized records per shard in document order
+
+    Returns:
+        List[Dict[str, Any]]: Serialized records without duplicates
+    """
+    # Joined records are replaced by None and removed at the end
+    merged: List[Optional[Dict[str, Any]]] = []
+    # Position in merged of each compound name and label, and the names and labels of each position
+    owners: Dict[Tuple[str, str], int] = {}
+    owned: Dict[int, List[Tuple[str, str]]] = {}
+    for records in record_lists:
+        for record in records:
+            compound = record.get("Compound")
+            if not compound:
+                if record not in merged:
+                    merged.append(record)
+                continue
+            keys = [("name", name) for name in compound.get("names", [])]
+            keys.extend(("label", label) for label in compound.get("labels", []))
+            positions = sorted({owners[key] for key in keys if key in owners})
+            if not positions:
+                position = len(merged)
+                merged.append({"Compound": {field: _copy(value) for field, value in compound.items()}})
+            else:
+                position = positions[0]
+                target = merged[position]["Compound"]
+                for other in positions[1:]:
+                    _merge_compound(target, merged[other]["Compound"])
+                    merged[other] = None
+                    for key in owned.pop(other):
+                        owners[key] = position
+                        owned[position].append(key)
+                _merge_compound(target, compound)
+            for key in keys:
+                if key not in owners:
+                    owners[key] = position
+                    owned.setdefault(position, []).append(key)
+    return [record for record in merged if record is not None]
+
+
+def _merge_compound(target: Dict[str, Any], compound: Dict[str, Any]):
+    """Unites the list fields of compound into target and adds the fields missing in target."""
+    for field, value in compound.items():
+        if isinstance(value, list):
+            target.setdefault(field, [])
+            target[field].extend(item for item in value if item not in target[field])
+        elif field not in target:
+            target[field] = _copy(value)
+
+
+def _copy(value: Any) -> Any:
+    return list(value) if isinstance(value, list) else value
+
+
+def extract_records(
+    elements: List[BaseElement],
+    shard_size: Optional[int] = NER_SHARD_SIZE,
+    workers: Optional[int] = None,
+    cache: Optional[NerCache] = None,
+) -> List[Dict[str, Any]]:
+    """Extracts the serialized Compound records of the elements of a document. Documents with more than
+       shard_size elements are split into shards, which are processed in parallel by the NER process
+       pool, and the records of the shards are merged with merge_records.
+
+    Args:
+        elements (List[BaseElement]): Elements of a document, see TeiXmlReader.parse_elements
+        shard_size (int, optional): Elements per shard, None to process the document as a whole.
+                                    Defaults to NER_SHARD_SIZE.
+        workers (int, optional): Number of worker processes. Defaults to the number of cores.
+        cache (NerCache, optional): Extract the entities sentence by sentence and look them up in the
+                                    cache first, see extract_records_cached. Defaults to None.
+
+    Returns:
+        List[Dict[str, Any]]: Serialized records, as Document.records.serialize()
+    """
+    if cache is not None:
+        return extract_records_cached(elements, cache, shard_size, workers)
+    if not shard_size or len(elements) <= shard_size:
+        return _shard_records(elements)
+    shards = [elements[i : i + shard_size] for i in range(0, len(elements), shard_size)]
+    record_lists = merge_recorded(get_ner_pool(workers).map(partial(call_recording, _shard_records), shards))
+    return merge_records(list(record_lists))
+
+
+def extract_records_cached(
+    elements: List[BaseElement],
+    cache: NerCache,
+    shard_size: Optional[int] = NER_SHARD_SIZE,
+    workers: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Extracts the serialized Compound records of the elements of a document sentence by sentence. Each
+       sentence is looked up in the cache before it is tagged, only missing sentences are processed by
+       CDE (in shards of shard_size sentences on the NER process pool if there are more) and stored.
+       Records are extracted without the context of the surrounding sentences, compounds mentioned in
+       several sentences are merged with merge_records. Tables are extracted as a whole without cache.
+
+    Args:
+        elements (List[BaseElement]): Elements of a document, see TeiXmlReader.parse_elements
+        cache (NerCache): Cache of sentence entities, see get_ner_cache
+        shard_size (int, optional): Missing sentences per shard, None to process them in this process.
+                                    Defaults to NER_SHARD_SIZE.
+        workers (int, optional): Number of worker processes. Defaults to the number of cores.
+
+    Returns:
+        List[Dict[str, Any]]: Serialized records in order of the sentences
+    """
+    # Sets the document and the models of the elements
+    Document(*elements, models=[Compound])
+    # Per element either the normalized texts of its sentences or the element itself
+    parts: List[Tuple[Optional[List[str]], BaseElement]] = []
+    entities: Dict[str, Dict[str, Any]] = {}
+    missing: List[str] = []
+    for element in elements:
+        sentences = _element_sentences(element)
+        if sentences is None:
+            parts.append((None, element))
+            continue
+        texts = [cache.normalize_sentence(sentence.text) for sentence in sentences]
+        parts.append((texts, element))
+        for text in texts:
+            if text and text not in entities:
+                cached = cache.get_sentence(text)
+                if cached is None:
+                    missing.append(text)
+                    # Placeholder for sentences occuring more than once in the document
+                    entities[text] = {}
+                else:
+                    entities[text] = cached
+
+    if shard_size and len(missing) > shard_size:
+        shards = [missing[i : i + shard_size] for i in range(0, len(missing), shard_size)]
+        shard_results = get_ner_pool(workers).map(partial(call_recording, _sentences_entities), shards)
+        results = [result for shard in merge_recorded(shard_results) for result in shard]
+    else:
+        results = _sentences_entities(missing)
+    entities.update(zip(missing, results))
+    if missing:
+        cache.set_sentences(dict(zip(missing, results)))
+
+    record_lists: List[List[Dict[str, Any]]] = []
+    for texts, element in parts:
+        if texts is None:
+            record_lists.append(_shard_records([element]))
+        else:
+            record_lists.extend(entities[text]["records"] for text in texts if text)
+    return merge_records(record_lists)
+
+
+_ner_cache: Optional[NerCache] = None
+_ner_cache_lock = threading.Lock()
+
+
+def get_ner_cache() -> NerCache:
+    """Returns the process wide cache of sentence entities stored at NER_CACHE.
+
+    Returns:
+        NerCache: Shared cache object for NER_VERSION.
+    """
+    global _ner_cache
+    with _ner_cache_lock:
+        if _ner_cache is None:
+            _ner_cache = NerCache(NER_VERSION)
+        return _ner_cache
@@ -0,0 +1,158 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import queue
+import threading
+from functools import partial
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Optional
+from metrics import call_recording, increment, merge_recorded, timer
+
+
+THREAD: str = "thread"
+PROCESS: str = "process"
+# Marks the end of the stream in a stage queue
+_END = object()
+
+
+class Stage(NamedTuple):
+    """Stage of a pipeline.
+
+    Args:
+        name (str): Name of the stage.
+        func (Callable[[Any], Any]): Function applied to each item, has to be picklable for process stages.
+        workers (int, optional): Number of concurrent calls of func. Defaults to 1.
+        kind (str, optional): THREAD for I/O bound stages, PROCESS for CPU bound stages. Defaults to THREAD.
+        queue_size (int, optional): Capacity of the input queue of the stage. Defaults to 2 * workers.
+    """
+
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+    kind: str = THREAD
+    queue_size: Optional[int] = None
+
+
+class PipelineResult(NamedTuple):
+    """Result of an item which went through the pipeline.
+
+    Args:
+        key (Any): Item from the source iterable.
+        value (Any): Output of the last stage, None if a stage failed.
+        error (Optional[BaseException]): Exception raised by the failed stage.
+        stage (Optional[str]): Name of the failed stage.
+    """
+
+    key: Any
+    value: Any
+    error: Optional[BaseException] = None
+    stage: Optional[str] = None
+
+
+def run_pipeline(
+    source: Iterable[Any], stages: List[Stage], mp_context: Optional[multiprocessing.context.BaseContext] = None
+) -> Iterator[PipelineResult]:
+    """Streams the items of source through the stages. Each stage runs with its own concurrency and
+       reads from a bounded queue, so a slow stage blocks the stages before it (backpressure) and the
+       memory use does not depend on the number of items. Results are yielded as soon as an item
+       leaves the last stage, their order may differ from the source. If iterating source fails, the
+       items read before are still processed and the error is raised after their results.
+
+    Args:
+        source (Iterable[Any]): Items to process, consumed lazily.
+        stages (List[Stage]): Stages in processing order.
+        mp_context (multiprocessing.context.BaseContext, optional): Context of the process pools.
+
+    Raises:
+        Exception: The error raised by source
+
+    Returns:
+        Iterator[PipelineResult]: Results in order of completion
+    """
+    queues = [queue.Queue(maxsize=stage.queue_size or 2 * stage.workers) for stage in stages]
+    results: queue.Queue = queue.Queue(maxsize=2 * stages[-1].workers)
+    queues.append(results)
+    stop = threading.Event()
+    executors = []
+    threads = []
+    source_errors: List[Exception] = []
+
+    def put(target: queue.Queue, item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed():
+        # The end marker is always sent, otherwise the stages and the consumer wait forever
+        try:
+            for item in source:
+                if not put(queues[0], (item, item)):
+                    return
+        except Exception as error:
+            logging.warning(f"Pipeline source failed: {error}")
+            increment("pipeline_failures_total", stage="source")
+            source_errors.append(error)
+        finally:
+            put(queues[0], _END)
+
+    def work(index: int, stage: Stage, executor: Optional[concurrent.futures.Executor], remaining: List[int]):
+        input_queue, output_queue = queues[index], queues[index + 1]
+        while not stop.is_set():
+            entry = input_queue.get()
+            if entry is _END:
+                break
+            key, value = entry
+            if isinstance(value, PipelineResult):
+                put(output_queue, (key, value))
+                continue
+            try:
+                # Timed in the parent, so that stages running in worker processes are included
+                with timer("pipeline_stage_seconds", stage=stage.name):
+                    if executor is not None:
+                        result = executor.submit(partial(call_recording, stage.func), value).result()
+                        value = next(merge_recorded([result]))
+                    else:
+                        value = stage.func(value)
+            except Exception as error:
+                logging.warning(f"Stage {stage.name} failed for {key}: {error}")
+                increment("pipeline_failures_total", stage=stage.name)
+                value = PipelineResult(key, None, error, stage.name)
+            put(output_queue, (key, value))
+        # Pass the end marker to the other workers of the stage, the last one passes it downstream
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            put(output_queue, _END)
+        else:
+            put(input_queue, _END)
+
+    lock = threading.Lock()
+    for index, stage in enumerate(stages):
+        executor = None
+        if stage.kind == PROCESS:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=stage.workers, mp_context=mp_context)
+            executors.append(executor)
+        remaining = [stage.workers]
+        for _ in range(stage.workers):
+            threads.append(threading.Thread(target=work, args=(index, stage, executor, remaining), daemon=True))
+    threads.append(threading.Thread(target=feed, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            entry = results.get()
+            if entry is _END:
+                break
+            key, value = entry
+            yield value if isinstance(value, PipelineResult) else PipelineResult(key, value)
+        if source_errors:
+            raise source_errors[0]
+    finally:
+        stop.set()
+        for executor in executors:
+            executor.shutdown(wait=False)
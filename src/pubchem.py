@@ -1,61 +1,573 @@
-import pubchempy as pcp
 import requests as r
-from typing import Any, List, Dict, Tuple
+from typing import TYPE_CHECKING, Any, List, Dict, NamedTuple, Optional, Set, Tuple
+from definitions import PUBCHEM_API_BASE
 from utils import create_session
+from cache import PubChemCache, get_pubchem_cache
+from throttle import SharedTokenBucket, CircuitBreaker, request_with_backoff
+from metrics import increment, timed, timer
+from name_index import get_name_index, name_variants
+from formula import formula_properties, looks_like_formula
+import concurrent.futures
 import base64
+import re
 
+if TYPE_CHECKING:
+    from image_store import ImageStore
 
 PROPERTIES: List[str] = ["iupac_name", "cid", "elements", "molecular_weight", "molecular_formula"]
-PUBCHEM_COMPOUND_URL: str = "https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/"
+PUBCHEM_REST_URL: str = PUBCHEM_API_BASE + "/compound/"
+PUBCHEM_COMPOUND_URL: str = PUBCHEM_REST_URL + "cid/"
+# PUG-REST property table columns of PROPERTIES ("elements" is derived from the molecular formula)
+PROPERTY_COLUMNS: Dict[str, str] = {
+    "iupac_name": "IUPACName",
+    "molecular_weight": "MolecularWeight",
+    "molecular_formula": "MolecularFormula",
+}
+PUBCHEM_BATCH_SIZE: int = 100
+ELEMENT_PATTERN = re.compile(r"[A-Z][a-z]?")
+# PubChem allows 5 requests per second, all threads and processes share the limiter
+PUBCHEM_REQUESTS_PER_SECOND: float = 5
+PUBCHEM_THREADS: int = 8
+PUBCHEM_RATE_LIMITER = SharedTokenBucket("pubchem", PUBCHEM_REQUESTS_PER_SECOND)
+PUBCHEM_CIRCUIT_BREAKER = CircuitBreaker(failure_threshold=10, reset_timeout=60)
 
 
-def get_structure_img(cid: int, session: r.Session) -> str:
-    """Get image of the structure of a chemical entity by cid from PubChem database.
+def pubchem_request(session: r.Session, method: str, url: str, **kwargs) -> r.Response:
+    """Send a rate limited request to PubChem, which is retried with backoff if PubChem throttles.
+
+    Args:
+        session (r.Session): requests.Session object for the request
+        method (str): HTTP method
+        url (str): PUG-REST URL
+        **kwargs: Arguments for session.request
+
+    Returns:
+        r.Response: PubChem response
+    """
+    return request_with_backoff(
+        session,
+        method,
+        url,
+        limiter=PUBCHEM_RATE_LIMITER,
+        breaker=PUBCHEM_CIRCUIT_BREAKER,
+        service="pubchem",
+        **kwargs,
+    )
+
+
+def fetch_structure_png(cid: int, session: r.Session) -> Optional[bytes]:
+    """Download the PNG image of the structure of a chemical entity by cid from PubChem database.
+
+    Args:
+        cid (int): PubChem Identifier for chemical
+        session (r.Session): requests.Session object for the GET request
+
+    Returns:
+        Optional[bytes]: PNG file, None if the download failed
+    """
+    try:
+        response = pubchem_request(session, "GET", f"{PUBCHEM_COMPOUND_URL}{str(cid)}/PNG")
+        response.raise_for_status()
+    except r.exceptions.RequestException:
+        return None
+    return response.content
+
+
+def get_structure_img(cid: int, session: r.Session, store: Optional["ImageStore"] = None) -> str:
+    """Get image of the structure of a chemical entity by cid from PubChem database. The PNG file is
+       kept in the image store, which also serves the lazy StructureImage handles.
 
     Args:
         cid (str): PubChem Identifier for chemical
         session (r.Session): requests.Session object for the GET request
+        store (ImageStore, optional): Store of the PNG files. Defaults to the shared image store.
 
     Returns:
         str: Base64 encoded string of the image
     """
-    try:
-        response = session.get(url=f"{PUBCHEM_COMPOUND_URL}{str(cid)}/PNG")
-        img = str(base64.b64encode(response.content))[3:-1]
-    except:
+    # image_store imports this module
+    from image_store import get_image_store
+
+    store = store if store is not None else get_image_store()
+    png = store.fetch(cid, session)
+    if png is None:
         return None
+    img = str(base64.b64encode(png))[3:-1]
     return img
 
 
+def get_structure_imgs(
+    cids: List[Optional[int]],
+    session: r.Session,
+    store: Optional["ImageStore"] = None,
+    num_threads: int = PUBCHEM_THREADS,
+) -> List[str]:
+    """Get images of the structures of many chemical entities concurrently, see get_structure_img.
+
+    Args:
+        cids (List[Optional[int]]): PubChem Identifiers, None gives no image
+        session (r.Session): requests.Session object for the GET requests
+        store (ImageStore, optional): Store of the PNG files. Defaults to the shared image store.
+        num_threads (int, optional): Number of threads. Defaults to PUBCHEM_THREADS.
+
+    Returns:
+        List[str]: Base64 encoded strings of the images in the order of cids
+    """
+    if not cids:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(num_threads, len(cids))) as executor:
+        return list(executor.map(lambda cid: get_structure_img(cid, session, store) if cid else None, cids))
+
+
+def _get_cached_compound(
+    cid: int, session: r.Session, cache: PubChemCache
+) -> Optional[Tuple[List[str], Dict[str, Any], str]]:
+    """Build a search result from the cache, if properties and synonyms of the cid are cached.
+
+    Args:
+        cid (int): PubChem Identifier for chemical
+        session (r.Session): requests.Session object for a missing structure image
+        cache (PubChemCache): PubChem cache
+
+    Returns:
+        Optional[Tuple[List[str], Dict[str, Any], str]]: (synonyms, properties, image) or None
+    """
+    properties = cache.get_properties(cid)
+    synonyms = cache.get_synonyms(cid)
+    if properties is None or synonyms is None:
+        return None
+    return synonyms, properties, get_structure_img(cid, session)
+
+
+def _get_indexed_compounds(
+    search_term: str, session: r.Session, num_results_used: int, cache: PubChemCache
+) -> Optional[List[Tuple[List[str], Dict[str, Any], str]]]:
+    """Build a search result from the offline name index (see name_index.py), if the name and the
+       properties of its first num_results_used CIDs are in the index.
+
+    Args:
+        search_term (str): Chemical name
+        session (r.Session): requests.Session object for a missing structure image
+        num_results_used (int): Number of search results to consider
+        cache (PubChemCache): PubChem cache for the structure images
+
+    Returns:
+        Optional[List[Tuple[List[str], Dict[str, Any], str]]]: List of (synonyms, properties, image) or None
+    """
+    index = get_name_index()
+    if index is None:
+        return None
+    cids = index.cids(search_term)
+    if not cids:
+        increment("name_index_lookups_total", result="miss")
+        return None
+    rows = [index.properties(cid) for cid in cids[0:num_results_used]]
+    if None in rows:
+        increment("name_index_lookups_total", result="miss")
+        return None
+    increment("name_index_lookups_total", result="hit")
+    return [
+        (row["Synonyms"], _properties_from_row(row), get_structure_img(row["CID"], session)) for row in rows
+    ]
+
+
+def _get_formula_compound(search_term: str) -> Optional[List[Tuple[List[str], Dict[str, Any], None]]]:
+    """Build a search result from a molecular formula without PubChem, see formula_properties.
+
+    Args:
+        search_term (str): Search term
+
+    Returns:
+        Optional[List[Tuple[List[str], Dict[str, Any], None]]]: [([search_term], properties, None)], None if
+                                                                the search term is not a formula
+    """
+    properties = formula_properties([search_term])[0]
+    increment("formula_lookups_total", result="hit" if properties is not None else "miss")
+    if properties is None:
+        return None
+    return [([search_term], properties, None)]
+
+
+@timed("stage_seconds", stage="search_pubchem")
 def search_pubchem(
-    search_term: str, session: r.Session, num_results_used: int = 1
+    search_term: str,
+    session: r.Session,
+    num_results_used: int = 1,
+    cache: Optional[PubChemCache] = None,
+    require_cid: bool = False,
 ) -> List[Tuple[List[str], Dict[str, Any], str]]:
     """Search PubChem with search term and extract chemical properties (specified
        in PROPERTIES), specified number of relavant synonyms and the 2D structure of the compounds found.
+       Names are looked up in the offline name index first, name resolutions (also without results),
+       properties, synonyms and images in the cache. A search term without name results which is a
+       molecular formula is resolved locally (see formula.py) instead of by a PubChem formula search,
+       unless require_cid is set.
 
     Args:
         search_term (str): Search term to use for searching PubChem database
         session (r.Session): requests.Session object for the GET request
         num_results_used (int, optional): Number of search results to consider. Defaults to 1.
+        cache (PubChemCache, optional): PubChem cache. Defaults to the shared cache.
+        require_cid (bool, optional): Search formulas on PubChem to find their CIDs. Defaults to False, a
+                                      formula gives one compound ([search_term], properties, None) without
+                                      CID, IUPAC name and image.
 
     Returns:
         List[Tuple[List[str], Dict[str, Any], str]]: List of compounds, each element consisting of: (snyonyms, properties, image)
     """
+    cache = cache if cache is not None else get_pubchem_cache()
+    compound_list = _get_indexed_compounds(search_term, session, num_results_used, cache)
+    if compound_list is not None:
+        return compound_list
+    name_cids = cache.get_cids(search_term)
+    if name_cids == [] and not require_cid:
+        formula_compound = _get_formula_compound(search_term)
+        if formula_compound is not None:
+            return formula_compound
+    # Formula search results are cached case sensitive, separately from the name search
+    cids = name_cids if name_cids != [] else cache.get_formula_cids(search_term)
+    if cids is not None:
+        compound_list = [_get_cached_compound(cid, session, cache) for cid in cids[0:num_results_used]]
+        if None not in compound_list:
+            return compound_list
+
+    # pubchempy is only needed for searches missing in the cache
+    import pubchempy as pcp
+
+    pcp.API_BASE = PUBCHEM_API_BASE
     compound_list: List[Tuple[List[str], Dict[str, Any], str]] = []
-    search_results = pcp.get_compounds(search_term, "name")[0:num_results_used]
+    search_results = []
+    if name_cids != []:
+        PUBCHEM_RATE_LIMITER.acquire()
+        with timer("pubchempy_request_seconds", namespace="name"):
+            search_results = pcp.get_compounds(search_term, "name")
+        cache.set_cids(search_term, [compound.cid for compound in search_results if compound.cid is not None])
+    if not search_results and not require_cid:
+        formula_compound = _get_formula_compound(search_term)
+        if formula_compound is not None:
+            return formula_compound
     if not search_results:
         try:
-            search_results = pcp.get_compounds(search_term, "formula")[0:num_results_used]
+            PUBCHEM_RATE_LIMITER.acquire()
+            with timer("pubchempy_request_seconds", namespace="formula"):
+                search_results = pcp.get_compounds(search_term, "formula")
+            cache.set_formula_cids(
+                search_term, [compound.cid for compound in search_results if compound.cid is not None]
+            )
         except:
             pass
-    for compound in search_results:
+    for compound in search_results[0:num_results_used]:
         properties: Dict[(str, Any)] = compound.to_dict(properties=PROPERTIES)
+        PUBCHEM_RATE_LIMITER.acquire()
         synonyms: List[str] = compound.synonyms[0:5]
+        if compound.cid is not None:
+            cache.set_properties(compound.cid, properties)
+            cache.set_synonyms(compound.cid, synonyms)
         structure_img: str = get_structure_img(properties["cid"], session)
         compound_list.append((synonyms, properties, structure_img))
     return compound_list
 
 
+def _request_cids(search_term: str, namespace: str, session: r.Session) -> List[int]:
+    """Request the CIDs of a name or formula via PUG-REST.
+
+    Args:
+        search_term (str): Name or formula
+        namespace (str): PUG-REST input namespace ("name" or "fastformula")
+        session (r.Session): requests.Session object for the POST request
+
+    Returns:
+        List[int]: CIDs found, empty if PubChem has no result
+    """
+    response = pubchem_request(
+        session, "POST", f"{PUBCHEM_REST_URL}{namespace}/cids/JSON", data={namespace: search_term}
+    )
+    if response.status_code in (400, 404):
+        return []
+    response.raise_for_status()
+    return response.json().get("IdentifierList", {}).get("CID", [])
+
+
+def _resolve_cids(name: str, session: r.Session, cache: PubChemCache) -> Optional[List[int]]:
+    """Resolve the name variants of a chemical name to CIDs, first in the offline name index, then with
+       PubChem by name and by formula.
+
+    Args:
+        name (str): Chemical name
+        session (r.Session): requests.Session object for the requests
+        cache (PubChemCache): PubChem cache
+
+    Returns:
+        Optional[List[int]]: CIDs of the first variant with results, empty if PubChem has no result and
+                             None if a request failed (or the circuit breaker was open) before
+    """
+    index = get_name_index()
+    if index is not None:
+        cids = index.resolve(name)
+        increment("name_index_lookups_total", result="hit" if cids else "miss")
+        if cids:
+            return cids
+    failed = False
+    for variant in name_variants(name):
+        try:
+            cids = _search_cids(variant, session, cache)
+        except r.exceptions.RequestException:
+            failed = True
+            continue
+        if cids:
+            return cids
+    return None if failed else []
+
+
+def _search_cids(search_term: str, session: r.Session, cache: PubChemCache) -> List[int]:
+    """CIDs of a search term by name search, by formula search if the name has no results. Name
+       results are cached case insensitive, formula results case sensitive.
+
+    Args:
+        search_term (str): Name or formula
+        session (r.Session): requests.Session object for the requests
+        cache (PubChemCache): PubChem cache
+
+    Returns:
+        List[int]: CIDs found, empty if PubChem has no result
+    """
+    cids = cache.get_cids(search_term)
+    if cids is None:
+        cids = [cid for cid in _request_cids(search_term, "name", session) if cid]
+        cache.set_cids(search_term, cids)
+    if cids:
+        return cids
+    cids = cache.get_formula_cids(search_term)
+    if cids is None:
+        cids = [cid for cid in _request_cids(search_term, "fastformula", session) if cid]
+        cache.set_formula_cids(search_term, cids)
+    return cids
+
+
+def _properties_from_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """PROPERTIES of a row of a PUG-REST property table (or of NameIndex.properties).
+
+    Args:
+        row (Dict[str, Any]): Row with the columns CID and PROPERTY_COLUMNS
+
+    Returns:
+        Dict[str, Any]: Properties
+    """
+    formula = row.get(PROPERTY_COLUMNS["molecular_formula"])
+    weight = row.get(PROPERTY_COLUMNS["molecular_weight"])
+    return {
+        "iupac_name": row.get(PROPERTY_COLUMNS["iupac_name"]),
+        "cid": row["CID"],
+        "elements": ELEMENT_PATTERN.findall(formula) if formula else [],
+        "molecular_weight": float(weight) if weight is not None else None,
+        "molecular_formula": formula,
+    }
+
+
+def _request_properties(cids: List[int], session: r.Session) -> Dict[int, Dict[str, Any]]:
+    """Request PROPERTIES of many CIDs with a single PUG-REST property table request.
+
+    Args:
+        cids (List[int]): CIDs
+        session (r.Session): requests.Session object for the POST request
+
+    Returns:
+        Dict[int, Dict[str, Any]]: Properties by cid
+    """
+    columns = ",".join(PROPERTY_COLUMNS.values())
+    response = pubchem_request(
+        session, "POST", f"{PUBCHEM_COMPOUND_URL}property/{columns}/JSON", data={"cid": ",".join(map(str, cids))}
+    )
+    response.raise_for_status()
+    return {
+        row["CID"]: _properties_from_row(row)
+        for row in response.json().get("PropertyTable", {}).get("Properties", [])
+    }
+
+
+def get_properties(
+    cids: List[int],
+    session: r.Session,
+    cache: Optional[PubChemCache] = None,
+    batch_size: int = PUBCHEM_BATCH_SIZE,
+    num_threads: int = PUBCHEM_THREADS,
+) -> Dict[int, Dict[str, Any]]:
+    """Get PROPERTIES of all CIDs from the offline name index or the cache, the others are requested
+       concurrently in batches of batch_size.
+
+    Args:
+        cids (List[int]): CIDs
+        session (r.Session): requests.Session object for the requests
+        cache (PubChemCache, optional): PubChem cache. Defaults to the shared cache.
+        batch_size (int, optional): Number of CIDs per request. Defaults to PUBCHEM_BATCH_SIZE.
+        num_threads (int, optional): Number of threads. Defaults to PUBCHEM_THREADS.
+
+    Returns:
+        Dict[int, Dict[str, Any]]: Properties by cid, CIDs without properties are missing
+    """
+    return _get_properties(cids, session, cache, batch_size, num_threads)[0]
+
+
+def _get_properties(
+    cids: List[int],
+    session: r.Session,
+    cache: Optional[PubChemCache] = None,
+    batch_size: int = PUBCHEM_BATCH_SIZE,
+    num_threads: int = PUBCHEM_THREADS,
+) -> Tuple[Dict[int, Dict[str, Any]], Set[int]]:
+    """get_properties, which also returns the CIDs of the failed requests.
+
+    Returns:
+        Tuple[Dict[int, Dict[str, Any]], Set[int]]: Properties by cid and the CIDs of failed requests
+    """
+    cache = cache if cache is not None else get_pubchem_cache()
+    index = get_name_index()
+    properties_by_cid: Dict[int, Dict[str, Any]] = {}
+    missing: List[int] = []
+    for cid in dict.fromkeys(cids):
+        row = index.properties(cid) if index is not None else None
+        if row is not None:
+            properties_by_cid[cid] = _properties_from_row(row)
+            continue
+        properties = cache.get_properties(cid)
+        if properties is None:
+            missing.append(cid)
+        else:
+            properties_by_cid[cid] = properties
+    batches = [missing[i : i + batch_size] for i in range(0, len(missing), batch_size)]
+    failed: Set[int] = set()
+    if not batches:
+        return properties_by_cid, failed
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(num_threads, len(batches))) as executor:
+        property_requests = {executor.submit(_request_properties, batch, session): batch for batch in batches}
+        for property_request in concurrent.futures.as_completed(property_requests):
+            try:
+                batch_properties = property_request.result()
+            except r.exceptions.RequestException:
+                failed.update(property_requests[property_request])
+                continue
+            for cid, properties in batch_properties.items():
+                cache.set_properties(cid, properties)
+            properties_by_cid.update(batch_properties)
+    return properties_by_cid, failed
+
+
+class NameResolution(NamedTuple):
+    """Chemical entities of the names of a document, see resolve_names.
+
+    Args:
+        chemical_list (List[List[Any]]): Chemical entities
+        failed (int): Number of names, whose lookup failed because of a request error or an open circuit
+                      breaker. Their entities are missing, but may be found when resolving again.
+    """
+
+    chemical_list: List[List[Any]]
+    failed: int
+
+
+def resolve_names(
+    names: List[str],
+    session: r.Session,
+    cache: Optional[PubChemCache] = None,
+    batch_size: int = PUBCHEM_BATCH_SIZE,
+    include_images: bool = True,
+    num_threads: int = PUBCHEM_THREADS,
+    require_cids: bool = True,
+) -> List[List[Any]]:
+    """Chemical entities of resolve_names_with_failures, see there."""
+    return resolve_names_with_failures(
+        names, session, cache, batch_size, include_images, num_threads, require_cids
+    ).chemical_list
+
+
+def resolve_names_with_failures(
+    names: List[str],
+    session: r.Session,
+    cache: Optional[PubChemCache] = None,
+    batch_size: int = PUBCHEM_BATCH_SIZE,
+    include_images: bool = True,
+    num_threads: int = PUBCHEM_THREADS,
+    require_cids: bool = True,
+) -> NameResolution:
+    """Resolve all chemical names of a document with PubChem. Names are normalized and deduplicated
+       before resolving, the properties of all found CIDs are requested in batches. Requests are sent
+       concurrently by num_threads threads, limited to PUBCHEM_REQUESTS_PER_SECOND for all processes.
+       Without require_cids, the molecular formulas among the names (see looks_like_formula) are
+       resolved locally in one pass and never sent to PubChem. Names whose lookup failed are counted,
+       so that callers do not store an incomplete result permanently.
+
+    Args:
+        names (List[str]): Chemical names in order of occurence
+        session (r.Session): requests.Session object for the requests
+        cache (PubChemCache, optional): PubChem cache. Defaults to the shared cache.
+        batch_size (int, optional): Number of CIDs per property request. Defaults to PUBCHEM_BATCH_SIZE.
+        include_images (bool, optional): Add the base64 encoded structure image. Defaults to True.
+        num_threads (int, optional): Number of threads. Defaults to PUBCHEM_THREADS.
+        require_cids (bool, optional): Resolve formulas with PubChem to find their CIDs. Defaults to True,
+                                       the CID index and the structure images need CIDs.
+
+    Returns:
+        NameResolution: List of chemical entities, one per CID or locally resolved formula, and the number
+                        of failed names. Each entity consists of: [Iupac name, CID, List of Atoms,
+                        Molecule Weight, Molecular Formula, Base64 encoded image of molecular structure].
+                        Formulas have no CID and image.
+    """
+    cache = cache if cache is not None else get_pubchem_cache()
+    unique_names: Dict[str, str] = {}
+    for name in names:
+        unique_names.setdefault(PubChemCache.normalize_name(name), name)
+
+    if not unique_names:
+        return NameResolution([], 0)
+    formula_names = [name for name in unique_names.values() if looks_like_formula(name)] if not require_cids else []
+    properties_by_formula = dict(zip(formula_names, formula_properties(formula_names)))
+    pubchem_names = [name for name in unique_names.values() if name not in properties_by_formula]
+    resolved_cids: List[Optional[List[int]]] = []
+    if pubchem_names:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(num_threads, len(pubchem_names))) as executor:
+            resolved_cids = list(executor.map(lambda name: _resolve_cids(name, session, cache), pubchem_names))
+    cid_by_name: Dict[str, int] = {name: cids[0] for name, cids in zip(pubchem_names, resolved_cids) if cids}
+    resolved = len(cid_by_name) + len(properties_by_formula)
+    failed = sum(cids is None for cids in resolved_cids)
+    increment("pubchem_names_total", resolved, result="resolved")
+    increment("pubchem_names_total", len(unique_names) - resolved - failed, result="unresolved")
+    increment("pubchem_names_total", failed, result="failed")
+    increment("formula_lookups_total", len(properties_by_formula), result="hit")
+    properties_by_cid, failed_cids = _get_properties(
+        list(cid_by_name.values()), session, cache, batch_size, num_threads
+    )
+    failed += sum(cid in failed_cids for cid in cid_by_name.values())
+
+    chemical_list: List[List[Any]] = []
+    # CIDs and formulas of the locally resolved names already in the list, a formula of a found CID
+    # (H2O of water) is not listed again
+    seen: Set[Any] = {properties["molecular_formula"] for properties in properties_by_cid.values()}
+    for name in unique_names.values():
+        if name in properties_by_formula:
+            properties = properties_by_formula[name]
+            key = properties["molecular_formula"]
+        else:
+            key = cid_by_name.get(name)
+            properties = properties_by_cid.get(key)
+        if properties is None or key in seen:
+            continue
+        seen.add(key)
+        iupac_name = properties["iupac_name"]
+        chemical = [
+            iupac_name.replace(";", " ") if iupac_name else name,
+            properties["cid"],
+            list(set(properties["elements"])),
+            properties["molecular_weight"],
+            properties["molecular_formula"],
+        ]
+        chemical_list.append(chemical)
+    if include_images:
+        images = get_structure_imgs([chemical[1] for chemical in chemical_list], session, num_threads=num_threads)
+        for chemical, image in zip(chemical_list, images):
+            chemical.append(image)
+    return NameResolution(chemical_list, failed)
+
+
 if __name__ == "__main__":
     s = create_session()
     compound = search_pubchem("water", s)
@@ -0,0 +1,316 @@
+import json
+import mmap
+import struct
+import sys
+import numpy as np
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from periodic_table import ELEMENTS, ELEMENT_INDEX
+
+# Number of uint64 words of the element bitset
+ELEMENT_WORDS: int = (len(ELEMENTS) + 63) // 64
+BATCH_MAGIC: bytes = b"CHEMBAT\x01"
+BATCH_ALIGNMENT: int = 64
+NO_CID: int = -1
+NO_STRING: int = -1
+
+
+class ChemicalRecord:
+    """Chemical entity as returned by process_pdf, with __slots__ and interned strings.
+
+    Args:
+        name (str): Iupac name, or extracted name if there is none
+        cid (Optional[int]): PubChem Identifier
+        elements (Tuple[str, ...]): Element symbols
+        molecular_weight (Optional[float]): Molecular weight
+        molecular_formula (Optional[str]): Molecular formula
+        image (Any, optional): Structure image (StructureImage handle or base64 string). Defaults to None.
+    """
+
+    __slots__ = ("name", "cid", "elements", "molecular_weight", "molecular_formula", "image")
+
+    def __init__(
+        self,
+        name: str,
+        cid: Optional[int],
+        elements: Sequence[str],
+        molecular_weight: Optional[float],
+        molecular_formula: Optional[str],
+        image: Any = None,
+    ):
+        self.name = sys.intern(name) if name is not None else None
+        self.cid = cid
+        self.elements = tuple(sys.intern(symbol) for symbol in elements)
+        self.molecular_weight = float(molecular_weight) if molecular_weight is not None else None
+        self.molecular_formula = sys.intern(molecular_formula) if molecular_formula is not None else None
+        self.image = image
+
+    @classmethod
+    def from_row(cls, row: Sequence[Any]) -> "ChemicalRecord":
+        """Record from a row [Iupac name, CID, List of Atoms, Molecule Weight, Molecular Formula, (Image)]."""
+        return cls(*row[:5], image=row[5] if len(row) > 5 else None)
+
+    def to_row(self) -> List[Any]:
+        return [self.name, self.cid, list(self.elements), self.molecular_weight, self.molecular_formula, self.image]
+
+    def __repr__(self) -> str:
+        return f"ChemicalRecord(name={self.name!r}, cid={self.cid}, molecular_formula={self.molecular_formula!r})"
+
+
+class _StringEncoder:
+    """Dictionary encoder for a string column."""
+
+    def __init__(self, values: Optional[List[str]] = None):
+        self.values: List[str] = list(values) if values else []
+        self._codes: Dict[str, int] = {value: code for code, value in enumerate(self.values)}
+
+    def encode(self, value: Optional[str]) -> int:
+        if value is None:
+            return NO_STRING
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+def encode_elements(elements: Sequence[str]) -> Tuple[int, ...]:
+    """Bitset of element symbols, bit i of the bitset is set if ELEMENTS[i] is contained.
+
+    Args:
+        elements (Sequence[str]): Element symbols
+
+    Returns:
+        Tuple[int, ...]: ELEMENT_WORDS 64 bit words
+    """
+    words = [0] * ELEMENT_WORDS
+    for symbol in elements:
+        index = ELEMENT_INDEX.get(symbol)
+        if index is not None:
+            words[index // 64] |= 1 << (index % 64)
+    return tuple(words)
+
+
+def decode_elements(words: Sequence[int]) -> List[str]:
+    """Element symbols of a bitset created by encode_elements."""
+    return [symbol for index, symbol in enumerate(ELEMENTS) if int(words[index // 64]) >> (index % 64) & 1]
+
+
+class ChemicalBatch:
+    """Columnar container for the chemical entities of many documents. CIDs are stored as int64
+       (NO_CID if missing), molecular weights as float64 (NaN if missing), elements as bitset over the
+       periodic table, names, formulas and document ids are dictionary encoded. Structure images are
+       not stored, they are referenced by CID through the image store.
+
+    Args:
+        document (np.ndarray): int32 document codes
+        cid (np.ndarray): int64 CIDs
+        molecular_weight (np.ndarray): float64 molecular weights
+        elements (np.ndarray): uint64 element bitsets of shape (n, ELEMENT_WORDS)
+        name (np.ndarray): int32 name codes
+        molecular_formula (np.ndarray): int32 formula codes
+        documents (List[str]): Document ids of the document codes
+        names (List[str]): Names of the name codes
+        formulas (List[str]): Formulas of the formula codes
+    """
+
+    COLUMNS: Tuple[str, ...] = ("document", "cid", "molecular_weight", "elements", "name", "molecular_formula")
+
+    def __init__(
+        self,
+        document: np.ndarray,
+        cid: np.ndarray,
+        molecular_weight: np.ndarray,
+        elements: np.ndarray,
+        name: np.ndarray,
+        molecular_formula: np.ndarray,
+        documents: List[str],
+        names: List[str],
+        formulas: List[str],
+    ):
+        self.document = document
+        self.cid = cid
+        self.molecular_weight = molecular_weight
+        self.elements = elements
+        self.name = name
+        self.molecular_formula = molecular_formula
+        self.documents = documents
+        self.names = names
+        self.formulas = formulas
+        self._buffer: Optional[mmap.mmap] = None
+
+    @classmethod
+    def from_documents(cls, chemical_lists: Dict[str, List[List[Any]]]) -> "ChemicalBatch":
+        """Batch of the chemical entities of many documents.
+
+        Args:
+            chemical_lists (Dict[str, List[List[Any]]]): Chemical entities (see process_pdf) by document id
+
+        Returns:
+            ChemicalBatch: Batch in the order of the documents and their entities
+        """
+        names, formulas = _StringEncoder(), _StringEncoder()
+        documents: List[str] = []
+        columns: Dict[str, list] = {column: [] for column in cls.COLUMNS}
+        for doc_id, chemical_list in chemical_lists.items():
+            code = len(documents)
+            documents.append(doc_id)
+            for row in chemical_list:
+                columns["document"].append(code)
+                columns["name"].append(names.encode(row[0]))
+                columns["cid"].append(row[1] if row[1] is not None else NO_CID)
+                columns["elements"].append(encode_elements(row[2] or ()))
+                columns["molecular_weight"].append(float(row[3]) if row[3] is not None else np.nan)
+                columns["molecular_formula"].append(formulas.encode(row[4]))
+        return cls(
+            document=np.array(columns["document"], dtype=np.int32),
+            cid=np.array(columns["cid"], dtype=np.int64),
+            molecular_weight=np.array(columns["molecular_weight"], dtype=np.float64),
+            elements=np.array(columns["elements"], dtype=np.uint64).reshape(-1, ELEMENT_WORDS),
+            name=np.array(columns["name"], dtype=np.int32),
+            molecular_formula=np.array(columns["molecular_formula"], dtype=np.int32),
+            documents=documents,
+            names=names.values,
+            formulas=formulas.values,
+        )
+
+    @classmethod
+    def from_rows(cls, chemical_list: List[List[Any]], doc_id: str = "") -> "ChemicalBatch":
+        """Batch of the chemical entities of a single document, see from_documents."""
+        return cls.from_documents({doc_id: chemical_list})
+
+    def __len__(self) -> int:
+        return len(self.cid)
+
+    def __getitem__(self, index: int) -> ChemicalRecord:
+        cid = int(self.cid[index])
+        weight = float(self.molecular_weight[index])
+        name_code, formula_code = int(self.name[index]), int(self.molecular_formula[index])
+        return ChemicalRecord(
+            self.names[name_code] if name_code != NO_STRING else None,
+            cid if cid != NO_CID else None,
+            decode_elements(self.elements[index]),
+            weight if not np.isnan(weight) else None,
+            self.formulas[formula_code] if formula_code != NO_STRING else None,
+        )
+
+    def __iter__(self) -> Iterator[ChemicalRecord]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def document_mask(self, doc_id: str) -> np.ndarray:
+        """Boolean mask of the entities of a document."""
+        return self.document == self.documents.index(doc_id)
+
+    def element_mask(self, symbol: str) -> np.ndarray:
+        """Boolean mask of the entities containing the element."""
+        index = ELEMENT_INDEX[symbol]
+        return ((self.elements[:, index // 64] >> np.uint64(index % 64)) & np.uint64(1)).astype(bool)
+
+    def select(self, mask: np.ndarray) -> "ChemicalBatch":
+        """Batch of the entities selected by a boolean mask or index array, the dictionaries are shared."""
+        return ChemicalBatch(
+            self.document[mask],
+            self.cid[mask],
+            self.molecular_weight[mask],
+            self.elements[mask],
+            self.name[mask],
+            self.molecular_formula[mask],
+            self.documents,
+            self.names,
+            self.formulas,
+        )
+
+    def save(self, path: str):
+        """Save the batch in a binary format, which load can memory-map: magic bytes, header length,
+           JSON header with dictionaries and array layout, then the raw arrays aligned to BATCH_ALIGNMENT.
+
+        Args:
+            path (str): Path of the file
+        """
+        arrays = {column: np.ascontiguousarray(getattr(self, column)) for column in self.COLUMNS}
+        layout: Dict[str, Dict[str, Any]] = {}
+        offset = 0
+        for column, array in arrays.items():
+            layout[column] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset += _align(array.nbytes)
+        header = json.dumps(
+            {"arrays": layout, "documents": self.documents, "names": self.names, "formulas": self.formulas}
+        ).encode("utf-8")
+        data_start = _align(len(BATCH_MAGIC) + 8 + len(header))
+        with open(path, "wb") as file:
+            file.write(BATCH_MAGIC)
+            file.write(struct.pack("<Q", len(header)))
+            file.write(header)
+            file.write(b"\0" * (data_start - file.tell()))
+            for column, array in arrays.items():
+                file.write(array.tobytes())
+                file.write(b"\0" * (_align(array.nbytes) - array.nbytes))
+
+    @classmethod
+    def load(cls, path: str) -> "ChemicalBatch":
+        """Memory-map a batch saved with save, the columns are read-only NumPy views of the file.
+
+        Args:
+            path (str): Path of the file
+
+        Returns:
+            ChemicalBatch: Batch backed by the file
+        """
+        with open(path, "rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[: len(BATCH_MAGIC)] != BATCH_MAGIC:
+            raise ValueError(f"{path} is not a chemical batch file.")
+        (header_length,) = struct.unpack_from("<Q", buffer, len(BATCH_MAGIC))
+        header_start = len(BATCH_MAGIC) + 8
+        header = json.loads(buffer[header_start : header_start + header_length].decode("utf-8"))
+        data_start = _align(header_start + header_length)
+        columns = {}
+        for column, layout in header["arrays"].items():
+            dtype = np.dtype(layout["dtype"])
+            count = int(np.prod(layout["shape"]))
+            columns[column] = np.frombuffer(
+                buffer, dtype=dtype, count=count, offset=data_start + layout["offset"]
+            ).reshape(layout["shape"])
+        batch = cls(**columns, documents=header["documents"], names=header["names"], formulas=header["formulas"])
+        batch._buffer = buffer
+        return batch
+
+
+def _align(size: int) -> int:
+    return (size + BATCH_ALIGNMENT - 1) // BATCH_ALIGNMENT * BATCH_ALIGNMENT
+
+
+def cid_column(chemical_list: List[List[Any]]) -> np.ndarray:
+    """CIDs of chemical entities (see process_pdf) as int64 array, NO_CID if missing.
+
+    Args:
+        chemical_list (List[List[Any]]): Chemical entities
+
+    Returns:
+        np.ndarray: int64 CIDs in the order of the entities
+    """
+    return np.fromiter(
+        (row[1] if row[1] is not None else NO_CID for row in chemical_list), dtype=np.int64, count=len(chemical_list)
+    )
+
+
+def shared_cid_pairs(source_cids: np.ndarray, target_cids: np.ndarray) -> np.ndarray:
+    """Index pairs [i, j] of same CIDs, j is the first position of source_cids[i] in target_cids.
+       Vectorized equivalent of the comparison in compare_documents.
+
+    Args:
+        source_cids (np.ndarray): CIDs of the source entities
+        target_cids (np.ndarray): CIDs of the target entities
+
+    Returns:
+        np.ndarray: int64 array of shape (m, 2), ordered by i
+    """
+    source_cids = np.asarray(source_cids, dtype=np.int64)
+    target_cids = np.asarray(target_cids, dtype=np.int64)
+    if len(source_cids) == 0 or len(target_cids) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    unique_cids, first_positions = np.unique(target_cids, return_index=True)
+    positions = np.minimum(np.searchsorted(unique_cids, source_cids), len(unique_cids) - 1)
+    # Entities without CID match like in the list comparison, None == None
+    found = unique_cids[positions] == source_cids
+    return np.stack([np.flatnonzero(found), first_positions[positions[found]]], axis=1).astype(np.int64)
@@ -1,81 +1,254 @@
 import bs4 as bs
 import requests as r
-from typing import List
-from fake_useragent import FakeUserAgent
+from typing import Any, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
 from definitions import PDF_FILES
+from metrics import increment, record_response
+from requests.adapters import HTTPAdapter
 import concurrent.futures
+import logging
+import os
+import re
+import time
 from utils import *
 
 ACS_WEBSITE: str = "https://pubs.acs.org"
 ACS_SEARCH: str = "https://pubs.acs.org/action/doSearch?AllField="
 ACS_PAGE: str = "&startPage="
 ACS_PAGE_SIZE: str = "&pageSize="
+DOI_PATTERN = re.compile(r"/doi/(?:pdf|epdf|pdfdirect|abs|full)/(10\.[^?#]+)")
+# Content-Range header of partial (bytes 100-199/1000) and unsatisfiable range (bytes */1000) responses
+CONTENT_RANGE_PATTERN = re.compile(r"bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)")
+DOWNLOAD_CHUNK_SIZE: int = 256 * 1024
+DOWNLOAD_TIMEOUT: float = 60
+# Status of a download, see DownloadResult
+DOWNLOADED: str = "downloaded"
+RESUMED: str = "resumed"
+SKIPPED: str = "skipped"
+FAILED: str = "failed"
 
 
-def download_pdf(download_url: str, path_to_save: PDF_FILES, session: r.Session) -> bool:
-    """Download pdf file and save it.
+class DownloadResult(NamedTuple):
+    """Result of download_pdf.
+
+    Args:
+        url (str): URL of the pdf file.
+        path (str): Path of the saved pdf file.
+        status (str): DOWNLOADED, RESUMED (a partial file was completed) or SKIPPED (the file existed).
+        bytes (int): Bytes received.
+        seconds (float): Seconds of the download.
+    """
+
+    url: str
+    path: str
+    status: str
+    bytes: int = 0
+    seconds: float = 0.0
+
+
+def download_pdf(
+    download_url: str,
+    path_to_save: PDF_FILES,
+    session: r.Session,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    timeout: float = DOWNLOAD_TIMEOUT,
+) -> DownloadResult:
+    """Download pdf file and save it. The body is streamed in chunks to a partial file, which is renamed
+       when it is complete, so that an interrupted download never leaves a truncated pdf file. Existing
+       pdf files are not downloaded again, partial files of an earlier run are resumed with a Range request.
+       A partial file is only taken as complete if its size is the total size the server reports, and
+       only resumed if the server sends the range from its end. Otherwise it is downloaded again.
 
     Args:
         download_url (str): URL to pdf file
         path_to_save (PDF_FILES): Save directory
         session (r.Session): Requests session object
+        chunk_size (int, optional): Bytes per write. Defaults to DOWNLOAD_CHUNK_SIZE.
+        timeout (float, optional): Seconds to wait for the server. Defaults to DOWNLOAD_TIMEOUT.
+
+    Raises:
+        r.exceptions.RequestException: The download failed or the response is no pdf file.
 
     Returns:
-        bool: _description_
+        DownloadResult: Status, bytes received and seconds of the download
     """
-    save_name = download_url.split("/")[-1]
-    try:
-        request = session.get(url=download_url)
-    except r.exceptions.Re:
-        pass
-    with open(path_to_save + save_name + ".pdf", "wb") as file:
-        file.write(request.content)
-    return True
+    path = path_to_save + pdf_name_from_url(download_url)
+    if os.path.exists(path):
+        return DownloadResult(download_url, path, SKIPPED)
+    partial_path = path + ".part"
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    start = time.perf_counter()
+    received = 0
+    with session.get(url=download_url, headers=headers, stream=True, timeout=timeout) as response:
+        record_response("acs", response)
+        content_range = _content_range(response)
+        if response.status_code == 416 and offset:
+            if content_range[1] == offset:
+                # The partial file is already complete
+                os.replace(partial_path, path)
+                return DownloadResult(download_url, path, RESUMED, 0, time.perf_counter() - start)
+            logging.warning(f"Partial file of {download_url} does not match the file on the server.")
+        elif offset and response.status_code == 206 and content_range[0] != offset:
+            logging.warning(f"{download_url} sent another range than requested, downloading it again.")
+        else:
+            response.raise_for_status()
+            if response.headers.get("Content-Type", "").startswith("text/html"):
+                raise r.exceptions.HTTPError(f"{download_url} returned a html page instead of a pdf file.")
+            # A server ignoring the Range header sends the whole file
+            resumed = offset > 0 and response.status_code == 206
+            with open(partial_path, "ab" if resumed else "wb") as file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+                    received += len(chunk)
+            os.replace(partial_path, path)
+            status = RESUMED if resumed else DOWNLOADED
+            return DownloadResult(download_url, path, status, received, time.perf_counter() - start)
+    # Without the partial file the next request has no Range header
+    os.remove(partial_path)
+    return download_pdf(download_url, path_to_save, session, chunk_size, timeout)
 
 
-def search_and_download_acs(
-    search_string: str, num_papers: int, page_size: int = 100, num_threads: int = 10
-) -> int:
-    """Search and download a number of papers from https://pubs.acs.org/ to PDF_FILES.
+def _content_range(response: r.Response) -> Tuple[Optional[int], Optional[int]]:
+    """First byte and total size of the Content-Range header, None if they are unknown."""
+    match = CONTENT_RANGE_PATTERN.fullmatch(response.headers.get("Content-Range", "").strip())
+    if match is None:
+        return None, None
+    first, total = match.groups()
+    return int(first) if first else None, int(total) if total != "*" else None
+
+
+def download_pdfs(
+    urls: Iterable[str], path_to_save: str = PDF_FILES, session: Optional[r.Session] = None, num_threads: int = 10
+) -> Dict[str, Any]:
+    """Download many pdf files concurrently with download_pdf. Urls are submitted as the iterable yields
+       them, so downloads start while later result pages of a search are requested. Urls of the same DOI
+       are downloaded once.
+
+    Args:
+        urls (Iterable[str]): URLs to pdf files
+        path_to_save (str, optional): Save directory. Defaults to PDF_FILES.
+        session (r.Session, optional): Requests session object. Defaults to a new session.
+        num_threads (int, optional): Number of threads. Defaults to 10.
+
+    Returns:
+        Dict[str, Any]: Number of files by status (downloaded, resumed, skipped, failed), bytes received,
+                        seconds and throughput in bytes per second
+    """
+    session = session or create_session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=num_threads)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    stats: Dict[str, Any] = {DOWNLOADED: 0, RESUMED: 0, SKIPPED: 0, FAILED: 0, "bytes": 0}
+    seen = set()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        downloads = {}
+        for url in urls:
+            doi = doi_from_url(url)
+            if doi in seen:
+                stats[SKIPPED] += 1
+                continue
+            seen.add(doi)
+            downloads[executor.submit(download_pdf, url, path_to_save, session)] = url
+        for download in concurrent.futures.as_completed(downloads):
+            try:
+                result = download.result()
+            except (r.exceptions.RequestException, OSError) as error:
+                logging.warning(f"Download of {downloads[download]} failed: {error}")
+                stats[FAILED] += 1
+                increment("downloads_total", status=FAILED)
+                continue
+            stats[result.status] += 1
+            stats["bytes"] += result.bytes
+            increment("downloads_total", status=result.status)
+    stats["seconds"] = time.perf_counter() - start
+    stats["bytes_per_second"] = stats["bytes"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+
+def doi_from_url(download_url: str) -> str:
+    """DOI of an ACS pdf url (https://pubs.acs.org/doi/pdf/<doi>), the url itself for other urls.
+
+    Args:
+        download_url (str): URL to pdf file
+
+    Returns:
+        str: DOI
+    """
+    match = DOI_PATTERN.search(download_url)
+    return match.group(1).lower() if match else download_url
+
+
+def pdf_name_from_url(download_url: str) -> str:
+    """Name of the pdf file, which download_pdf saves for the url.
+
+    Args:
+        download_url (str): URL to pdf file
+
+    Returns:
+        str: Name of the pdf file
+    """
+    return download_url.split("/")[-1] + ".pdf"
+
+
+def iter_acs_pdf_urls(
+    search_string: str, num_papers: int, page_size: int = 100, session: r.Session = None
+) -> Iterator[str]:
+    """Search https://pubs.acs.org/ and yield the pdf urls of the results, result pages are only
+       requested when the urls of the previous page are consumed.
 
     Args:
         search_string (str): Search string.
-        num_papers (int): Number of papers to download.
+        num_papers (int): Maximum number of urls.
         page_size (int, optional): Size of search page. Defaults to 100.
-        num_threads (int, optional): Number of threads. Defaults to 10.
+        session (r.Session, optional): Requests session object. Defaults to a new session.
 
     Returns:
-        int: Number of downloaded scientific papers.
+        Iterator[str]: Pdf urls
     """
-    session = create_session()
-    paper_url_list: List[str] = []
-    num_papers_downloaded: int = 0
+    session = session or create_session()
+    num_urls: int = 0
     page: int = 0
-    while len(paper_url_list) < num_papers:
+    while num_urls < num_papers:
         request = session.get(
             url=f"{ACS_SEARCH}{search_string}{ACS_PAGE}{page}{ACS_PAGE_SIZE}{page_size}"
         )
         soup = bs.BeautifulSoup(request.text, "lxml")
-        paper = [ACS_WEBSITE + pdf["href"] for pdf in soup.find_all("a", {"title": "PDF"})]
-        paper_url_list.extend(paper)
+        for pdf in soup.find_all("a", {"title": "PDF"}):
+            if num_urls == num_papers:
+                return
+            num_urls += 1
+            yield ACS_WEBSITE + pdf["href"]
         if soup.find("a", {"class": "pagination__btn--next"}):
             page += 1
         else:
             break
 
-    if len(paper_url_list) > num_papers:
-        paper_url_list = paper_url_list[:num_papers]
 
-    if paper_url_list:
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=min(num_threads, len(paper_url_list))
-        ) as executor:
-            paper_download = [
-                executor.submit(download_pdf, url, PDF_FILES, session) for url in paper_url_list
-            ]
-            for paper in concurrent.futures.as_completed(paper_download):
-                num_papers += int(paper.result())
+def search_and_download_acs(
+    search_string: str, num_papers: int, page_size: int = 100, num_threads: int = 10
+) -> int:
+    """Search and download a number of papers from https://pubs.acs.org/ to PDF_FILES. Downloads start
+       with the urls of the first result page, while further pages are requested.
 
+    Args:
+        search_string (str): Search string.
+        num_papers (int): Number of papers to download.
+        page_size (int, optional): Size of search page. Defaults to 100.
+        num_threads (int, optional): Number of threads. Defaults to 10.
+
+    Returns:
+        int: Number of downloaded scientific papers, including completed partial downloads.
+    """
+    session = create_session()
+    urls = iter_acs_pdf_urls(search_string, num_papers, page_size, session)
+    stats = download_pdfs(urls, PDF_FILES, session, num_threads)
+    logging.info(
+        f"ACS search {search_string!r}: {stats[DOWNLOADED]} downloaded, {stats[RESUMED]} resumed, "
+        f"{stats[SKIPPED]} skipped, {stats[FAILED]} failed, {stats['bytes'] / 2 ** 20:.1f} MiB in "
+        f"{stats['seconds']:.1f} s ({stats['bytes_per_second'] / 2 ** 20:.2f} MiB/s)"
+    )
+    num_papers_downloaded: int = stats[DOWNLOADED] + stats[RESUMED]
     return num_papers_downloaded
 
 
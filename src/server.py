@@ -0,0 +1,247 @@
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+from definitions import PDF_FILES, SERVICE_HOST, SERVICE_PORT
+from main import compare_documents, process_pdf
+from manifest import get_manifest
+from metrics import call_recording, get_metrics, merge_recorded, prometheus_text
+
+if TYPE_CHECKING:
+    from requests import Session
+
+# Requests processed at the same time, further requests wait for a free worker
+SERVICE_WORKERS: int = 4
+# Session of a worker process, sessions are not shared with forked processes
+_worker_session: Optional["Session"] = None
+
+
+def serialize_rows(chemical_list: List[List[Any]]) -> List[List[Any]]:
+    """Chemical entities of process_pdf in a JSON serializable form. Lazy structure images are replaced by
+       {"cid": int, "digest": Optional[str]}, the image can be read from the image store by CID.
+
+    Args:
+        chemical_list (List[List[Any]]): Chemical entities, see process_pdf
+
+    Returns:
+        List[List[Any]]: Chemical entities without StructureImage handles
+    """
+    from image_store import StructureImage
+
+    rows = []
+    for chemical in chemical_list:
+        row = list(chemical)
+        if row and isinstance(row[-1], StructureImage):
+            row[-1] = {"cid": row[-1].cid, "digest": row[-1].digest}
+        rows.append(row)
+    return rows
+
+
+def _session() -> "Session":
+    global _worker_session
+    if _worker_session is None:
+        from utils import create_session
+
+        _worker_session = create_session()
+    return _worker_session
+
+
+def _process_pdf(pdf_name: str, eager_images: bool) -> List[List[Any]]:
+    return serialize_rows(process_pdf(pdf_name, eager_images=eager_images, session=_session()))
+
+
+def _compare_documents(source_pdf: str, recommendation_pdf: str) -> List[List[Any]]:
+    source, recommendation, index_list = compare_documents(source_pdf, recommendation_pdf, _session())
+    return [serialize_rows(source), serialize_rows(recommendation), index_list]
+
+
+class ExtractionService:
+    """Keeps the CDE models, the Hyplag token and the caches of the extraction warm and runs the
+       requests of the server on a pool of worker processes. CDE is not thread-safe and holds the GIL,
+       so every request is extracted in its own process. The workers are forked after the models are
+       loaded and share them copy-on-write (see ner.get_ner_pool). The dependencies of the extraction
+       are imported by warm_up, so that the server is listening right after the start.
+
+    Args:
+        workers (int, optional): Number of worker processes. Defaults to SERVICE_WORKERS.
+    """
+
+    def __init__(self, workers: int = SERVICE_WORKERS):
+        self.workers = workers
+        self.executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self.ready = threading.Event()
+
+    def warm_up(self):
+        """Loads the models and opens the caches, the service is ready afterwards."""
+        from cache import get_pubchem_cache
+        from hyplag_backend import get_current_token
+        from image_store import get_image_store
+        from ner import get_ner_cache
+        from parser import preload_models
+
+        preload_models()
+        get_manifest()
+        get_pubchem_cache()
+        get_ner_cache()
+        get_image_store()
+        try:
+            get_current_token()
+        except Exception:
+            # Grobid is tried first, the Hyplag backend is only needed as fallback
+            logging.warning("Hyplag token could not be requested.", exc_info=True)
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        # Forked pools start all workers with the first task, before requests are processed
+        self.executor.submit(os.getpid).result()
+        self.ready.set()
+
+    def process_pdf(self, pdf_name: str, eager_images: bool = False) -> List[List[Any]]:
+        return self.submit(_process_pdf, pdf_name, eager_images)
+
+    def compare_documents(self, source_pdf: str, recommendation_pdf: str) -> List[List[Any]]:
+        return self.submit(_compare_documents, source_pdf, recommendation_pdf)
+
+    def submit(self, func: Callable[..., Any], *args) -> Any:
+        """Runs func in a worker process after the warm up and waits for its result."""
+        self.ready.wait()
+        return next(merge_recorded([self.executor.submit(call_recording, func, *args).result()]))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class ExtractionRequestHandler(BaseHTTPRequestHandler):
+    """JSON endpoints of the extraction service:
+
+       GET /health: {"status": "ok"} while the server is running
+       GET /ready: 200 after the warm up, 503 before
+       GET /metrics: metrics of the service in the Prometheus text format, empty unless METRICS is set
+       POST /process_pdf {"pdf_name": str, "eager_images": bool}: chemical entities, see serialize_rows
+       POST /compare_documents {"source_pdf": str, "recommendation_pdf": str}: result of compare_documents
+    """
+
+    protocol_version = "HTTP/1.1"
+    server: "ExtractionServer"
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(HTTPStatus.OK, {"status": "ok"})
+        elif self.path == "/ready":
+            if self.server.service.ready.is_set():
+                self._send_json(HTTPStatus.OK, {"status": "ready"})
+            else:
+                self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"status": "starting"})
+        elif self.path == "/metrics":
+            data = prometheus_text(get_metrics().snapshot()).encode("utf-8")
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown endpoint {self.path}."})
+
+    def do_POST(self):
+        service = self.server.service
+        try:
+            body = self._read_json()
+            if self.path == "/process_pdf":
+                (pdf_name,) = _required(body, "pdf_name")
+                result = service.process_pdf(pdf_name, bool(body.get("eager_images", False)))
+            elif self.path == "/compare_documents":
+                pdf_names = _required(body, "source_pdf", "recommendation_pdf")
+                result = service.compare_documents(*pdf_names)
+            else:
+                self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown endpoint {self.path}."})
+                return
+        except ValueError as error:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": str(error)})
+        except FileNotFoundError as error:
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": str(error)})
+        except Exception as error:
+            logging.exception(f"Request {self.path} failed.")
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(error)})
+        else:
+            self._send_json(HTTPStatus.OK, result)
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as error:
+            raise ValueError(f"Invalid JSON body: {error}.")
+        if not isinstance(body, dict):
+            raise ValueError("JSON body must be an object.")
+        return body
+
+    def _send_json(self, status: HTTPStatus, value: Any):
+        data = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+def _required(body: Dict[str, Any], *fields: str) -> Tuple[str, ...]:
+    """Values of required string fields of a request body, pdf names must be files in PDF_FILES."""
+    values = []
+    for field in fields:
+        value = body.get(field)
+        if not isinstance(value, str) or not value:
+            raise ValueError(f"Field {field} is required.")
+        if os.path.basename(value) != value:
+            raise ValueError(f"Field {field} must be a file name in {PDF_FILES}.")
+        if not os.path.exists(PDF_FILES + value):
+            raise FileNotFoundError(f"{value} not found in {PDF_FILES}.")
+        values.append(value)
+    return tuple(values)
+
+
+class ExtractionServer(ThreadingHTTPServer):
+    """Threading HTTP server of an ExtractionService."""
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], service: ExtractionService):
+        super().__init__(address, ExtractionRequestHandler)
+        self.service = service
+
+
+def serve(host: str = SERVICE_HOST, port: int = SERVICE_PORT, workers: int = SERVICE_WORKERS):
+    """Runs the extraction service until it is interrupted. The server accepts requests during the warm
+       up, /ready reports when the models are loaded.
+
+    Args:
+        host (str, optional): Host name. Defaults to SERVICE_HOST.
+        port (int, optional): Port. Defaults to SERVICE_PORT.
+        workers (int, optional): Number of worker processes. Defaults to SERVICE_WORKERS.
+    """
+    service = ExtractionService(workers)
+    server = ExtractionServer((host, port), service)
+    threading.Thread(target=service.warm_up, name="warm-up", daemon=True).start()
+    logging.info(f"Extraction service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    serve()
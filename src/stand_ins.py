@@ -0,0 +1,334 @@
+import base64
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# (status, content type, body) of a stand-in response
+Response = Tuple[int, str, bytes]
+# Synthetic response for (method, path, body) of requests without recording
+Responder = Callable[[str, str, bytes], Response]
+
+JSON_TYPE: str = "application/json"
+XML_TYPE: str = "application/xml"
+PNG_TYPE: str = "image/png"
+STAND_IN_TOKEN: str = "stand-in-token"
+# Average atomic weights of the elements of the synthetic compounds
+_SYNTHETIC_ELEMENTS: Tuple[Tuple[str, int, float], ...] = (
+    ("C", 6, 12.011),
+    ("H", 1, 1.008),
+    ("N", 7, 14.007),
+    ("O", 8, 15.999),
+)
+
+
+def request_key(method: str, path: str, body: bytes, content_type: str = "") -> str:
+    """Key of a recorded response. Multipart uploads differ in their random boundary, so only their
+    method and path are part of the key."""
+    if not body or content_type.startswith("multipart/"):
+        return f"{method} {path}"
+    return f"{method} {path} {hashlib.sha256(body).hexdigest()}"
+
+
+def _json_response(value, status: int = 200) -> Response:
+    return status, JSON_TYPE, json.dumps(value).encode("utf-8")
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Local HTTP server standing in for an external service. Requests are answered from recorded
+       responses, forwarded to the upstream service and recorded if upstream is set, or answered by
+       a responder with synthetic responses. Every response is delayed by the injected latency.
+
+    Args:
+        responder (Responder, optional): Synthetic responses for requests without recording.
+        latency (float, optional): Seconds added to every response. Defaults to 0.
+        recordings (Dict[str, Dict[str, Union[int, str]]], optional): Recorded responses by request_key,
+            see load_recordings.
+        upstream (str, optional): Base URL of the real service for recording missing responses.
+        host (str, optional): Host name. Defaults to "127.0.0.1".
+        port (int, optional): Port, 0 for a free port. Defaults to 0.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        responder: Optional[Responder] = None,
+        latency: float = 0.0,
+        recordings: Optional[Dict[str, Dict[str, Union[int, str]]]] = None,
+        upstream: Optional[str] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        super().__init__((host, port), StandInRequestHandler)
+        self.responder = responder
+        self.latency = latency
+        self.recordings = recordings if recordings is not None else {}
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def respond(self, method: str, path: str, body: bytes, content_type: str = "") -> Response:
+        with self._lock:
+            self.requests += 1
+        key = request_key(method, path, body, content_type)
+        recording = self.recordings.get(key)
+        if recording is not None:
+            return recording["status"], recording["content_type"], base64.b64decode(recording["body"])
+        if self.upstream:
+            response = self._forward(method, path, body, content_type)
+            with self._lock:
+                self.recordings[key] = {
+                    "status": response[0],
+                    "content_type": response[1],
+                    "body": base64.b64encode(response[2]).decode("ascii"),
+                }
+            return response
+        if self.responder:
+            return self.responder(method, path, body)
+        return _json_response({"error": f"No recording for {key}."}, 404)
+
+    def _forward(self, method: str, path: str, body: bytes, content_type: str) -> Response:
+        headers = {"Content-Type": content_type} if content_type else {}
+        request = urllib.request.Request(self.upstream + path, data=body or None, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                return response.status, response.headers.get("Content-Type", ""), response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers.get("Content-Type", ""), error.read()
+
+    def start(self) -> "StandInServer":
+        self._thread = threading.Thread(target=self.serve_forever, name=f"stand-in-{self.url}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def save_recordings(self, path: str):
+        with open(path, "w") as file:
+            json.dump(self.recordings, file, indent=1, sort_keys=True)
+
+    @staticmethod
+    def load_recordings(path: str) -> Dict[str, Dict[str, Union[int, str]]]:
+        """Recorded responses saved by save_recordings, empty if the file does not exist."""
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            return json.load(file)
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StandInServer
+
+    def _handle(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.latency)
+        status, content_type, data = self.server.respond(
+            self.command, self.path, body, self.headers.get("Content-Type", "")
+        )
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, format: str, *args):
+        pass
+
+
+def synthetic_cid(name: str) -> int:
+    """Stable CID of a name or formula, every search term is found."""
+    digest = hashlib.sha256(" ".join(name.split()).lower().encode("utf-8")).hexdigest()
+    return int(digest[:12], 16) % 10_000_000 + 1
+
+
+def synthetic_compound(cid: int) -> Dict[str, Union[int, str, float, List[int]]]:
+    """Stable properties of a CID: a compound of C, H, N and O with formula in Hill order."""
+    rng = random.Random(cid)
+    counts = {"C": rng.randint(1, 12), "N": rng.randint(0, 2), "O": rng.randint(0, 3)}
+    counts["H"] = 2 * counts["C"] + 2 + counts["N"]
+    formula = "".join(
+        symbol + (str(counts[symbol]) if counts[symbol] > 1 else "")
+        for symbol, _, _ in _SYNTHETIC_ELEMENTS
+        if counts[symbol]
+    )
+    return {
+        "cid": cid,
+        "iupac_name": f"stand-in compound {cid}",
+        "molecular_formula": formula,
+        "molecular_weight": round(sum(counts[symbol] * weight for symbol, _, weight in _SYNTHETIC_ELEMENTS), 3),
+        "atomic_numbers": [number for symbol, number, _ in _SYNTHETIC_ELEMENTS for _ in range(counts[symbol])],
+    }
+
+
+def _pc_compound(cid: int) -> Dict:
+    """Compound record in the PUG-REST JSON format read by pubchempy."""
+    compound = synthetic_compound(cid)
+    atomic_numbers = compound["atomic_numbers"]
+    return {
+        "id": {"id": {"cid": cid}},
+        "atoms": {"aid": list(range(1, len(atomic_numbers) + 1)), "element": atomic_numbers},
+        "props": [
+            {"urn": {"label": "IUPAC Name", "name": "Preferred"}, "value": {"sval": compound["iupac_name"]}},
+            {"urn": {"label": "Molecular Formula"}, "value": {"sval": compound["molecular_formula"]}},
+            {"urn": {"label": "Molecular Weight"}, "value": {"sval": str(compound["molecular_weight"])}},
+        ],
+    }
+
+
+def synthetic_png(cid: int) -> bytes:
+    """1x1 PNG, the color depends on the CID."""
+    pixel = hashlib.sha256(str(cid).encode("ascii")).digest()[:3]
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0)
+    data = chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"\0" + pixel)) + chunk(b"IEND", b"")
+    return b"\x89PNG\r\n\x1a\n" + data
+
+
+def pubchem_responder(method: str, path: str, body: bytes) -> Response:
+    """Synthetic PUG-REST responses for the requests of pubchem.py and pubchempy."""
+    path = unquote(urlsplit(path).path)
+    path = path[path.index("/compound/") :] if "/compound/" in path else path
+    form = {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+    match = re.fullmatch(r"/compound/(name|fastformula)/cids/JSON", path)
+    if match:
+        return _json_response({"IdentifierList": {"CID": [synthetic_cid(form.get(match.group(1), ""))]}})
+    if path == "/compound/name/JSON":
+        return _json_response({"PC_Compounds": [_pc_compound(synthetic_cid(form.get("name", "")))]})
+    match = re.fullmatch(r"/compound/formula/(.+)/JSON", path)
+    if match:
+        return _json_response({"PC_Compounds": [_pc_compound(synthetic_cid(match.group(1)))]})
+    if re.fullmatch(r"/compound/cid/property/[^/]+/JSON", path):
+        properties = []
+        for cid in form.get("cid", "").split(","):
+            compound = synthetic_compound(int(cid))
+            properties.append(
+                {
+                    "CID": int(cid),
+                    "MolecularFormula": compound["molecular_formula"],
+                    "MolecularWeight": str(compound["molecular_weight"]),
+                    "IUPACName": compound["iupac_name"],
+                }
+            )
+        return _json_response({"PropertyTable": {"Properties": properties}})
+    if path == "/compound/cid/synonyms/JSON":
+        cid = int(form.get("cid", "0").split(",")[0])
+        synonyms = [f"stand-in compound {cid}", f"compound {cid}"]
+        return _json_response({"InformationList": {"Information": [{"CID": cid, "Synonym": synonyms}]}})
+    match = re.fullmatch(r"/compound/cid/(\d+)/PNG", path)
+    if match:
+        return 200, PNG_TYPE, synthetic_png(int(match.group(1)))
+    return _json_response({"Fault": {"Code": "PUGREST.NotFound", "Message": f"Unknown request {path}."}}, 404)
+
+
+def hyplag_responder(tei: bytes) -> Responder:
+    """Synthetic Hyplag backend: tokens, indexing and the TEI of every document is tei."""
+    document_ids = itertools.count(1)
+
+    def respond(method: str, path: str, body: bytes) -> Response:
+        path = urlsplit(path).path
+        if method == "POST" and path == "/token/create":
+            return _json_response({"token": STAND_IN_TOKEN})
+        if method == "POST" and path == "/indexing":
+            return _json_response(next(document_ids))
+        if method == "GET" and re.fullmatch(r"/document/\d+/tei", path):
+            return 200, XML_TYPE, tei
+        return _json_response({"error": f"Unknown request {method} {path}."}, 404)
+
+    return respond
+
+
+def grobid_responder(tei: bytes) -> Responder:
+    """Synthetic Grobid server, every pdf file is converted to tei."""
+
+    def respond(method: str, path: str, body: bytes) -> Response:
+        path = urlsplit(path).path
+        if path == "/api/isalive":
+            return 200, "text/plain", b"true"
+        if method == "POST" and path == "/api/processFulltextDocument":
+            return 200, XML_TYPE, tei
+        return 404, "text/plain", b"Unknown request."
+
+    return respond
+
+
+class StandInServices:
+    """Stand-ins for PubChem, Hyplag and Grobid, used as context manager.
+
+    Args:
+        tei (bytes): TEI returned by the Grobid and Hyplag stand-ins
+        latency (Union[float, Dict[str, float]], optional): Seconds added to every response, or by service
+                                                             ("pubchem", "hyplag", "grobid"). Defaults to 0.
+        recordings_dir (str, optional): Directory of the recorded responses <service>.json. Defaults to None.
+    """
+
+    SERVICES: Tuple[str, ...] = ("pubchem", "hyplag", "grobid")
+
+    def __init__(
+        self, tei: bytes, latency: Union[float, Dict[str, float]] = 0.0, recordings_dir: Optional[str] = None
+    ):
+        responders = {
+            "pubchem": pubchem_responder,
+            "hyplag": hyplag_responder(tei),
+            "grobid": grobid_responder(tei),
+        }
+        self.servers: Dict[str, StandInServer] = {}
+        for service in self.SERVICES:
+            recordings = None
+            if recordings_dir:
+                recordings = StandInServer.load_recordings(os.path.join(recordings_dir, service + ".json"))
+            service_latency = latency.get(service, 0.0) if isinstance(latency, dict) else latency
+            self.servers[service] = StandInServer(responders[service], service_latency, recordings)
+
+    def environment(self) -> Dict[str, str]:
+        """Environment variables pointing definitions.py to the stand-ins."""
+        return {
+            "PUBCHEM_API_BASE": self.servers["pubchem"].url + "/rest/pug",
+            "HYPLAG_BACKEND": self.servers["hyplag"].url,
+            "GROBID_URL": self.servers["grobid"].url,
+        }
+
+    def requests(self) -> Dict[str, int]:
+        return {service: server.requests for service, server in self.servers.items()}
+
+    def __enter__(self) -> "StandInServices":
+        for server in self.servers.values():
+            server.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for server in self.servers.values():
+            server.stop()
+
+
+if __name__ == "__main__":
+    server = StandInServer(pubchem_responder).start()
+    with urllib.request.urlopen(server.url + "/rest/pug/compound/cid/property/MolecularFormula/JSON", b"cid=1") as r:
+        print(r.read().decode("utf-8"))
+    server.stop()
@@ -0,0 +1,294 @@
+from xml.etree.ElementTree import ElementTree
+from lxml import etree
+from typing import IO, List, Tuple, Union
+from collections import defaultdict
+from chemdataextractor.doc import Document, Table, Figure, Heading, Caption, Title
+from chemdataextractor.doc.element import BaseElement
+from chemdataextractor.scrape.clean import Cleaner
+from chemdataextractor.reader.markup import LxmlReader
+from chemdataextractor.doc.meta import MetaData
+from chemdataextractor.errors import ReaderError
+from chemdataextractor.model import Compound
+from parser import XML_ID, clean_xml, load_tei
+from metrics import timed
+
+
+class TeiXmlReader(LxmlReader):
+    """Reader for xml files, which follow the TEI standard (grobid, hyplag).
+
+    Args:
+        LxmlReader : _description_
+
+    Raises:
+        ReaderError: _description_
+
+    Returns:
+        _type_: _description_
+    """
+    # Xpath expressions for different document elements
+    main_document_body = ".//body"
+
+    metadata_xpath = "//fileDesc"
+    metadata_title_xpath = ".//titleStmt/title"
+    metadata_date_xpath = ".//publicationStmt/date"
+    metadata_doi_xpath = ".//idno[@type='DOI']"
+    metadata_authors_xpath = ".//author/persName"
+
+    headings_xpath = ".//div/head"
+
+    figures_xpath = "//div//*//figure[contains(@xml:id, 'fig')]"
+    figures_caption_xpath = "figDesc"
+    figures_label_xpath = "label"
+
+    tables_xpath = "//div//*//figure[contains(@xml:id, 'tab')]"
+    table_rows_xpath = "table/row"
+    tables_caption_xpath = "figDesc"
+    tables_label_xpath = "label"
+
+    references_text_xpath = "//div//*//ref[contains(@target, '#b')]"
+    references_bibliography_xpath = "//bibleStruct"
+    # Cleaner for removing references without proper id
+    cleaner = Cleaner(kill_xpath="//div//*//ref[contains(@target, '#b')]")
+
+    def _parse_reference(self, el) -> int:
+        """Parse reference id.
+
+        Args:
+            el (xml element): Reference xml element, for example <ref type="bibr" target="#b0">
+
+        Returns:
+            int: Bibliography number
+        """
+        bib_id: str = el.get("target")
+        if bib_id:
+            # Remove #b
+            bib_id = [int(bib_id[2:])]
+            return bib_id
+        return 1000
+
+    def _parse_figure(self, el, refs, specials) -> List[Figure]:
+        """Parse a figure to a CDE figure object.
+
+        Args:
+            el (xml element): Root xml element
+            refs : References, which are child elements of el
+            specials (dict): Dictionary of already created object
+
+        Returns:
+            List[Figure]: [CDE figure object]
+        """
+        caps = self._xpath(self.figures_caption_xpath, el)
+        label = self._xpath(self.figures_label_xpath, el)
+        caption = (
+            self._parse_text(caps[0], refs=refs, specials=specials, element_cls=Caption)[0]
+            if caps
+            else Caption("")
+        )
+        figure = Figure(caption, label=label, links=None)
+        return [figure]
+
+    def _parse_table_rows(self, els, refs, specials):
+        hdict = {}
+
+    def _parse_table(self, el, refs, specials) -> List[Table]:
+        """Parse a table to a CDE table object.
+
+        Args:
+            el (xml element): Root xml element
+            refs : References, which are child elements of el
+            specials (dict): Dictionary of already created objects
+
+        Returns:
+            List[Table]: [CDE table object]
+        """
+        caps = self._xpath(self.figures_caption_xpath, el)
+        caption = (
+            self._parse_text(caps[0], refs=refs, specials=specials, element_cls=Caption)[0]
+            if caps
+            else Caption("")
+        )
+        table = Table(caption, table_data=None)
+        return [table]
+
+    def _parse_authors(self, el) -> List[str]:
+        """Parse the xml element, which contains the authors, into a list of author names
+
+        Args:
+            el (xml element): Root xml element
+        Returns:
+            List[str]: List of author names
+        """
+        author_list = []
+        for author in self._xpath(self.metadata_authors_xpath, el):
+            name = ""
+            for i in author.iter():
+                if i.text is not None:
+                    name += i.text + " "
+            name = name[:-1]
+            author_list.append(name)
+        return author_list
+
+    def _parse_metadata(self, el) -> List[MetaData]:
+        """Parses the medata of xml element into CDE Metadata object.
+
+        Args:
+            el (xml element): Root xml element
+
+        Returns:
+            List[MetaData]: [Metadataobject]
+        """
+        title = self._xpath(self.metadata_title_xpath, el)
+        authors = self._parse_authors(el)
+        publisher = None
+        journal = None
+        date = self._xpath(self.metadata_date_xpath, el)
+        language = None
+        volume = None
+        issue = None
+        firstpage = None
+        lastpage = None
+        doi = self._xpath(self.metadata_doi_xpath, el)
+        pdf_url = None
+        html_url = None
+
+        metadata = {
+            "_title": title[0] if title else None,
+            "_authors": authors if authors else None,
+            "_publisher": publisher[0] if publisher else None,
+            "_journal": journal[0] if journal else None,
+            "_date": date[0] if date else None,
+            "_language": language[0] if language else None,
+            "_volume": volume[0] if volume else None,
+            "_issue": issue[0] if issue else None,
+            "_firstpage": firstpage[0] if firstpage else None,
+            "_lastpage": lastpage[0] if lastpage else None,
+            "_doi": doi[0] if doi else None,
+            "_pdf_url": pdf_url[0] if pdf_url else None,
+            "_html_url": html_url[0] if html_url else None,
+        }
+        meta = MetaData(metadata)
+        return [meta]
+
+    def _make_tree(self, fstring: Union[str, bytes, IO[bytes]]) -> ElementTree:
+        """Create xml tree without namespaces from string
+
+        Args:
+            fstring (Union[str, bytes, IO[bytes]]): XML string, content or binary file object
+
+        Returns:
+            ElementTree: XML tree
+        """
+        if isinstance(fstring, str):
+            fstring = fstring.encode("utf-8")
+        root = load_tei(fstring, recover=True)
+        return root
+
+    def _classify_elements(self, root) -> Tuple[List, List, List, List, List, List]:
+        """Sorts the elements matched by metadata_title_xpath, headings_xpath, figures_xpath, tables_xpath,
+        references_text_xpath and metadata_xpath into lists in a single walk over the tree. The lists are
+        in document order, as the results of the xpath queries.
+
+        Args:
+            root (xml element): Root xml element
+
+        Returns:
+            Tuple[List, List, List, List, List, List]: (titles, headings, figures, tables, references, metadata)
+        """
+        titles, headings, figures, tables, references, md = [], [], [], [], [], []
+        for el in root.iter():
+            tag = el.tag
+            if tag == "title" or tag == "head":
+                parent = el.getparent()
+                if parent is None or parent is root:
+                    continue
+                if tag == "title" and parent.tag == "titleStmt":
+                    titles.append(el)
+                elif tag == "head" and parent.tag == "div":
+                    headings.append(el)
+            elif tag == "figure" or tag == "ref":
+                # //div//*//figure: a div has to be an ancestor of an ancestor of the element
+                parent = el.getparent()
+                grandparent = parent.getparent() if parent is not None else None
+                if grandparent is None:
+                    continue
+                if grandparent.tag != "div" and next(grandparent.iterancestors("div"), None) is None:
+                    continue
+                if tag == "figure":
+                    xml_id = el.get(XML_ID, "")
+                    if "fig" in xml_id:
+                        figures.append(el)
+                    if "tab" in xml_id:
+                        tables.append(el)
+                elif "#b" in el.get("target", ""):
+                    references.append(el)
+            elif tag == "fileDesc" and not md:
+                md.append(el)
+        return titles, headings, figures, tables, references, md
+
+    def parse(self, file) -> Document:
+        """Parse a xml file into a CDE document
+
+        Args:
+            file: XML root element, string, content or binary file object
+
+        Raises:
+            ReaderError: XML could not be read
+
+        Returns:
+            Document: CDE document
+        """
+        return Document(*self.parse_elements(file), models=[Compound])
+
+    @timed("stage_seconds", stage="parse")
+    def parse_elements(self, file) -> List[BaseElement]:
+        """Parse a xml file into the CDE elements of its body, which are not yet part of a document
+
+        Args:
+            file: XML root element, string, content or binary file object
+
+        Raises:
+            ReaderError: XML could not be read
+
+        Returns:
+            List[BaseElement]: CDE elements (paragraphs, headings, figures, tables, ...)
+        """
+        if type(file) == etree._Element:
+            root = file
+        else:
+            root = self._make_tree(file)
+
+        self.root = root
+
+        if root is None:
+            raise ReaderError
+        for cleaner in self.cleaners:
+            cleaner(root)
+        specials = {}
+        refs = defaultdict(list)
+        titles, headings, figures, tables, references, md = self._classify_elements(root)
+        for reference in references:
+            refs[reference.getparent()].extend(self._parse_reference(reference))
+        # for ignore in ignores:
+        #    specials[ignore] = []
+        for title in titles:
+            specials[title] = self._parse_text(
+                title, element_cls=Title, refs=refs, specials=specials
+            )
+        for heading in headings:
+            specials[heading] = self._parse_text(
+                heading, element_cls=Heading, refs=refs, specials=specials
+            )
+        for figure in figures:
+            specials[figure] = self._parse_figure(figure, refs=refs, specials=specials)
+        for table in tables:
+            specials[table] = self._parse_table(table, refs=refs, specials=specials)
+        # for citation in citations:
+        #    specials[citation] = self._parse_text(citation, element_cls=Citation, refs=refs, specials=specials)
+        specials[md[0]] = self._parse_metadata(root)
+        root = self.root.find(self.main_document_body)
+        return self._parse_element(root, specials=specials, refs=refs)
+
+
+if __name__ == "__main__":
+    document = TeiXmlReader().parse(clean_xml("acssuschemeng.7b03870.tei.xml"))
+    print(document)
@@ -0,0 +1,311 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+import requests as r
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional
+from definitions import RATE_LIMITS
+from metrics import endpoint, increment, record_response
+
+
+class CircuitOpenError(r.exceptions.RequestException):
+    """Raised if a request is refused, because the circuit breaker of the service is open."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter. The rate is halved if the service throttles the client
+       and recovers additively with every successful request.
+
+    Args:
+        rate (float): Requests per second.
+        capacity (float, optional): Maximum burst size. Defaults to rate.
+        min_rate (float, optional): Lower bound of the rate when slowed down. Defaults to rate / 8.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, min_rate: Optional[float] = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 8
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        """Halve the rate after the service throttled a request."""
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        """Increase the rate towards the maximum rate after a successful request."""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class SharedTokenBucket(TokenBucket):
+    """Token bucket shared by all processes using the same file and name, e.g. the workers of
+       process_corpus, the stages of stream_corpus and the NER pool, so that together they stay within
+       the rate of the service. Tokens and the current rate are kept in a SQLite file and updated in a
+       write transaction, which serializes the processes.
+
+    Args:
+        name (str): Name of the bucket, e.g. the service
+        rate (float): Requests per second of all processes together.
+        path (str, optional): Path of the SQLite file. Defaults to RATE_LIMITS.
+        capacity (float, optional): Maximum burst size. Defaults to rate.
+        min_rate (float, optional): Lower bound of the rate when slowed down. Defaults to rate / 8.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        path: str = RATE_LIMITS,
+        capacity: Optional[float] = None,
+        min_rate: Optional[float] = None,
+    ):
+        super().__init__(rate, capacity, min_rate)
+        self.name = name
+        self.path = path
+        self._pid: Optional[int] = None
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections must not be shared with forked worker processes
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL, rate REAL)"
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    @contextmanager
+    def _state(self) -> Iterator[List[float]]:
+        """[tokens, rate] of the bucket refilled until now, changes of the list are stored at the end of
+        the block. Wall clock time is used, monotonic clocks are not comparable between processes."""
+        with self._lock:
+            connection = self.connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT tokens, updated, rate FROM buckets WHERE name = ?", (self.name,)
+                ).fetchone()
+                now = time.time()
+                if row is None:
+                    state = [self.capacity, self.max_rate]
+                else:
+                    tokens, updated, rate = row
+                    rate = min(self.max_rate, max(self.min_rate, rate))
+                    state = [min(self.capacity, tokens + max(0.0, now - updated) * rate), rate]
+                yield state
+                connection.execute(
+                    "INSERT OR REPLACE INTO buckets (name, tokens, updated, rate) VALUES (?, ?, ?, ?)",
+                    (self.name, state[0], now, state[1]),
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            self.rate = state[1]
+
+    def acquire(self):
+        """Block until a token is available in the shared bucket and take it."""
+        while True:
+            with self._state() as state:
+                if state[0] >= 1:
+                    state[0] -= 1
+                    return
+                wait = (1 - state[0]) / state[1]
+            time.sleep(wait)
+
+    def slow_down(self):
+        """Halve the shared rate after the service throttled a request."""
+        with self._state() as state:
+            state[1] = max(self.min_rate, state[1] / 2)
+
+    def speed_up(self):
+        """Increase the shared rate towards the maximum rate after a successful request."""
+        # self.rate is the rate seen last, no transaction while it is at the maximum
+        if self.rate < self.max_rate:
+            with self._state() as state:
+                state[1] = min(self.max_rate, state[1] + self.max_rate / 20)
+
+
+class MemoryBudget:
+    """Thread-safe budget of bytes held in memory at the same time, e.g. by the buffers of concurrent
+       uploads. acquire blocks until enough bytes are released by other threads.
+
+    Args:
+        capacity (int): Bytes available.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._available = capacity
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int):
+        """Block until size bytes are available and take them, sizes above the capacity take the whole budget."""
+        size = min(size, self.capacity)
+        with self._condition:
+            self._condition.wait_for(lambda: self._available >= size)
+            self._available -= size
+
+    def release(self, size: int):
+        size = min(size, self.capacity)
+        with self._condition:
+            self._available += size
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """Thread-safe circuit breaker. After failure_threshold consecutive failures all requests are
+       refused for reset_timeout seconds, then a single trial request is let through.
+
+    Args:
+        failure_threshold (int, optional): Consecutive failures until the circuit opens. Defaults to 5.
+        reset_timeout (float, optional): Seconds until a trial request is allowed. Defaults to 30.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """Returns whether a request may be sent."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._trial and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Exponential backoff with full jitter.
+
+    Args:
+        attempt (int): Number of the retry, starting at 0.
+        base_delay (float): Delay of the first retry in seconds.
+        max_delay (float): Upper bound of the delay in seconds.
+
+    Returns:
+        float: Seconds to wait
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def request_with_backoff(
+    session: r.Session,
+    method: str,
+    url: str,
+    limiter: Optional[TokenBucket] = None,
+    breaker: Optional[CircuitBreaker] = None,
+    max_retries: int = 5,
+    base_delay: float = 0.5,
+    max_delay: float = 30,
+    retry_statuses: Iterable[int] = (429, 500, 502, 503, 504),
+    service: str = "http",
+    **kwargs,
+) -> r.Response:
+    """Send a HTTP request, which is rate limited by limiter and retried with jittered exponential
+       backoff if the service throttles the request or the connection fails.
+
+    Args:
+        session (r.Session): Requests session object
+        method (str): HTTP method
+        url (str): URL
+        limiter (TokenBucket, optional): Rate limiter shared by all requests to the service.
+        breaker (CircuitBreaker, optional): Circuit breaker shared by all requests to the service.
+        max_retries (int, optional): Maximum number of retries. Defaults to 5.
+        base_delay (float, optional): Delay of the first retry in seconds. Defaults to 0.5.
+        max_delay (float, optional): Upper bound of a retry delay in seconds. Defaults to 30.
+        retry_statuses (Iterable[int], optional): Status codes, which are retried.
+        service (str, optional): Service label of the request metrics of every attempt. Defaults to "http".
+        **kwargs: Arguments for session.request
+
+    Raises:
+        CircuitOpenError: The circuit breaker of the service is open
+        r.exceptions.RequestException: The connection failed on the last retry
+
+    Returns:
+        r.Response: Response of the last attempt
+    """
+    for attempt in range(max_retries + 1):
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(f"Circuit breaker open, refused request to {url}")
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = record_response(service, session.request(method, url, **kwargs))
+        except (r.exceptions.ConnectionError, r.exceptions.Timeout) as error:
+            increment("http_errors_total", service=service, endpoint=endpoint(url), error=type(error).__name__)
+            if breaker is not None:
+                breaker.record_failure()
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+            continue
+        if response.status_code not in retry_statuses:
+            if breaker is not None:
+                breaker.record_success()
+            if limiter is not None:
+                limiter.speed_up()
+            return response
+        if breaker is not None:
+            breaker.record_failure()
+        if limiter is not None:
+            limiter.slow_down()
+        if attempt < max_retries:
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, min(max_delay, float(retry_after)))
+            time.sleep(delay)
+    return response
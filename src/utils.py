@@ -1,5 +1,17 @@
-from fake_useragent import FakeUserAgent
 import requests as r
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def _user_agent_pool():
+    """Loads the user agent database of fake_useragent once per process.
+
+    Returns:
+        FakeUserAgent: User agent pool.
+    """
+    from fake_useragent import FakeUserAgent
+
+    return FakeUserAgent()
 
 
 def create_user_agent() -> str:
@@ -8,7 +20,7 @@ def create_user_agent() -> str:
     Returns:
         str: User agent string.
     """
-    return str(FakeUserAgent().random)
+    return str(_user_agent_pool().random)
 
 
 def create_session() -> r.Session:
@@ -0,0 +1,89 @@
+import sqlite3
+import pytest
+import cache as cache_module
+from cache import ACCESS_FLUSH_SIZE, PubChemCache, SqliteLruCache
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module, "time", clock)
+    return clock
+
+
+def accessed(path, kind, key):
+    with sqlite3.connect(path) as connection:
+        return connection.execute("SELECT accessed FROM entries WHERE kind = ? AND key = ?", (kind, key)).fetchone()[0]
+
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    cache = SqliteLruCache(str(tmp_path / "cache.sqlite"), ttl=10)
+    cache.set("name", "water", b"962")
+    clock.now += 9
+    assert cache.get("name", "water") == b"962"
+    clock.now += 2
+    assert cache.get("name", "water") is None
+    assert cache.stats()["name"] == {"hits": 1, "misses": 1, "hit_ratio": 0.5}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = SqliteLruCache(str(tmp_path / "cache.sqlite"), max_size=35)
+    for key in "abc":
+        cache.set("kind", key, b"0123456789")
+        clock.now += 1
+    # a is used after b, so b is the least recently used entry
+    assert cache.get("kind", "a") is not None
+    clock.now += 1
+    cache.set("kind", "d", b"0123456789")
+    assert cache.get("kind", "b") is None
+    assert [cache.get("kind", key) is not None for key in "acd"] == [True, True, True]
+    assert cache._size <= 35
+
+
+def test_access_times_are_written_in_batches(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite")
+    cache = SqliteLruCache(path)
+    cache.set("kind", "a", b"value")
+    written = accessed(path, "kind", "a")
+    clock.now += 1
+    cache.get("kind", "a")
+    assert accessed(path, "kind", "a") == written
+    cache.flush()
+    assert accessed(path, "kind", "a") == clock.now
+    keys = [str(number) for number in range(ACCESS_FLUSH_SIZE)]
+    cache.set_many("kind", [(key, b"value") for key in keys])
+    clock.now += 1
+    for key in keys[:-1]:
+        cache.get("kind", key)
+    assert accessed(path, "kind", keys[0]) == clock.now - 1
+    cache.get("kind", keys[-1])
+    assert accessed(path, "kind", keys[0]) == clock.now
+
+
+def test_negative_results_expire_earlier(tmp_path, clock):
+    cache = PubChemCache(str(tmp_path / "cache.sqlite"), ttl=None, negative_ttl=60)
+    cache.set_cids("Unobtainium", [])
+    cache.set_cids("Water", [962])
+    assert cache.get_cids(" unobtainium ") == []
+    clock.now += 61
+    assert cache.get_cids("unobtainium") is None
+    assert cache.get_cids("WATER") == [962]
+
+
+def test_formulas_are_case_sensitive(tmp_path, clock):
+    cache = PubChemCache(str(tmp_path / "cache.sqlite"))
+    cache.set_formula_cids("CO", [281])
+    cache.set_formula_cids("Co", [104730])
+    assert cache.get_formula_cids(" CO ") == [281]
+    assert cache.get_formula_cids("Co") == [104730]
+    assert cache.get_formula_cids("co") is None
+    # Names and formulas are separate kinds
+    assert cache.get_cids("CO") is None
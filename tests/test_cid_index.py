@@ -0,0 +1,64 @@
+import math
+import pytest
+from cid_index import JACCARD, OVERLAP, WEIGHTED_JACCARD, CidIndex
+
+DOCUMENTS = {
+    "a": [1, 2, None, 3, 2],
+    "b": [3, 4, 1],
+    "c": [5, 3],
+}
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = CidIndex(str(tmp_path / "document_index.sqlite"))
+    for doc_id, cids in DOCUMENTS.items():
+        index.add_document(doc_id, cids)
+    return index
+
+
+def _weighted_jaccard(query, document, documents):
+    # Computed from all documents instead of the stored frequencies and sums
+    def idf(cid):
+        df = sum(cid in cids for cids in documents.values())
+        return math.log((1 + len(documents)) / (1 + df)) + 1
+
+    query, document = set(query) - {None}, set(document) - {None}
+    return sum(map(idf, query & document)) / sum(map(idf, query | document))
+
+
+def test_index_pairs(index):
+    matches = index.query([3, 9, 1], metric=OVERLAP)
+    assert [(match.doc_id, match.score) for match in matches] == [("a", 2.0), ("b", 2.0), ("c", 1.0)]
+    # First positions of the shared CIDs in the query and the document
+    assert [match.index_pairs for match in matches] == [[[0, 3], [2, 0]], [[0, 0], [2, 2]], [[0, 1]]]
+    assert [match.doc_id for match in index.query([3, 9, 1], exclude="a")] == ["b", "c"]
+
+
+def test_jaccard_scores(index):
+    scores = {match.doc_id: match.score for match in index.query([1, 3, 6], metric=JACCARD)}
+    assert scores == {"a": pytest.approx(2 / 4), "b": pytest.approx(2 / 4), "c": pytest.approx(1 / 4)}
+
+
+def test_weighted_jaccard_scores(index):
+    query = [1, 3, 6]
+    scores = {match.doc_id: match.score for match in index.query(query, metric=WEIGHTED_JACCARD)}
+    assert scores == {
+        doc_id: pytest.approx(_weighted_jaccard(query, cids, DOCUMENTS)) for doc_id, cids in DOCUMENTS.items()
+    }
+    # c only shares 3, which every document contains
+    assert scores["c"] < 1 / 4
+
+
+def test_readding_a_document_replaces_its_postings(index):
+    index.add_document("a", [4, 5])
+    documents = dict(DOCUMENTS, a=[4, 5])
+    assert len(index) == 3
+    assert [match.doc_id for match in index.query([2])] == []
+    matches = index.query([4, 5], metric=WEIGHTED_JACCARD)
+    assert {match.doc_id: match.score for match in matches} == {
+        doc_id: pytest.approx(_weighted_jaccard([4, 5], cids, documents)) for doc_id, cids in documents.items()
+    }
+    assert matches[0].doc_id == "a" and matches[0].index_pairs == [[0, 0], [1, 1]]
+    index.remove_document("a")
+    assert [match.doc_id for match in index.query([4, 5])] == ["b", "c"]
@@ -0,0 +1,52 @@
+import pytest
+from formula import Formula, formula_properties, looks_like_formula, normalize_formula, parse_formula
+
+
+@pytest.mark.parametrize(
+    "text, formula",
+    [
+        ("Ca2+", Formula({"Ca": 1}, 2)),
+        ("Fe3+", Formula({"Fe": 1}, 3)),
+        ("Ce4+", Formula({"Ce": 1}, 4)),
+        ("H2+", Formula({"H": 2}, 1)),
+        ("Na2+", Formula({"Na": 2}, 1)),
+        ("Cl-", Formula({"Cl": 1}, -1)),
+        ("NH4+", Formula({"N": 1, "H": 4}, 1)),
+        ("NO3-", Formula({"N": 1, "O": 3}, -1)),
+        ("SO4^2-", Formula({"S": 1, "O": 4}, -2)),
+        ("O4S-2", Formula({"O": 4, "S": 1}, -2)),
+        ("[Fe(CN)6]3-", Formula({"Fe": 1, "C": 6, "N": 6}, -3)),
+        ("CuSO4·5H2O", Formula({"Cu": 1, "S": 1, "O": 9, "H": 10}, 0)),
+    ],
+)
+def test_parse_formula(text, formula):
+    assert parse_formula(text) == formula
+
+
+@pytest.mark.parametrize("text", ["SO42-", "CO32-", "PO43-"])
+def test_ambiguous_charges_are_rejected(text):
+    assert parse_formula(text) is None
+    assert not looks_like_formula(text)
+
+
+def test_normalized_formulas():
+    assert normalize_formula("NaCl") == normalize_formula("ClNa") == "ClNa"
+    assert normalize_formula("SO4^2-") == normalize_formula("O4S-2") == "O4S-2"
+    assert normalize_formula("Fe3+") == "Fe+3"
+
+
+@pytest.mark.parametrize("text", ["CO", "PVP", "BOCs", "COs", "CNTs", "No", "AmCl3"])
+def test_abbreviations_are_no_formulas(text):
+    assert not looks_like_formula(text)
+
+
+@pytest.mark.parametrize("text", ["H2O", "Cs", "CsCl", "NaOs", "Ca2+", "H2+", "PuO2"])
+def test_formulas(text):
+    assert looks_like_formula(text)
+
+
+def test_formula_properties():
+    water, calcium, name = formula_properties(["H2O", "Ca2+", "water"])
+    assert water["molecular_weight"] == 18.015 and water["molecular_formula"] == "H2O"
+    assert calcium["molecular_weight"] == 40.078 and calcium["molecular_formula"] == "Ca+2"
+    assert name is None
@@ -0,0 +1,71 @@
+import pytest
+import requests
+import hyplag_backend
+
+
+def _http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(response=response)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    polls = {}
+
+    def fetch_tei(document_id, token, session):
+        polls[document_id] = polls.get(document_id, 0) + 1
+        if document_id == 1 and polls[document_id] < 3:
+            raise _http_error(503)
+        if document_id == 2:
+            raise _http_error(403)
+        return b"<TEI/>"
+
+    monkeypatch.setattr(hyplag_backend, "poll_delay", lambda attempt, *args: 0.01)
+    monkeypatch.setattr(hyplag_backend, "post_document", lambda path, *args: {"a.pdf": 1, "b.pdf": 2}[path.name])
+    monkeypatch.setattr(hyplag_backend, "fetch_tei", fetch_tei)
+    return polls
+
+
+def test_transient_poll_errors_are_retried(backend):
+    results = hyplag_backend.process_documents_hyplag(["a.pdf", "b.pdf"], token="token", num_threads=2, timeout=5)
+    assert results["a.pdf"].tei == b"<TEI/>" and results["a.pdf"].polls == 3
+    assert results["b.pdf"].tei is None and results["b.pdf"].error.response.status_code == 403
+    assert backend == {1: 3, 2: 1}
+
+
+def test_wait_for_document_retries_transient_errors(backend):
+    assert hyplag_backend.wait_for_document(1, "token", timeout=5) == b"<TEI/>"
+
+
+@pytest.mark.parametrize("num_threads", [0, -1])
+def test_invalid_number_of_threads(num_threads):
+    with pytest.raises(ValueError):
+        hyplag_backend.process_documents_hyplag(["a.pdf"], token="token", num_threads=num_threads)
+
+
+class _Session:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.requests = 0
+
+    def get(self, url, headers):
+        self.requests += 1
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.request = requests.Request("GET", url).prepare()
+        response._content = b""
+        return response
+
+
+@pytest.mark.parametrize("status_code", [202, 204])
+def test_documents_in_processing_are_not_ready(status_code):
+    assert hyplag_backend.fetch_tei(1, "token", _Session(status_code)) is None
+
+
+def test_unknown_documents_fail(monkeypatch):
+    monkeypatch.setattr(hyplag_backend, "poll_delay", lambda attempt, *args: 0.01)
+    session = _Session(404)
+    with pytest.raises(requests.exceptions.HTTPError):
+        hyplag_backend.wait_for_document(1, "token", timeout=5, session=session)
+    assert session.requests == 1
@@ -0,0 +1,71 @@
+import pytest
+import image_store
+from image_store import ImageStore
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(image_store, "time", clock)
+    return clock
+
+
+def _png(number: int) -> bytes:
+    return b"\x89PNG" + bytes([number]) * 15
+
+
+def test_hits_and_misses(tmp_path, clock):
+    store = ImageStore(str(tmp_path), ttl=None)
+    assert store.get(962) is None
+    store.put(962, _png(1))
+    assert store.get(962) == _png(1)
+    assert store.stats() == {"hits": 1, "misses": 1, "hit_ratio": 0.5}
+
+
+def test_identical_images_are_stored_once(tmp_path, clock):
+    store = ImageStore(str(tmp_path), ttl=None)
+    assert store.put(1, _png(1)) == store.put(2, _png(1))
+    assert len(list((tmp_path / "objects").glob("*/*.png"))) == 1
+    assert ImageStore(str(tmp_path))._size == len(_png(1))
+
+
+def test_expired_images_are_missing(tmp_path, clock):
+    store = ImageStore(str(tmp_path), ttl=10)
+    store.put(962, _png(1))
+    clock.now += 9
+    assert store.get(962) == _png(1)
+    clock.now += 2
+    assert store.get(962) is None and store.digest(962) is None
+
+
+def test_least_recently_used_images_are_evicted(tmp_path, clock):
+    store = ImageStore(str(tmp_path), ttl=None, max_size=70)
+    for cid in (1, 2, 3):
+        store.put(cid, _png(cid))
+        clock.now += 1
+    # 1 is used after 2, so 2 is the least recently used image
+    assert store.get(1) is not None
+    clock.now += 1
+    store.put(4, _png(4))
+    assert store.get(2) is None
+    assert [store.get(cid) is not None for cid in (1, 3, 4)] == [True, True, True]
+    assert store._size == 3 * len(_png(1))
+
+
+def test_shared_images_are_kept_while_referenced(tmp_path, clock):
+    store = ImageStore(str(tmp_path), ttl=None, max_size=50)
+    for cid, number in ((1, 1), (3, 3), (2, 1), (4, 4)):
+        store.put(cid, _png(number))
+        clock.now += 1
+    # 1 and 3 are evicted, the image of 1 is still referenced by 2
+    assert store.get(1) is None and store.get(3) is None
+    assert store.get(2) == _png(1) and store.get(4) == _png(4)
+    assert len(list((tmp_path / "objects").glob("*/*.png"))) == 2
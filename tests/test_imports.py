@@ -0,0 +1,29 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+# Imported by the functions that need them, the entry points start without them. The import times are
+# measured by check_import_times of the benchmark suite.
+HEAVY_MODULES = ("chemdataextractor", "pubchempy", "numpy", "lxml", "bs4", "grobid_client")
+DEFERRED_MODULES = {
+    "main": HEAVY_MODULES + ("requests",),
+    "server": HEAVY_MODULES + ("requests",),
+    "client": HEAVY_MODULES,
+}
+
+
+@pytest.mark.parametrize("module", sorted(DEFERRED_MODULES))
+def test_entry_points_defer_heavy_imports(module):
+    # A fresh interpreter, the test session has imported most modules already
+    process = subprocess.run(
+        [sys.executable, "-c", f"import json, sys, {module}; print(json.dumps(sorted(sys.modules)))"],
+        cwd=SRC,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    loaded = {name.split(".")[0] for name in json.loads(process.stdout)}
+    assert loaded.isdisjoint(DEFERRED_MODULES[module]), sorted(loaded.intersection(DEFERRED_MODULES[module]))
@@ -0,0 +1,44 @@
+import multiprocessing
+import pytest
+from metrics import MetricsRegistry, get_metrics, increment, observe
+from pipeline import PROCESS, Stage, run_pipeline
+
+
+@pytest.fixture
+def registry():
+    registry = get_metrics()
+    enabled = registry.enabled
+    registry.enabled = True
+    registry.reset()
+    yield registry
+    registry.reset()
+    registry.enabled = enabled
+
+
+def _counted_square(value):
+    increment("squares_total")
+    observe("square_seconds", 0.01)
+    return value * value
+
+
+def test_drained_metrics_are_merged():
+    worker, parent = MetricsRegistry(enabled=True), MetricsRegistry(enabled=True)
+    parent.increment("items_total", 2)
+    worker.increment("items_total", 3)
+    worker.observe("stage_seconds", 0.2, stage="ner")
+    worker.set_gauge("queue_size", 4)
+    parent.merge(worker.drain())
+    parent.merge(worker.drain())
+    assert parent.counters[("items_total", ())] == 5
+    assert parent.gauges[("queue_size", ())] == 4
+    assert parent.histograms[("stage_seconds", (("stage", "ner"),))].count == 1
+    assert worker.drain() == ({}, {}, {})
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_process_stage_metrics_reach_the_parent(registry):
+    stages = [Stage("square", _counted_square, 2, PROCESS)]
+    results = list(run_pipeline(range(5), stages, multiprocessing.get_context("fork")))
+    assert sorted(result.value for result in results) == [0, 1, 4, 9, 16]
+    assert registry.counters[("squares_total", ())] == 5
+    assert registry.histograms[("square_seconds", ())].count == 5
@@ -0,0 +1,46 @@
+from name_index import NameIndex, build_name_index
+
+SYNONYMS = "1\tBenzene\n1\tbenzol\n2\tbenzol\n2\tcyclohexatriene\n2\tbenzene\n3\tWater\n3\toxidane\n"
+TITLES = "2\tcyclohexatriene\n3\twater\n"
+PROPERTIES = "CID,IUPACName,MolecularFormula,MolecularWeight\n1,benzene,C6H6,78.11\n3,oxidane,H2O,18.015\n"
+
+
+def build(tmp_path, **options):
+    for name, content in (("synonyms", SYNONYMS), ("titles", TITLES), ("properties.csv", PROPERTIES)):
+        (tmp_path / name).write_text(content)
+    output = str(tmp_path / "names.idx")
+    properties = str(tmp_path / "properties.csv")
+    stats = build_name_index(output, str(tmp_path / "synonyms"), str(tmp_path / "titles"), properties, **options)
+    return stats, NameIndex(output)
+
+
+def test_cids_in_pubchem_order(tmp_path):
+    stats, index = build(tmp_path, run_size=2, all_cids=True)
+    assert stats == {"names": 5, "cids": 2}
+    assert index.cids("benzene") == [1, 2]
+    assert index.cids("Benzol") == [2, 1]
+    assert index.cids("cyclohexatriene") == [2]
+    assert index.cids("water") == [3]
+    assert index.cids("toluene") is None
+
+
+def test_only_cids_with_properties(tmp_path):
+    _, index = build(tmp_path, run_size=3)
+    assert index.cids("benzol") == [1]
+    assert index.cids("cyclohexatriene") is None
+    assert index.properties(3) == {
+        "CID": 3,
+        "IUPACName": "oxidane",
+        "MolecularFormula": "H2O",
+        "MolecularWeight": 18.015,
+        "Synonyms": ["Water", "oxidane"],
+    }
+    assert index.properties(2) is None
+
+
+def test_run_size_does_not_change_the_index(tmp_path):
+    build(tmp_path, run_size=1)
+    small_runs = (tmp_path / "names.idx").read_bytes()
+    build(tmp_path)
+    assert (tmp_path / "names.idx").read_bytes() == small_runs
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["names.idx", "properties.csv", "synonyms", "titles"]
@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip("chemdataextractor")
+from ner import merge_records  # noqa: E402
+
+
+def compound(names=(), labels=(), **fields):
+    return {"Compound": dict(names=list(names), labels=list(labels), **fields)}
+
+
+def test_records_with_a_shared_name_are_merged():
+    merged = merge_records([[compound(["benzene"], ["1"])], [compound(["benzene", "C6H6"], ["2"])]])
+    assert merged == [compound(["benzene", "C6H6"], ["1", "2"])]
+
+
+def test_bridging_record_joins_all_matching_records():
+    merged = merge_records(
+        [
+            [compound(["benzene"]), compound(["toluene"], ["2"]), compound(["water"])],
+            [compound(["benzene", "toluene"], ["3"])],
+            [compound(["toluene"], ["4"])],
+        ]
+    )
+    assert merged == [compound(["benzene", "toluene"], ["2", "3", "4"]), compound(["water"])]
+
+
+def test_records_without_compound_are_kept_once():
+    merged = merge_records([[{"Other": 1}, compound(["water"])], [{"Other": 1}]])
+    assert merged == [{"Other": 1}, compound(["water"])]
@@ -0,0 +1,40 @@
+from lxml import etree
+from parser import XML_ID, load_tei
+
+TEI = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<TEI xmlns="http://www.tei-c.org/ns/1.0" xmlns:xlink="http://www.w3.org/1999/xlink">'
+    b'<text><body><div><head n="1">Intro</head>'
+    b'<p title="a > b xmlns=&quot;x&quot;">Benzene<ref target="#b0">[1]</ref></p>'
+    b'<!-- <p xmlns="http://example.org"> -->'
+    b'<p><![CDATA[<x xmlns="http://example.org">]]></p>'
+    b'<xlink:note xml:id="n1">prefixed</xlink:note>'
+    b"</div></body></text></TEI>"
+)
+
+
+def test_tags_have_no_namespace():
+    root = load_tei(TEI)
+    assert root.tag == "TEI"
+    assert all(elem.tag[0] != "{" for elem in root.iter(etree.Element))
+    assert root.find(".//body/div/head").text == "Intro"
+    assert root.find(".//note").get(XML_ID) == "n1"
+
+
+def test_attributes_comments_and_cdata_are_kept():
+    root = load_tei(TEI)
+    paragraphs = root.findall(".//p")
+    assert paragraphs[0].get("title") == 'a > b xmlns="x"'
+    assert paragraphs[0].find("ref").get("target") == "#b0"
+    comments = [elem for elem in root.iter(etree.Comment)]
+    assert comments[0].text == ' <p xmlns="http://example.org"> '
+    assert paragraphs[1].text == '<x xmlns="http://example.org">'
+
+
+def test_sources_give_the_same_tree(tmp_path):
+    path = tmp_path / "doc.tei.xml"
+    path.write_bytes(TEI)
+    expected = etree.tostring(load_tei(TEI))
+    assert etree.tostring(load_tei(str(path))) == expected
+    with open(path, "rb") as file:
+        assert etree.tostring(load_tei(file)) == expected
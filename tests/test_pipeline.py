@@ -0,0 +1,36 @@
+import pytest
+from pipeline import PipelineResult, Stage, run_pipeline
+
+
+def _double(value: int) -> int:
+    return 2 * value
+
+
+def _fail_on_two(value: int) -> int:
+    if value == 2:
+        raise ValueError("two")
+    return value
+
+
+def test_run_pipeline_processes_all_items():
+    results = run_pipeline(range(10), [Stage("double", _double, 3), Stage("double_again", _double, 2)])
+    assert sorted(result.value for result in results) == [4 * i for i in range(10)]
+
+
+def test_run_pipeline_reports_stage_failures():
+    results = {result.key: result for result in run_pipeline(range(4), [Stage("fail", _fail_on_two, 2)])}
+    assert results[2] == PipelineResult(2, None, results[2].error, "fail")
+    assert isinstance(results[2].error, ValueError)
+    assert [results[key].value for key in (0, 1, 3)] == [0, 1, 3]
+
+
+def test_run_pipeline_raises_source_error_after_results():
+    def source():
+        yield 1
+        raise ConnectionError("search page failed")
+
+    results = []
+    with pytest.raises(ConnectionError, match="search page failed"):
+        for result in run_pipeline(source(), [Stage("double", _double, 2)]):
+            results.append(result)
+    assert results == [PipelineResult(1, 2)]
@@ -0,0 +1,60 @@
+import random
+import pytest
+
+pytest.importorskip("numpy")
+from records import NO_CID, ChemicalBatch, cid_column, shared_cid_pairs  # noqa: E402
+
+CHEMICALS = {
+    "a.pdf": [
+        ["water", 962, ["H", "O"], 18.015, "H2O"],
+        ["unknown", None, [], None, None],
+        ["carbon monoxide", 281, ["C", "O"], 28.01, "CO"],
+    ],
+    "b.pdf": [],
+    "c.pdf": [["cobalt", 104730, ["Co"], 58.933, "Co"], ["water", 962, ["H", "O"], 18.015, "H2O"]],
+}
+
+
+def _list_pairs(source, target):
+    # Comparison of compare_documents before shared_cid_pairs
+    pairs = []
+    for i, source_cid in enumerate(source):
+        for j, target_cid in enumerate(target):
+            if source_cid == target_cid:
+                pairs.append([i, j])
+                break
+    return pairs
+
+
+def test_batch_round_trip(tmp_path):
+    batch = ChemicalBatch.from_documents(CHEMICALS)
+    batch.save(str(tmp_path / "batch.bin"))
+    loaded = ChemicalBatch.load(str(tmp_path / "batch.bin"))
+    assert loaded.documents == ["a.pdf", "b.pdf", "c.pdf"]
+    assert [record.to_row()[:5] for record in loaded] == [row for rows in CHEMICALS.values() for row in rows]
+    assert loaded.cid.tolist() == [962, NO_CID, 281, 104730, 962]
+    assert loaded.element_mask("O").tolist() == [True, False, True, False, True]
+    assert len(loaded.select(loaded.document_mask("c.pdf"))) == 2
+    assert not loaded.cid.flags.writeable
+
+
+def test_empty_batch_round_trip(tmp_path):
+    ChemicalBatch.from_rows([], "empty.pdf").save(str(tmp_path / "batch.bin"))
+    loaded = ChemicalBatch.load(str(tmp_path / "batch.bin"))
+    assert len(loaded) == 0 and list(loaded) == [] and loaded.documents == ["empty.pdf"]
+    assert loaded.elements.shape == (0, ChemicalBatch.from_rows([]).elements.shape[1])
+
+
+def test_load_rejects_other_files(tmp_path):
+    (tmp_path / "batch.bin").write_bytes(b"not a batch" * 10)
+    with pytest.raises(ValueError):
+        ChemicalBatch.load(str(tmp_path / "batch.bin"))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_shared_cid_pairs_match_the_list_comparison(seed):
+    generator = random.Random(seed)
+    source = [generator.choice([None, 1, 2, 3, 5, 8]) for _ in range(generator.randrange(12))]
+    target = [generator.choice([None, 2, 3, 4, 8, 13]) for _ in range(generator.randrange(12))]
+    rows = [[[None, cid, [], None, None] for cid in cids] for cids in (source, target)]
+    assert shared_cid_pairs(cid_column(rows[0]), cid_column(rows[1])).tolist() == _list_pairs(source, target)
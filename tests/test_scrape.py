@@ -0,0 +1,73 @@
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("fake_useragent")
+import scrape  # noqa: E402
+
+URL = "https://pubs.acs.org/doi/pdf/10.1021/acssuschemeng.7b03870"
+
+
+class Response:
+    def __init__(self, status_code, body=b"", content_range=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {"Content-Type": "application/pdf"}
+        if content_range:
+            self.headers["Content-Range"] = content_range
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise scrape.r.exceptions.HTTPError(self.status_code)
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+
+class Session:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.ranges = []
+
+    def get(self, url, headers, stream, timeout):
+        self.ranges.append(headers.get("Range"))
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def download(tmp_path, monkeypatch):
+    monkeypatch.setattr(scrape, "record_response", lambda service, response: response)
+    path = tmp_path / scrape.pdf_name_from_url(URL)
+    (tmp_path / (path.name + ".part")).write_bytes(b"abc")
+
+    def run(*responses):
+        session = Session(*responses)
+        result = scrape.download_pdf(URL, str(tmp_path) + "/", session)
+        assert not (tmp_path / (path.name + ".part")).exists()
+        return result.status, path.read_bytes(), session.ranges
+
+    return run
+
+
+def test_complete_partial_file(download):
+    assert download(Response(416, content_range="bytes */3")) == (scrape.RESUMED, b"abc", ["bytes=3-"])
+
+
+def test_partial_file_of_another_size_is_downloaded_again(download):
+    result = download(Response(416, content_range="bytes */10"), Response(200, b"0123456789"))
+    assert result == (scrape.DOWNLOADED, b"0123456789", ["bytes=3-", None])
+
+
+def test_resumed_range(download):
+    result = download(Response(206, b"3456", "bytes 3-6/7"))
+    assert result == (scrape.RESUMED, b"abc3456", ["bytes=3-"])
+
+
+def test_other_range_is_downloaded_again(download):
+    result = download(Response(206, b"23456", "bytes 2-6/7"), Response(200, b"0123456"))
+    assert result == (scrape.DOWNLOADED, b"0123456", ["bytes=3-", None])
@@ -0,0 +1,78 @@
+import concurrent.futures
+import json
+import os
+import threading
+import urllib.request
+import pytest
+
+pytest.importorskip("chemdataextractor")
+import cache  # noqa: E402
+import hyplag_backend  # noqa: E402
+import image_store  # noqa: E402
+import main  # noqa: E402
+import ner  # noqa: E402
+import pubchem  # noqa: E402
+import server  # noqa: E402
+from manifest import Manifest  # noqa: E402
+from pubchem import NameResolution  # noqa: E402
+
+TEI_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "xml_files", "acssuschemeng.7b03870.tei.xml"
+)
+DOCUMENTS = 4
+
+
+class EmptyManifest(Manifest):
+    """Records nothing, so that every request runs the NER."""
+
+    def set(self, key, stage, value, source=None):
+        pass
+
+
+def _resolve(chem_names, session, include_images=False):
+    return NameResolution([[name, None, [], None, None] for name in chem_names], 0)
+
+
+@pytest.fixture
+def url(tmp_path, monkeypatch):
+    pdf_files = str(tmp_path) + os.sep
+    for number in range(DOCUMENTS):
+        (tmp_path / f"{number}.pdf").write_bytes(b"%PDF-1.4 " + bytes([number]))
+    with open(TEI_FILE, "rb") as file:
+        tei = file.read()
+    manifest = EmptyManifest(str(tmp_path / "manifest.sqlite"))
+    store = image_store.ImageStore(str(tmp_path / "image_files"))
+    # Patched before the workers are forked by warm_up
+    monkeypatch.setattr(main, "PDF_FILES", pdf_files)
+    monkeypatch.setattr(server, "PDF_FILES", pdf_files)
+    monkeypatch.setattr(main, "get_manifest", lambda: manifest)
+    monkeypatch.setattr(server, "get_manifest", lambda: manifest)
+    monkeypatch.setattr(main, "convert_pdf", lambda pdf_name, save_xml=False: tei)
+    monkeypatch.setattr(pubchem, "resolve_names_with_failures", _resolve)
+    monkeypatch.setattr(image_store, "get_image_store", lambda: store)
+    monkeypatch.setattr(cache, "get_pubchem_cache", lambda: None)
+    monkeypatch.setattr(ner, "get_ner_cache", lambda: None)
+    monkeypatch.setattr(hyplag_backend, "get_current_token", lambda: "token")
+    service = server.ExtractionService(workers=DOCUMENTS)
+    service.warm_up()
+    http_server = server.ExtractionServer(("127.0.0.1", 0), service)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{http_server.server_address[1]}"
+    http_server.shutdown()
+    http_server.server_close()
+    service.shutdown()
+
+
+def _post(url, path, body):
+    request = urllib.request.Request(url + path, json.dumps(body).encode("utf-8"), {"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=600) as response:
+        return json.load(response)
+
+
+def test_concurrent_requests_match_serial_runs(url):
+    pdf_names = [f"{number}.pdf" for number in range(DOCUMENTS)]
+    serial = [_post(url, "/process_pdf", {"pdf_name": pdf_name}) for pdf_name in pdf_names]
+    assert all(serial)
+    with concurrent.futures.ThreadPoolExecutor(2 * DOCUMENTS) as executor:
+        results = list(executor.map(lambda pdf_name: _post(url, "/process_pdf", {"pdf_name": pdf_name}), pdf_names * 2))
+    assert results == serial * 2
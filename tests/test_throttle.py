@@ -0,0 +1,120 @@
+import datetime
+import multiprocessing
+import pytest
+import requests
+import throttle
+from throttle import CircuitBreaker, CircuitOpenError, SharedTokenBucket, request_with_backoff
+
+
+class Clock:
+    """Fake time module, sleeping advances the clock."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttle, "time", clock)
+    return clock
+
+
+def _response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response.request = requests.Request("GET", "https://example.org/compound/1").prepare()
+    response.elapsed = datetime.timedelta(0)
+    return response
+
+
+class Session:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+
+    def request(self, method, url, **kwargs):
+        self.requests += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def _drain_bucket(bucket):
+    # Runs in a forked process with the fake clock of the parent
+    for _ in range(2):
+        bucket.acquire()
+    bucket.slow_down()
+    raise SystemExit(len(throttle.time.sleeps))
+
+
+def test_processes_share_a_bucket(tmp_path, clock):
+    path = str(tmp_path / "rate_limits.sqlite")
+    bucket = SharedTokenBucket("service", rate=4, path=path, capacity=2)
+    process = multiprocessing.get_context("fork").Process(target=_drain_bucket, args=(bucket,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    # The other process took the burst and halved the rate
+    other = SharedTokenBucket("service", rate=4, path=path, capacity=2)
+    other.acquire()
+    assert clock.sleeps == [0.5] and other.rate == 2
+    # Buckets of other names are independent
+    SharedTokenBucket("other", rate=4, path=path, capacity=2).acquire()
+    assert clock.sleeps == [0.5]
+
+
+def test_circuit_breaker_opens_and_resets(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.allow()
+    clock.now += 10
+    # A single trial request, its failure opens the circuit again
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open and breaker.allow() and breaker.allow()
+
+
+def test_throttled_requests_are_retried(clock):
+    session = Session([_response(429, {"Retry-After": "3"}), _response(200)])
+    limiter = throttle.TokenBucket(rate=8)
+    response = request_with_backoff(session, "GET", "https://example.org/compound/1", limiter=limiter, max_delay=30)
+    assert response.status_code == 200 and session.requests == 2
+    assert clock.sleeps == [3.0]
+    # Slowed down to 4 requests per second, then sped up again
+    assert limiter.rate == pytest.approx(4.4)
+
+
+def test_connection_errors_are_retried_until_max_retries(clock):
+    session = Session([requests.exceptions.ConnectionError()] * 3)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        request_with_backoff(session, "GET", "https://example.org/", max_retries=2)
+    assert session.requests == 3 and len(clock.sleeps) == 2
+
+
+def test_open_circuit_refuses_requests(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    session = Session([_response(503), _response(503)])
+    with pytest.raises(CircuitOpenError):
+        request_with_backoff(session, "GET", "https://example.org/", breaker=breaker, max_retries=5)
+    assert session.requests == 2